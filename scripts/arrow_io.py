@@ -0,0 +1,237 @@
+"""
+Arrow / Parquet 形式のデータセットを読み書きする共通モジュール
+
+拡張子が .arrow（Arrow IPC ファイル形式）または .parquet のファイルは、
+JSONL の代わりに以下の列を持つ列指向のデータセットとして扱います。
+
+    id           string        エントリのID
+    title        string        タイトル
+    text         large_string  本文
+    token_count  int64         トークン数（分割処理などで計算済みの場合のみ。不明な場合は null）
+    base_name    string        タイトルから抽出したベース名（merge_jsonl_by_title.py と同じ解析）
+    block_num    int32         タイトルから抽出したblock番号
+    key_order    string        元のJSONのキーの順序（id, title, text の順以外の場合のみ。JSON配列）
+    extra        large_string  id / title / text 以外のフィールド（ある場合のみ。JSONオブジェクト）
+
+key_order と extra により、JSONL との相互変換で元のエントリを完全に復元できます。
+.arrow ファイルはメモリマップで読み込むため、必要な列だけを読む場合（統計やタイトル集計）は
+本文の列に触れずに処理できます。pyarrow が必要です。
+"""
+
+import json
+import sys
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from merge_jsonl_by_title import extract_base_name_and_block_num
+
+ARROW_SUFFIXES = (".arrow", ".parquet")
+STANDARD_KEYS = ["id", "title", "text"]
+BATCH_SIZE = 10000
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Arrow / Parquet 形式を扱うには pyarrow が必要です: pip install pyarrow")
+    return pyarrow
+
+
+def is_arrow_file(path):
+    return str(path).endswith(ARROW_SUFFIXES)
+
+
+def schema():
+    pa = _import_pyarrow()
+    return pa.schema([
+        ("id", pa.string()),
+        ("title", pa.string()),
+        ("text", pa.large_string()),
+        ("token_count", pa.int64()),
+        ("base_name", pa.string()),
+        ("block_num", pa.int32()),
+        ("key_order", pa.string()),
+        ("extra", pa.large_string()),
+    ])
+
+
+def _entry_to_row(entry, token_count):
+    """エントリを列の値に変換する（文字列以外の id / title / text は extra に保存する）"""
+    row = {key: None for key in STANDARD_KEYS}
+    extra = {}
+    for key, value in entry.items():
+        if key in row and isinstance(value, str):
+            row[key] = value
+        else:
+            extra[key] = value
+
+    keys = list(entry.keys())
+    base_name, block_num = extract_base_name_and_block_num(row["title"] or "")
+    row["token_count"] = token_count
+    row["base_name"] = base_name
+    row["block_num"] = block_num
+    row["key_order"] = None if keys == STANDARD_KEYS else json.dumps(keys, ensure_ascii=False)
+    row["extra"] = json.dumps(extra, ensure_ascii=False) if extra else None
+    return row
+
+
+def _row_to_entry(row):
+    """列の値からエントリを復元する"""
+    keys = json.loads(row["key_order"]) if row["key_order"] is not None else STANDARD_KEYS
+    extra = json.loads(row["extra"]) if row["extra"] is not None else {}
+    return {key: extra[key] if key in extra else row[key] for key in keys}
+
+
+class ArrowRecordWriter:
+    """エントリを Arrow IPC ファイルまたは Parquet ファイルに書き込む（BATCH_SIZE 件ごとにバッチを書き出す）"""
+
+    def __init__(self, path):
+        self.pa = _import_pyarrow()
+        self.path = str(path)
+        self.schema = schema()
+        if self.path.endswith(".parquet"):
+            self.writer = self.pa.parquet.ParquetWriter(self.path, self.schema)
+        else:
+            self.sink = self.pa.OSFile(self.path, 'wb')
+            self.writer = self.pa.ipc.new_file(self.sink, self.schema)
+        self.rows = {name: [] for name in self.schema.names}
+        self.count = 0
+
+    def write(self, entry, token_count=None):
+        for name, value in _entry_to_row(entry, token_count).items():
+            self.rows[name].append(value)
+        self.count += 1
+        if len(self.rows["id"]) >= BATCH_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows["id"]:
+            return
+        batch = self.pa.record_batch(
+            [self.pa.array(self.rows[field.name], type=field.type) for field in self.schema],
+            schema=self.schema
+        )
+        self.writer.write_batch(batch)
+        self.rows = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+        if not self.path.endswith(".parquet"):
+            self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def read_table(path, columns=None):
+    """
+    データセットを pyarrow.Table として読み込む
+    .arrow はメモリマップで読み込むため、指定した列以外のデータは読み込まれない（ゼロコピー）。
+    .parquet は指定した列のみを読み込む。
+    """
+    pa = _import_pyarrow()
+    path = str(path)
+    if path.endswith(".parquet"):
+        return pa.parquet.read_table(path, columns=columns, memory_map=True)
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return table.select(columns) if columns is not None else table
+
+
+def iter_records(path):
+    """データセットの各エントリを元のJSONLと同じ辞書として返す"""
+    table = read_table(path)
+    for batch in table.to_batches(max_chunksize=BATCH_SIZE):
+        for row in batch.to_pylist():
+            yield _row_to_entry(row)
+
+
+def count_rows(path):
+    pa = _import_pyarrow()
+    path = str(path)
+    if path.endswith(".parquet"):
+        return pa.parquet.ParquetFile(path).metadata.num_rows
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all().num_rows
+
+
+def write_columns(path, columns):
+    """
+    列名 → 値のリスト（または numpy 配列）の辞書を .parquet / .arrow ファイルに書き込む
+    （集計結果のエクスポートなど、エントリ以外の表を保存する場合に使用する）
+    """
+    pa = _import_pyarrow()
+    table = pa.table(columns)
+    path = str(path)
+    if path.endswith(".parquet"):
+        pa.parquet.write_table(table, path)
+        return
+    with pa.ipc.new_file(path, table.schema) as writer:
+        writer.write_table(table)
+
+
+def token_counts(path):
+    """
+    計算済みのトークン数を numpy 配列で返す（1件でも不明なエントリがある場合は None）
+    token_count 列のみを読み込むため、本文は読み込まれない。
+    """
+    column = read_table(path, columns=["token_count"]).column("token_count")
+    if column.null_count:
+        return None
+    return column.to_numpy()
+
+
+def convert(input_file, output_file):
+    """
+    JSONL と Arrow / Parquet の相互変換（拡張子で判定）
+    入力が Arrow / Parquet で出力も Arrow / Parquet の場合は、列をそのまま書き出す。
+    """
+    from jsonl_io import iter_records as iter_any_records, RecordWriter
+
+    if is_arrow_file(input_file) and is_arrow_file(output_file):
+        pa = _import_pyarrow()
+        table = read_table(input_file)
+        if str(output_file).endswith(".parquet"):
+            pa.parquet.write_table(table, str(output_file))
+        else:
+            with pa.OSFile(str(output_file), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=BATCH_SIZE)
+        return table.num_rows
+
+    count = 0
+    if is_arrow_file(input_file):
+        # token_count 列を引き継ぐ
+        table = read_table(input_file)
+        counts = table.column("token_count").to_pylist()
+        with RecordWriter(output_file) as writer:
+            for entry, token_count in zip(iter_records(input_file), counts):
+                writer.write(entry, token_count)
+                count += 1
+    else:
+        with RecordWriter(output_file) as writer:
+            for entry in iter_any_records(input_file):
+                writer.write(entry)
+                count += 1
+    return count
+
+
+def main():
+    from config import CONVERT_FORMAT_CONFIG
+
+    input_file = CONVERT_FORMAT_CONFIG["input_file"]
+    output_file = CONVERT_FORMAT_CONFIG["output_file"]
+    print(f"入力ファイル: {input_file}")
+    print(f"出力ファイル: {output_file}")
+    count = convert(input_file, output_file)
+    print(f"変換完了: {count} エントリ")
+
+
+if __name__ == "__main__":
+    main()
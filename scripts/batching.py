@@ -0,0 +1,177 @@
+"""
+トークナイザーの呼び出しをバッチにまとめる共通モジュール
+
+テキストの長さは 50 文字のブロックから 2MB のプログラムまで大きく偏っているため、件数を固定したバッチでは
+バッチが小さすぎたり（スレッドが遊ぶ）、大きすぎたり（メモリを使い切る）します。このモジュールは
+
+    1. 入力を先頭から sort_window 件（かつ文字数の予算の window_budgets 倍）ずつのウィンドウに区切り、
+    2. ウィンドウ内を長さ順に並べ替えて、合計文字数が予算（char_budget）以下になるようにバッチにまとめ、
+    3. トークン化した結果を元の順序に戻して返します。
+
+長さの近いテキストが同じバッチに入るため、tokenizers のスレッドの負荷が均等になります。
+予算を超える1つのテキストは単独のバッチにします。予算は実際のスループット（文字/秒）を測定しながら
+自動で調整します（auto_tune。予算を増減して、スループットが下がった場合は逆方向に変える）。
+
+    from batching import tokenize_batched, iter_tokenized
+    tokenized = tokenize_batched(tokenizer, segments, add_special_tokens=False)  # tokenizer(segments, ...) と同じ形式
+    for ids in iter_tokenized(tokenizer, texts, add_special_tokens=False):        # イテレーターを順に処理する
+        ...
+
+config.py の BATCHING_CONFIG で、予算の初期値・範囲とウィンドウの大きさを設定します。
+"""
+
+import sys
+import time
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import BATCHING_CONFIG
+from metrics import timer, count
+
+
+def plan_batches(lengths, char_budget, max_batch_size=None):
+    """
+    テキストの長さのリストを、長さ順に並べて合計が char_budget 以下のバッチに分ける
+    戻り値: 各バッチの（lengths の）インデックスのリスト
+    """
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    batches = []
+    batch = []
+    batch_chars = 0
+    for i in order:
+        if batch and (batch_chars + lengths[i] > char_budget or (max_batch_size and len(batch) >= max_batch_size)):
+            batches.append(batch)
+            batch = []
+            batch_chars = 0
+        batch.append(i)
+        batch_chars += lengths[i]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class BudgetTuner:
+    """
+    バッチの文字数の予算をスループットから調整する（山登り法）
+
+    予算の半分以上を使ったバッチの文字数と時間を累積し、予算の sample_budgets 倍の文字数を処理するごとに
+    スループットを前回と比較する。下がった場合は調整の方向を逆にし、予算を step 倍（または 1/step 倍）にする。
+    """
+
+    def __init__(self, char_budget, min_budget, max_budget, auto_tune=True, step=1.5, sample_budgets=4):
+        self.budget = char_budget
+        self.min_budget = min_budget
+        self.max_budget = max_budget
+        self.auto_tune = auto_tune
+        self.factor = step
+        self.sample_budgets = sample_budgets
+        self.last_rate = None
+        self._chars = 0
+        self._seconds = 0.0
+
+    def observe(self, chars, seconds):
+        if not self.auto_tune or chars < self.budget // 2:
+            return
+        self._chars += chars
+        self._seconds += seconds
+        if self._chars < self.budget * self.sample_budgets or self._seconds <= 0:
+            return
+        rate = self._chars / self._seconds
+        if self.last_rate is not None and rate < self.last_rate:
+            self.factor = 1 / self.factor
+        self.last_rate = rate
+        self.budget = int(min(self.max_budget, max(self.min_budget, self.budget * self.factor)))
+        self._chars = 0
+        self._seconds = 0.0
+
+
+_tuner = None
+
+
+def get_tuner():
+    """プロセスごとの BudgetTuner（予算の調整結果は同じプロセスのすべての呼び出しで共有する）"""
+    global _tuner
+    if _tuner is None:
+        _tuner = BudgetTuner(
+            BATCHING_CONFIG["char_budget"], BATCHING_CONFIG["min_char_budget"], BATCHING_CONFIG["max_char_budget"],
+            BATCHING_CONFIG.get("auto_tune", True)
+        )
+    return _tuner
+
+
+def _tokenize_window(tokenizer, texts, kwargs, counts_only=False):
+    """
+    1つのウィンドウのテキストをバッチごとにトークン化し、元の順序の {キー: リスト} を返す
+    counts_only=True でトークナイザーが count() に対応している場合（tokenizer_service.py のクライアント）は
+    トークンIDの代わりにトークン数のみを受け取る（{"counts": [...]}）
+    """
+    tuner = get_tuner()
+    lengths = [len(text) for text in texts]
+    result = {}
+    for batch in plan_batches(lengths, tuner.budget, BATCHING_CONFIG.get("max_batch_size")):
+        batch_chars = sum(lengths[i] for i in batch)
+        start = time.perf_counter()
+        with timer("tokenize"):
+            if counts_only and hasattr(tokenizer, "count"):
+                encoded = {"counts": tokenizer.count([texts[i] for i in batch], **kwargs)}
+            else:
+                encoded = tokenizer([texts[i] for i in batch], **kwargs)
+        tuner.observe(batch_chars, time.perf_counter() - start)
+        count("tokenize_batches")
+        for key, values in encoded.items():
+            column = result.setdefault(key, [None] * len(texts))
+            for i, value in zip(batch, values):
+                column[i] = value
+    return result
+
+
+def _iter_windows(texts):
+    """テキストを sort_window 件・予算の window_budgets 倍の文字数までのウィンドウに区切る"""
+    window_size = BATCHING_CONFIG["sort_window"]
+    window = []
+    window_chars = 0
+    for text in texts:
+        window.append(text)
+        window_chars += len(text)
+        if len(window) >= window_size or window_chars >= get_tuner().budget * BATCHING_CONFIG["window_budgets"]:
+            yield window
+            window = []
+            window_chars = 0
+    if window:
+        yield window
+
+
+def tokenize_batched(tokenizer, texts, **kwargs):
+    """
+    tokenizer(texts, **kwargs) と同じ {"input_ids": [...], ...} を返す（各リストは texts の順）
+    長さ順・文字数の予算ごとのバッチに分けてトークン化する。
+    """
+    result = {}
+    for window in _iter_windows(texts):
+        for key, values in _tokenize_window(tokenizer, window, kwargs).items():
+            result.setdefault(key, []).extend(values)
+    result.setdefault("input_ids", [])
+    return result
+
+
+def iter_tokenized(tokenizer, texts, **kwargs):
+    """
+    texts（イテレーターでもよい）の各テキストのトークンIDを順に返す
+    ウィンドウ単位で読み込むため、ファイル全体のテキストをメモリに保持する必要はない。
+    """
+    for window in _iter_windows(texts):
+        yield from _tokenize_window(tokenizer, window, kwargs)["input_ids"]
+
+
+def iter_token_counts(tokenizer, texts, **kwargs):
+    """texts の各テキストのトークン数を順に返す"""
+    for window in _iter_windows(texts):
+        encoded = _tokenize_window(tokenizer, window, kwargs, counts_only=True)
+        if "counts" in encoded:
+            yield from encoded["counts"]
+        else:
+            yield from (len(ids) for ids in encoded["input_ids"])
+
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+前処理パイプライン全体のベンチマークスクリプト
+
+合成したPLCコーパス（Shift-JIS の .mnm ファイルのツリー）を生成し、各ステージを実行して
+処理時間・スループット（MB/s、エントリ/s、トークン/s）・ピークメモリ（RSS）を計測します。
+結果は results_dir に JSON で保存するため、変更前後の結果を --compare で比較できます。
+
+合成コーパスは実データと同様に ;<h1/> 見出しと \\n; コメント行で区切ったラダー命令
+（「LDB M2351                ; 6st_2D検査_1サイクル_手動」のような行）で、コメントには半角カナを含みます。
+トークナイザーは生成したコーパスから学習した小さなBPEトークナイザー（work_dir/tokenizer）を使うため、
+ネットワークに接続せずに実行できます（トークン数の絶対値は Qwen とは異なります）。
+
+各ステージは fork した子プロセスで実行し、子プロセスとそのワーカーのピークRSSを計測します（Linux / macOS 用）。
+
+使用方法:
+    python scripts/benchmark.py                          # BENCHMARK_CONFIG の設定で実行
+    python scripts/benchmark.py --size-mb 1000           # コーパスのサイズを指定
+    python scripts/benchmark.py --stages split_long_jsonl count_tokens
+    python scripts/benchmark.py --compare data/analysis/benchmark/benchmark_20250101-120000.json
+    python scripts/benchmark.py --generate-only          # コーパスの生成のみ
+
+設定:
+    config.pyのBENCHMARK_CONFIGで設定を変更可能
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+import config
+from config import BENCHMARK_CONFIG
+
+CORPUS_META_FILE = "corpus.json"
+
+# --- 合成コーパスの素材 ---
+INSTRUCTIONS = ["LD", "LDI", "LDB", "LDP", "AND", "ANI", "ANB", "OR", "ORI", "ORB",
+                "OUT", "SET", "RST", "PLS", "MOV", "MOVP", "BMOV", "CMP", "ADD", "SUB", "TMR", "CNT"]
+DEVICES = ["X", "Y", "M", "L", "B", "D", "W", "T", "C", "SM", "SD"]
+COMMENT_WORDS = ["ｻｰﾎﾞ", "ｼﾘﾝﾀﾞ", "ｺﾝﾍﾞｱ", "ﾁｬｯｸ", "ﾎﾟﾝﾌﾟ", "ﾓｰﾀ", "ﾘｾｯﾄ", "ｴﾗｰ", "ｽﾃｰｼﾞ",
+                 "原点復帰", "検査", "サイクル", "手動", "自動", "異常", "搬送", "前進", "後退",
+                 "上昇", "下降", "停止", "完了", "積層機", "2D", "3D", "ON", "OFF", "st"]
+MACHINE_NAMES = ["積層機", "搬送ﾛﾎﾞｯﾄ", "UT2_Hi_Chamber", "検査装置", "ﾌﾟﾚｽ機", "洗浄槽", "ｺｰﾀｰ"]
+UNIT_NAMES = ["ｻｰﾎﾞ", "ｼﾘﾝﾀﾞ", "Transport_RB", "ﾒｲﾝ", "原点復帰", "異常処理", "手動操作"]
+
+
+def _comment(rng):
+    words = rng.choices(COMMENT_WORDS, k=rng.randint(2, 5))
+    return f"{rng.randint(1, 12)}st_" + "_".join(words)
+
+
+def _rung_line(rng):
+    instruction = rng.choice(INSTRUCTIONS)
+    operand = f"{rng.choice(DEVICES)}{rng.randint(0, 9999)}"
+    if instruction in ("MOV", "MOVP", "CMP", "ADD", "SUB", "BMOV"):
+        operand += f" D{rng.randint(0, 9999)}"
+    line = f"{instruction:<4}{operand}"
+    if rng.random() < 0.6:
+        line = f"{line:<25}; {_comment(rng)}"
+    return line
+
+
+def generate_program(rng, line_pool, target_bytes):
+    """
+    1つのプログラム（.mnm の内容）を生成する
+    ;<h1/> で始まる見出しごとに、\\n; で始まるコメント行で区切ったラダー命令のブロックを並べる
+    """
+    parts = []
+    size = 0
+    while size < target_bytes:
+        section = [f";<h1/>{_comment(rng)}"]
+        for _ in range(rng.randint(1, 6)):
+            section.append(f";{_comment(rng)}")
+            section.extend(rng.choices(line_pool, k=rng.randint(3, 40)))
+        text = "\n".join(section)
+        parts.append(text)
+        size += len(text) * 2  # Shift-JIS でのおおよそのバイト数
+    return "\n".join(parts) + "\n"
+
+
+def generate_corpus(corpus_dir, size_mb, seed=0, max_file_kb=4096):
+    """
+    合成コーパスを corpus_dir/raw/<装置名>/<ユニット名>/NNNNN.mnm に Shift-JIS で生成する
+    ファイルサイズは対数正規分布（中央値 約16KB、最大 max_file_kb）で、合計が size_mb に達するまで生成する。
+    同じ設定のコーパスが既に存在する場合は再利用する。
+
+    Returns:
+        コーパスのメタデータ（ファイル数・バイト数）
+    """
+    params = {"size_mb": size_mb, "seed": seed, "max_file_kb": max_file_kb}
+    meta_path = os.path.join(corpus_dir, CORPUS_META_FILE)
+    raw_dir = os.path.join(corpus_dir, "raw")
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        num_files = sum(len(files) for _, _, files in os.walk(raw_dir))
+        if meta["params"] == params and meta["num_files"] == num_files:
+            return meta
+    shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    rng = random.Random(seed)
+    # 行を毎回生成すると遅いため、行のプールから選んで組み立てる
+    line_pool = [_rung_line(rng) for _ in range(20000)]
+    target = int(size_mb * (1 << 20))
+    total_bytes = 0
+    num_files = 0
+    while total_bytes < target:
+        file_bytes = min(int(rng.lognormvariate(9.7, 1.2)), max_file_kb << 10, target - total_bytes)
+        directory = os.path.join(raw_dir, rng.choice(MACHINE_NAMES), rng.choice(UNIT_NAMES))
+        os.makedirs(directory, exist_ok=True)
+        data = generate_program(rng, line_pool, max(file_bytes, 256)).encode('shift_jis')
+        with open(os.path.join(directory, f"{num_files:05d}.mnm"), 'wb') as f:
+            f.write(data)
+        total_bytes += len(data)
+        num_files += 1
+
+    meta = {"params": params, "num_files": num_files, "bytes": total_bytes}
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=4, ensure_ascii=False)
+    return meta
+
+
+def build_tokenizer(corpus_dir, output_dir, vocab_size=4000, sample_bytes=4 << 20):
+    """
+    コーパスの一部から小さなバイトレベルBPEトークナイザーを学習し、
+    AutoTokenizer.from_pretrained で読み込める形式で output_dir に保存する（既にあれば再利用する）
+    """
+    if os.path.exists(os.path.join(output_dir, "tokenizer.json")):
+        return output_dir
+
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    def sample_texts():
+        read = 0
+        for root, _, files in sorted(os.walk(os.path.join(corpus_dir, "raw"))):
+            for file_name in sorted(files):
+                with open(os.path.join(root, file_name), 'rb') as f:
+                    data = f.read()
+                yield data.decode('shift_jis')
+                read += len(data)
+                if read >= sample_bytes:
+                    return
+
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<unk>", "<|endoftext|>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(sample_texts(), trainer)
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>",
+                            eos_token="<|endoftext|>").save_pretrained(output_dir)
+    return output_dir
+
+
+def _dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def _count_lines(path):
+    from shards import count_lines
+    return count_lines(path)
+
+
+class Workspace:
+    """ベンチマークの作業ディレクトリ内の各ステージの入出力パス"""
+
+    def __init__(self, work_dir, token_limit, length_limit):
+        self.work_dir = work_dir
+        self.corpus_dir = os.path.join(work_dir, "corpus")
+        self.raw_dir = os.path.join(self.corpus_dir, "raw")
+        self.tokenizer_dir = os.path.join(work_dir, "tokenizer")
+        self.out_dir = os.path.join(work_dir, "output")
+        self.txt_dir = os.path.join(self.out_dir, "txt")
+        self.error_dir = os.path.join(self.out_dir, "encoding_error")
+        self.jsonl_dir = os.path.join(self.out_dir, "jsonl")
+        self.jsonl_file = os.path.join(self.jsonl_dir, "bench.jsonl")
+        self.split_file = os.path.join(self.out_dir, "split", "bench_h1.jsonl")
+        self.exceeding_file = os.path.join(self.out_dir, "exceeding", "bench_exceeding.jsonl")
+        self.summary_dir = os.path.join(self.out_dir, "split_summary")
+        self.filtered_dir = os.path.join(self.out_dir, "short_removed")
+        self.filtered_file = os.path.join(self.filtered_dir, "filtered_bench_h1.jsonl")
+        self.train_val_dir = os.path.join(self.out_dir, "train_val")
+        self.packed_file = os.path.join(self.out_dir, "packed", "bench_packed.jsonl")
+        self.log_file = os.path.join(work_dir, "benchmark.log")
+        self.token_limit = token_limit
+        self.length_limit = length_limit
+
+
+# --- 各ステージ（子プロセス内で実行し、計測用の値を返す） ---
+
+def stage_mnm_to_txt(ws):
+    from mnm_to_txt import process_files
+    shutil.rmtree(ws.txt_dir, ignore_errors=True)
+    process_files(ws.raw_dir, ws.txt_dir, ws.error_dir)
+    return {"input_bytes": _dir_size(ws.raw_dir), "entries": len(os.listdir(ws.txt_dir))}
+
+
+def stage_txt_to_jsonl(ws):
+    from txt_to_jsonl import txt_files_to_jsonl
+    txt_files_to_jsonl(ws.txt_dir, ws.jsonl_dir, os.path.basename(ws.jsonl_file), "bench", "00",
+                       use_delimiter=True, delimiter=";<h1/>")
+    return {"input_bytes": _dir_size(ws.txt_dir), "entries": _count_lines(ws.jsonl_file)}
+
+
+def stage_split_long_jsonl(ws):
+    from split_long_jsonl import process_jsonl_file
+    summary = process_jsonl_file(ws.jsonl_file, ws.split_file, ws.summary_dir, ws.token_limit,
+                                 ws.exceeding_file, ";<h1/>")
+    return {"input_bytes": _dir_size(ws.jsonl_file), "entries": summary["num_original_entries"],
+            "tokens": summary["num_split_tokens"]}
+
+
+def stage_split_segments(ws):
+    """split_segments_by_max_sum のみを計測する（合成したセグメント長のリストを分割）"""
+    from split_long_jsonl import split_segments_by_max_sum
+    rng = random.Random(0)
+    cases = [[rng.randint(1, ws.token_limit // 4) for _ in range(rng.randint(2, 400))] for _ in range(2000)]
+    for segment_token_counts in cases:
+        split_segments_by_max_sum(segment_token_counts, 3, ws.token_limit)
+    return {"entries": len(cases), "tokens": sum(sum(case) for case in cases)}
+
+
+def stage_count_tokens(ws):
+    from tokenizer_backend import get_tokenizer
+    from count_tokens import load_texts_and_titles, tokenize_and_count
+    total_lines, texts, titles = load_texts_and_titles(ws.split_file)
+    token_counts, _ = tokenize_and_count(texts, titles, get_tokenizer(ws.tokenizer_dir))
+    return {"input_bytes": _dir_size(ws.split_file), "entries": total_lines, "tokens": sum(token_counts)}
+
+
+def stage_remove_short_jsonl(ws):
+    from remove_short_jsonl import filter_jsonl_file_to
+    os.makedirs(ws.filtered_dir, exist_ok=True)
+    num_kept, removed_texts = filter_jsonl_file_to(ws.split_file, ws.filtered_file, ws.length_limit)
+    return {"input_bytes": _dir_size(ws.split_file), "entries": num_kept + len(removed_texts)}
+
+
+def stage_split_train_val_jsonl(ws):
+    from split_train_val_jsonl import split_jsonl
+    split_jsonl(ws.filtered_file, 0.95, ws.train_val_dir)
+    return {"input_bytes": _dir_size(ws.filtered_file), "entries": _count_lines(ws.filtered_file)}
+
+
+def stage_pack_sequences(ws):
+    from pack_sequences import pack_sequences
+    report = pack_sequences(ws.filtered_file, ws.packed_file, ws.packed_file + ".report.json",
+                            seq_length=ws.token_limit + 512, model_name=ws.tokenizer_dir)
+    return {"input_bytes": _dir_size(ws.filtered_file), "entries": report["num_entries"],
+            "tokens": report["packed_tokens"], "packing_efficiency": report["packing_efficiency"]}
+
+
+# 実行順に並べたステージ（後のステージは前のステージの出力を入力とする）
+STAGES = {
+    "mnm_to_txt": stage_mnm_to_txt,
+    "txt_to_jsonl": stage_txt_to_jsonl,
+    "split_long_jsonl": stage_split_long_jsonl,
+    "split_segments_by_max_sum": stage_split_segments,
+    "count_tokens": stage_count_tokens,
+    "remove_short_jsonl": stage_remove_short_jsonl,
+    "split_train_val_jsonl": stage_split_train_val_jsonl,
+    "pack_sequences": stage_pack_sequences,
+}
+
+
+def _stage_child(stage, ws, result_queue):
+    """子プロセスでステージを実行する（出力はログファイルに書き込む）"""
+    with open(ws.log_file, 'a', encoding='utf-8') as log:
+        log.write(f"\n===== {stage} =====\n")
+        log.flush()
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    # トークナイザーをローカルのものに差し替える（各スクリプトの import 前に設定する）
+    config.MODEL_NAME = ws.tokenizer_dir
+    for name in dir(config):
+        value = getattr(config, name)
+        if name.endswith("_CONFIG") and isinstance(value, dict) and "model_name" in value:
+            value["model_name"] = ws.tokenizer_dir
+    try:
+        start = time.perf_counter()
+        stats = STAGES[stage](ws)
+        stats["seconds"] = time.perf_counter() - start
+    except Exception as e:
+        stats = {"error": f"{type(e).__name__}: {e}"}
+    # ru_maxrss は Linux では KB、macOS ではバイト単位
+    unit = 1 if sys.platform == "darwin" else 1024
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit
+    stats["peak_rss_mb"] = self_rss / (1 << 20)
+    stats["peak_worker_rss_mb"] = children_rss / (1 << 20)
+    result_queue.put(stats)
+
+
+def run_stage(stage, ws):
+    """ステージを fork した子プロセスで実行し、計測結果を返す"""
+    context = multiprocessing.get_context("fork")
+    result_queue = context.Queue()
+    process = context.Process(target=_stage_child, args=(stage, ws, result_queue))
+    process.start()
+    stats = result_queue.get()
+    process.join()
+
+    seconds = stats.get("seconds")
+    if seconds:
+        if stats.get("input_bytes"):
+            stats["mb_per_s"] = stats["input_bytes"] / (1 << 20) / seconds
+        if stats.get("entries"):
+            stats["entries_per_s"] = stats["entries"] / seconds
+        if stats.get("tokens"):
+            stats["tokens_per_s"] = stats["tokens"] / seconds
+    return stats
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=script_dir, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous_file, results):
+    """前回の結果と比較して、ステージごとの処理時間の変化を表示する"""
+    with open(previous_file, 'r', encoding='utf-8') as f:
+        previous = json.load(f)
+    print(f"\n前回の結果との比較: {previous_file}")
+    print(f"{'ステージ':<28}{'前回(秒)':>12}{'今回(秒)':>12}{'比率':>10}")
+    for stage, stats in results["stages"].items():
+        old = previous.get("stages", {}).get(stage, {}).get("seconds")
+        new = stats.get("seconds")
+        if old and new:
+            print(f"{stage:<28}{old:>12.2f}{new:>12.2f}{new / old:>9.2f}x")
+        else:
+            print(f"{stage:<28}{'-':>12}{(f'{new:.2f}' if new else '-'):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前処理パイプラインのベンチマーク")
+    parser.add_argument("--size-mb", type=float, default=BENCHMARK_CONFIG["corpus_size_mb"],
+                        help="合成コーパスのサイズ（MB）")
+    parser.add_argument("--stages", nargs="*", choices=list(STAGES), help="実行するステージ（省略時はすべて）")
+    parser.add_argument("--compare", help="比較する前回の結果ファイル")
+    parser.add_argument("--generate-only", action="store_true", help="コーパスとトークナイザーの生成のみ行う")
+    args = parser.parse_args()
+
+    ws = Workspace(BENCHMARK_CONFIG["work_dir"], BENCHMARK_CONFIG["token_limit"], BENCHMARK_CONFIG["length_limit"])
+    print(f"合成コーパスを準備中: {ws.corpus_dir} ({args.size_mb} MB)")
+    start = time.perf_counter()
+    corpus = generate_corpus(ws.corpus_dir, args.size_mb, BENCHMARK_CONFIG["seed"], BENCHMARK_CONFIG["max_file_kb"])
+    print(f"  ファイル数: {corpus['num_files']} / {corpus['bytes'] / (1 << 20):.1f} MB ({time.perf_counter() - start:.1f} 秒)")
+    build_tokenizer(ws.corpus_dir, ws.tokenizer_dir, BENCHMARK_CONFIG["tokenizer_vocab_size"])
+    if args.generate_only:
+        return
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "corpus": corpus,
+        "token_limit": ws.token_limit,
+        "stages": {}
+    }
+    for stage in args.stages or list(STAGES):
+        print(f"実行中: {stage}")
+        stats = run_stage(stage, ws)
+        results["stages"][stage] = stats
+        if "error" in stats:
+            print(f"  エラー: {stats['error']}（詳細は {ws.log_file}）")
+            continue
+        throughput = [f"{stats['seconds']:.2f} 秒"]
+        for key, unit in (("mb_per_s", "MB/s"), ("entries_per_s", "エントリ/s"), ("tokens_per_s", "トークン/s")):
+            if key in stats:
+                throughput.append(f"{stats[key]:,.1f} {unit}")
+        throughput.append(f"ピークRSS {max(stats['peak_rss_mb'], stats['peak_worker_rss_mb']):.0f} MB")
+        print("  " + " / ".join(throughput))
+
+    os.makedirs(BENCHMARK_CONFIG["results_dir"], exist_ok=True)
+    result_file = os.path.join(BENCHMARK_CONFIG["results_dir"], f"benchmark_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(result_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4, ensure_ascii=False)
+    print(f"結果を保存しました: {result_file}")
+
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+処理済みのJSONLの各エントリのメタデータを SQLite のカタログに記録する
+
+「STG のプログラムで 8k トークンを超えるものは何トークンあるか」のような集計は、これまで count_tokens.py で
+JSONL 全体をトークン化し直す必要がありました。カタログは各エントリの
+
+    id, title, base_name, block_num, category, ファイル, 行番号, バイトオフセット・長さ, 文字数, トークン数, 内容のハッシュ
+
+をインデックス付きのテーブルに記録するため、統計・サンプリング・絞り込みを SQL のクエリで求められます。
+ファイルごとにフィンガープリント（パス・サイズ・更新時刻・モデル名）を記録し、変更されていないファイルは登録し直しません。
+
+    with Catalog(CATALOG_CONFIG["path"]) as catalog:
+        catalog.index_file("./data/processed/jsonl/long_text_splitted/plc_normal_h1.jsonl")
+        catalog.query("category = ? AND token_count > ?", ("STG", 8192))  # {"entries": ..., "tokens": ..., "files": ...}
+
+count_tokens.py と generate_sample_jsonl.py は CATALOG_CONFIG の enabled が True の場合、
+入力ファイルがカタログに登録済み（変更なし）であれば、ファイルを読み直さずにカタログのトークン数を使用します。
+
+使用方法:
+    python scripts/catalog.py                    # CATALOG_CONFIG の input_files を登録する
+    python scripts/catalog.py "<WHERE 句>"       # 条件に一致するエントリ数・トークン数を表示する
+    例: python scripts/catalog.py "category = 'STG' AND token_count > 8192"
+
+設定:
+    config.pyのCATALOG_CONFIGで設定を変更可能
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import CATALOG_CONFIG, MODEL_NAME
+from jsonl_io import iter_records, is_jsonl_file, compression_of
+from metrics import measure_stage, timer, count
+from checkpoint import input_fingerprint, iter_chunks
+from merge_jsonl_by_title import extract_base_name_and_block_num
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    fingerprint TEXT NOT NULL,
+    model_name TEXT,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    file_id INTEGER NOT NULL,
+    row INTEGER NOT NULL,
+    id TEXT,
+    title TEXT,
+    base_name TEXT,
+    block_num INTEGER,
+    category TEXT,
+    byte_offset INTEGER,
+    byte_length INTEGER,
+    char_length INTEGER NOT NULL,
+    token_count INTEGER,
+    content_hash TEXT NOT NULL,
+    PRIMARY KEY (file_id, row)
+);
+CREATE INDEX IF NOT EXISTS entries_title ON entries (title);
+CREATE INDEX IF NOT EXISTS entries_base_name ON entries (base_name, block_num);
+CREATE INDEX IF NOT EXISTS entries_category_tokens ON entries (category, token_count);
+CREATE INDEX IF NOT EXISTS entries_tokens ON entries (token_count);
+CREATE INDEX IF NOT EXISTS entries_content_hash ON entries (content_hash);
+"""
+
+# query() で指定できる列（files の path と entries の列）
+_QUERY_FROM = "entries JOIN files USING (file_id)"
+
+
+def entry_category(entry):
+    """エントリのカテゴリ（"category" がなければ txt_to_jsonl.py の id の先頭 "<category>-<id_prefix>-..."）"""
+    if entry.get("category"):
+        return entry["category"]
+    entry_id = entry.get("id")
+    if isinstance(entry_id, str) and "-" in entry_id:
+        return entry_id.split("-", 1)[0]
+    return None
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def iter_located_records(path):
+    """
+    path の各エントリを (エントリ, バイトオフセット, バイト長) として返す
+    非圧縮のJSONL以外はオフセットを記録できないため (エントリ, None, None) を返す（行番号で参照する）。
+    """
+    if is_jsonl_file(path) and compression_of(path) is None:
+        from mmap_jsonl import MappedJsonl
+        with MappedJsonl(path) as reader:
+            starts, ends = reader.offsets
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                yield json.loads(reader.span(start, end).tobytes()), start, end - start
+        return
+    for entry in iter_records(path):
+        yield entry, None, None
+
+
+def read_entries(path, rows):
+    """
+    カタログの行（row, byte_offset, byte_length を含む辞書）のエントリを path から読み込む（rows の順）
+    オフセットが記録されている場合は該当するバイト範囲のみを読む。
+    """
+    if rows and all(row["byte_offset"] is not None for row in rows):
+        entries = []
+        with open(path, 'rb') as f:
+            for row in rows:
+                f.seek(row["byte_offset"])
+                entries.append(json.loads(f.read(row["byte_length"])))
+        return entries
+    wanted = {row["row"] for row in rows}
+    found = {i: entry for i, entry in enumerate(iter_records(path)) if i in wanted}
+    return [found[row["row"]] for row in rows]
+
+
+class Catalog:
+    """エントリのメタデータを記録する SQLite のカタログ"""
+
+    def __init__(self, path=None):
+        self.path = str(path or CATALOG_CONFIG["path"])
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(self.path, timeout=CATALOG_CONFIG.get("busy_timeout", 60))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def lookup(self, path, model_name=None):
+        """path が変更されずに登録済みであれば file_id を返す（model_name を指定した場合はトークン数のモデルも確認する）"""
+        if not os.path.exists(path):
+            return None
+        row = self.conn.execute("SELECT file_id, fingerprint, model_name FROM files WHERE path = ?",
+                                (os.path.abspath(path),)).fetchone()
+        if row is None or row["fingerprint"] != input_fingerprint(path, model_name=row["model_name"]):
+            return None
+        if model_name is not None and row["model_name"] != model_name:
+            return None
+        return row["file_id"]
+
+    def index_file(self, path, model_name=MODEL_NAME, batch_size=None, force=False):
+        """
+        path の各エントリを登録する（変更されていなければスキップする）。戻り値: 登録したエントリ数（スキップした場合は None）
+        model_name が None の場合はトークン数を記録しない。
+        トークン数は Arrow / Parquet の token_count 列 → count_tokens.py のキャッシュ → トークン化 の順に使用する。
+        """
+        if not force and self.lookup(path, model_name) is not None:
+            count("catalog_files_skipped")
+            return None
+        batch_size = batch_size or CATALOG_CONFIG.get("batch_size", 10000)
+        token_counts = iter(_known_token_counts(path, model_name) or ()) if model_name else None
+        tokenizer = None
+        abs_path = os.path.abspath(path)
+        # 読み込み中にファイルが変更された場合に登録し直されるよう、フィンガープリントは読み込む前に計算する
+        fingerprint = input_fingerprint(path, model_name=model_name)
+
+        # トークン化の間はカタログをロックしないよう、メタデータを集めてから1つのトランザクションで書き込む
+        rows = []
+        for batch in iter_chunks(iter_located_records(path), batch_size):
+            texts = [entry.get("text", "") for entry, _, _ in batch]
+            counts = [None] * len(batch)
+            if model_name:
+                counts = list(itertools.islice(token_counts, len(batch)))
+                if len(counts) < len(batch):
+                    # 計算済みのトークン数がない場合はトークン化する
+                    if tokenizer is None:
+                        from tokenizer_backend import get_tokenizer
+                        tokenizer = get_tokenizer(model_name)
+                    from batching import iter_token_counts
+                    counts = list(iter_token_counts(tokenizer, texts, add_special_tokens=False))
+            for (entry, offset, length), text, tokens in zip(batch, texts, counts):
+                title = entry.get("title")
+                base_name, block_num = extract_base_name_and_block_num(title) if isinstance(title, str) else (None, None)
+                rows.append((len(rows), entry.get("id"), title, base_name, block_num, entry_category(entry),
+                             offset, length, len(text), int(tokens) if tokens is not None else None, content_hash(text)))
+
+        with timer("catalog_write"), self.conn:
+            old = self.conn.execute("SELECT file_id FROM files WHERE path = ?", (abs_path,)).fetchone()
+            if old is not None:
+                self.conn.execute("DELETE FROM entries WHERE file_id = ?", (old["file_id"],))
+                self.conn.execute("DELETE FROM files WHERE file_id = ?", (old["file_id"],))
+            file_id = self.conn.execute("INSERT INTO files (path, fingerprint, model_name, rows) VALUES (?, ?, ?, ?)",
+                                        (abs_path, fingerprint, model_name, len(rows))).lastrowid
+            self.conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  ((file_id, *row) for row in rows))
+        num_rows = len(rows)
+        count("catalog_entries", num_rows)
+        return num_rows
+
+    def token_counts(self, path, model_name=MODEL_NAME):
+        """登録済みのファイルの (トークン数のリスト, タイトルのリスト)（行の順。登録されていなければ None）"""
+        file_id = self.lookup(path, model_name)
+        if file_id is None:
+            return None
+        rows = self.conn.execute("SELECT token_count, title FROM entries WHERE file_id = ? ORDER BY row",
+                                 (file_id,)).fetchall()
+        return [row[0] for row in rows], [row[1] if row[1] is not None else "不明" for row in rows]
+
+    def sample(self, path, num_samples, model_name=MODEL_NAME, where=None, params=()):
+        """
+        登録済みのファイルから無作為に num_samples 件の行（row, byte_offset, byte_length, token_count など）を選ぶ
+        where を指定した場合は条件に一致するエントリから選ぶ。登録されていなければ None。
+        """
+        file_id = self.lookup(path, model_name)
+        if file_id is None:
+            return None
+        condition = f" AND ({where})" if where else ""
+        rows = self.conn.execute(f"SELECT * FROM entries WHERE file_id = ?{condition} ORDER BY random() LIMIT ?",
+                                 (file_id, *params, num_samples)).fetchall()
+        return [dict(row) for row in rows]
+
+    def query(self, where="1", params=()):
+        """条件に一致するエントリ数・トークン数の合計・ファイル数"""
+        row = self.conn.execute(f"SELECT COUNT(*), SUM(token_count), COUNT(DISTINCT file_id) FROM {_QUERY_FROM} "
+                                f"WHERE {where}", params).fetchone()
+        return {"entries": row[0], "tokens": row[1] or 0, "files": row[2]}
+
+
+def _known_token_counts(path, model_name):
+    """計算済みのトークン数（Arrow / Parquet の token_count 列または count_tokens.py のキャッシュ）"""
+    from count_tokens import load_cached_token_counts, token_count_cache_path
+    from config import COUNT_TOKENS_CONFIG
+    cached = load_cached_token_counts(path)
+    if cached is not None:
+        return cached[0]
+    cache_dir = COUNT_TOKENS_CONFIG.get("cache_dir")
+    # count_tokens.py のキャッシュは MODEL_NAME のトークン数
+    if cache_dir and model_name == MODEL_NAME:
+        cache_path = token_count_cache_path(path, cache_dir)
+        if os.path.exists(cache_path):
+            import numpy as np
+            with np.load(cache_path) as data:
+                return data["token_counts"].tolist()
+    return None
+
+
+def open_catalog():
+    """CATALOG_CONFIG の enabled が True の場合はカタログを開く（無効または存在しない場合は None）"""
+    if not CATALOG_CONFIG.get("enabled", False) or not os.path.exists(CATALOG_CONFIG["path"]):
+        return None
+    return Catalog(CATALOG_CONFIG["path"])
+
+
+@measure_stage("catalog")
+def catalog_files(input_files, path, model_name=MODEL_NAME, batch_size=10000):
+    """input_files（パスまたはパスのリスト）をカタログに登録する"""
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    with Catalog(path) as catalog:
+        for input_file in input_files:
+            num_rows = catalog.index_file(input_file, model_name, batch_size)
+            if num_rows is None:
+                print(f"変更なし: {input_file}")
+            else:
+                print(f"登録: {input_file}（{num_rows} 件）")
+
+
+def main():
+    path = CATALOG_CONFIG["path"]
+    if len(sys.argv) > 1:
+        with Catalog(path) as catalog:
+            result = catalog.query(sys.argv[1])
+        print(f"エントリ数: {result['entries']}")
+        print(f"トークン数: {result['tokens']}")
+        print(f"ファイル数: {result['files']}")
+        return
+    catalog_files(CATALOG_CONFIG["input_files"], path, CATALOG_CONFIG.get("model_name", MODEL_NAME),
+                  CATALOG_CONFIG.get("batch_size", 10000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""
+長時間かかるステージの途中経過を保存し、中断した位置から再開するための共通モジュール
+
+入力を先頭から順にチャンク単位で処理するステージ（split_long_jsonl.py）は ChunkCheckpoint を使用します。
+
+    <出力ファイル>.checkpoint/
+        state.json      処理済みのエントリ数・入力のバイトオフセット・コミット済みのチャンクのリスト
+        part_00000/     チャンク1つ分の出力（一時ディレクトリに書き込んでからリネームする）
+        part_00001/
+        ...
+
+チャンクの出力をリネームしてから state.json を更新（一時ファイルに書き込んでからリネーム）するため、
+途中で中断しても state.json に記録されたチャンクは完全な状態で残ります。再実行時は最後にコミットした
+チャンクの次から処理し、すべてのチャンクを順に結合して最終的な出力を作成するため、中断しなかった場合と
+同じ出力になります。入力ファイル（サイズ・更新時刻）や設定が変わった場合は、チェックポイントを破棄して最初から処理します。
+
+ファイル単位で処理するステージ（mnm_to_txt.py）は Journal に処理済みのファイルを1行ずつ追記します。
+
+ファイル単位で出力するステージ（mnm_to_txt.py / split_long_txt.py）は、実行が完了した時点で入力ごとの
+サイズ・更新時刻・出力ファイルを FileState に保存します。次回の実行では変更のない入力をスキップし、
+変更・削除された入力の以前の出力のみを削除します（出力ディレクトリ全体を削除し直す必要はありません）。
+
+config.py の CHECKPOINT_CONFIG で、再開の有効・無効とチャンクあたりのエントリ数を設定します。
+"""
+
+import ast
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import CHECKPOINT_CONFIG
+from jsonl_io import iter_records, RecordWriter, is_jsonl_file, compression_of, frame_index_path
+
+STATE_FILE = "state.json"
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+def checkpoint_dir(output_path):
+    """出力ファイルに対応するチェックポイントのディレクトリ"""
+    return str(output_path) + CHECKPOINT_SUFFIX
+
+
+def temp_path(path):
+    """path と同じディレクトリ・同じ拡張子の一時ファイルのパス（書き込み後に replace_file でリネームする）"""
+    directory, name = os.path.split(str(path))
+    return os.path.join(directory, ".tmp-" + name)
+
+
+def replace_file(tmp_path, path):
+    """一時ファイルを path にリネームする（seekable で書き込んだ圧縮ファイルのフレームインデックスも含む）"""
+    if os.path.exists(frame_index_path(tmp_path)):
+        os.replace(frame_index_path(tmp_path), frame_index_path(path))
+    os.replace(tmp_path, path)
+
+
+def write_json_atomic(path, data):
+    """JSON を一時ファイルに書き込んでから path にリネームする（書き込み途中の状態が残らない）"""
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def input_fingerprint(path, **params):
+    """入力ファイル（パス・サイズ・更新時刻）と設定値から計算したフィンガープリント"""
+    stat = os.stat(path)
+    payload = {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "params": params
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def local_imports(module_name):
+    """
+    スクリプトが import している scripts/ 内のモジュールを、依存先をたどってすべて返す（自身を含む）
+    関数内の import も対象とする。config.py はステージの設定値として別にハッシュするため除く。
+    """
+    found = set()
+    pending = [module_name]
+    while pending:
+        name = pending.pop()
+        if name in found:
+            continue
+        found.add(name)
+        with open(script_dir / f"{name}.py", 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for imported in names:
+                imported = imported.split(".")[0]
+                if imported != "config" and (script_dir / f"{imported}.py").exists():
+                    pending.append(imported)
+    return sorted(found)
+
+
+def code_version(module_name):
+    """スクリプトと、そこから import している scripts/ 内のモジュールのハッシュ（コードのバージョンとして使用）"""
+    digest = hashlib.sha256()
+    for name in local_imports(module_name):
+        with open(script_dir / f"{name}.py", 'rb') as f:
+            digest.update(f"{name}\0".encode('utf-8'))
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def iter_records_from(path, position=0, offset=None):
+    """
+    path の position 件目以降のエントリを (エントリ, 入力のバイトオフセット) として返す
+    非圧縮のJSONLは offset（前回コミットした位置）から読み、各エントリの行末のオフセットを返す。
+    それ以外の形式は先頭から position 件を読み飛ばす（オフセットは None）。
+    """
+    if is_jsonl_file(path) and compression_of(path) is None:
+        from mmap_jsonl import MappedJsonl
+        with MappedJsonl(path) as reader:
+            for start, end in reader.iter_spans(offset or 0):
+                yield json.loads(reader.span(start, end).tobytes()), end
+        return
+    for entry in itertools.islice(iter_records(path), position, None):
+        yield entry, None
+
+
+def concat_records(part_paths, output_path, token_counts=None):
+    """
+    チャンクごとの非圧縮のJSONLファイルを順に結合して output_path に書き込み、書き込んだ件数を返す
+    出力が非圧縮のJSONLの場合は解析せずにバイト列をそのまま結合し、それ以外は拡張子の形式で書き込む。
+    一時ファイルに書き込んでからリネームするため、書き込み途中の出力は残らない。
+    """
+    tmp_path = temp_path(output_path)
+    num_records = 0
+    if is_jsonl_file(output_path) and compression_of(output_path) is None:
+        with open(tmp_path, 'wb') as out_f:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as in_f:
+                    shutil.copyfileobj(in_f, out_f, 1 << 20)
+        for part_path in part_paths:
+            with open(part_path, 'rb') as f:
+                num_records += sum(1 for line in f if line.strip())
+    else:
+        token_counts = iter(token_counts) if token_counts is not None else None
+        with RecordWriter(tmp_path) as writer:
+            for part_path in part_paths:
+                for entry in iter_records(part_path):
+                    writer.write(entry, next(token_counts) if token_counts is not None else None)
+        num_records = writer.count
+    replace_file(tmp_path, output_path)
+    return num_records
+
+
+def iter_chunks(iterable, size):
+    """iterable を size 件ずつのリストに分ける"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ChunkCheckpoint:
+    """入力を先頭から順にチャンク単位で処理するステージのチェックポイント"""
+
+    def __init__(self, directory, fingerprint, resume=None):
+        """
+        Args:
+            directory: チェックポイントのディレクトリ（checkpoint_dir(出力ファイル)）
+            fingerprint: 入力と設定のフィンガープリント（一致しない場合はチェックポイントを破棄する）
+            resume: False の場合は既存のチェックポイントを破棄する（省略時は CHECKPOINT_CONFIG["enabled"]）
+        """
+        self.directory = directory
+        self.state_path = os.path.join(directory, STATE_FILE)
+        if resume is None:
+            resume = CHECKPOINT_CONFIG.get("enabled", True)
+
+        state = None
+        if resume and os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get("fingerprint") != fingerprint:
+                print(f"警告: 入力または設定が変わったため、チェックポイントを破棄して最初から処理します: {directory}")
+                state = None
+        if state is None:
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+            state = {"fingerprint": fingerprint, "position": 0, "offset": 0, "parts": []}
+        self.state = state
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def position(self):
+        """コミット済みの入力のエントリ数"""
+        return self.state["position"]
+
+    @property
+    def offset(self):
+        """コミット済みの入力のバイトオフセット（非圧縮のJSONL以外は None）"""
+        return self.state["offset"]
+
+    def begin_part(self):
+        """次のチャンクの出力を書き込む一時ディレクトリを作成して返す"""
+        tmp_dir = os.path.join(self.directory, f"part_{len(self.state['parts']):05d}.tmp")
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        return tmp_dir
+
+    def commit_part(self, tmp_dir, position, offset=None):
+        """一時ディレクトリをチャンクとしてリネームし、処理済みの位置を記録する"""
+        part_dir = tmp_dir[:-len(".tmp")]
+        # 前回、リネーム後・記録前に中断した場合のディレクトリは上書きする
+        if os.path.isdir(part_dir):
+            shutil.rmtree(part_dir)
+        os.replace(tmp_dir, part_dir)
+        self.state["parts"].append(os.path.basename(part_dir))
+        self.state["position"] = position
+        self.state["offset"] = offset
+        write_json_atomic(self.state_path, self.state)
+
+    def part_dirs(self):
+        """コミット済みのチャンクのディレクトリ（入力の順）"""
+        return [os.path.join(self.directory, name) for name in self.state["parts"]]
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Journal:
+    """
+    ファイル単位で処理するステージの処理済みのファイルを記録するジャーナル
+    1ファイルの処理ごとに {"key": ..., <値>} を1行追記して fsync する（同じキーは後の行が優先）。
+    """
+
+    def __init__(self, path, resume=None):
+        self.path = path
+        self.entries = {}
+        if resume is None:
+            resume = CHECKPOINT_CONFIG.get("enabled", True)
+        if not resume and os.path.exists(path):
+            os.remove(path)
+
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 書き込み途中で中断した最後の行は破棄する
+            complete = data[:data.rfind(b'\n') + 1]
+            if len(complete) != len(data):
+                with open(path, 'r+b') as f:
+                    f.truncate(len(complete))
+            for line in complete.splitlines():
+                record = json.loads(line)
+                self.entries[record["key"]] = record
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def record(self, key, **values):
+        record = {"key": key, **values}
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.entries[key] = record
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def remove(self):
+        """すべての処理が完了した場合にジャーナルを削除する"""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class FileState:
+    """
+    ファイル単位で出力するステージの、入力ごとのサイズ・更新時刻・出力ファイルの記録
+    path: 状態ファイルのパス
+    version: コードと設定から決まる値（JSON に変換できる値）。前回の実行と異なる場合は、
+        すべての入力を変更ありとして扱う（以前の出力の削除には前回の記録を使用する）
+    出力ファイルは base_dir（出力ディレクトリ）からの相対パスで記録する。
+    """
+
+    def __init__(self, path, version, base_dir):
+        self.path = path
+        self.version = version
+        self.base_dir = base_dir
+        self.previous = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.previous = json.load(f)
+        self.files = {}
+
+    def _output_path(self, output):
+        return os.path.join(self.base_dir, output)
+
+    def get(self, key):
+        """前回の実行の記録（version が異なる場合は None）"""
+        if self.previous.get("version") != self.version:
+            return None
+        return self.previous.get("files", {}).get(key)
+
+    def is_current(self, key, stat, outputs=None):
+        """前回の実行から入力（os.stat の結果）が変わっておらず、出力がすべて残っているか"""
+        entry = self.get(key)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+            return False
+        if outputs is not None and entry["outputs"] != list(outputs):
+            return False
+        return all(os.path.exists(self._output_path(output)) for output in entry["outputs"])
+
+    def record(self, key, stat, outputs, **values):
+        """
+        今回の実行で処理した（またはスキップした）入力を記録する
+        stat: 処理する前に取得した入力の os.stat の結果
+        outputs: 出力ファイルのパス（base_dir からの相対パス）
+        """
+        self.files[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "outputs": list(outputs), **values}
+
+    def keep(self, key):
+        """今回の実行で処理できなかった入力の前回の記録（と出力）をそのまま残す"""
+        entry = self.previous.get("files", {}).get(key)
+        if entry is not None:
+            self.files[key] = entry
+
+    def save(self):
+        """
+        記録を保存し、前回の実行の出力のうち今回の出力に含まれないもの（変更・削除された入力の以前の出力）を削除する
+        """
+        current = {output for entry in self.files.values() for output in entry["outputs"]}
+        for entry in self.previous.get("files", {}).values():
+            for output in entry["outputs"]:
+                if output not in current and os.path.exists(self._output_path(output)):
+                    os.remove(self._output_path(output))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        write_json_atomic(self.path, {"version": self.version, "files": self.files})
+        self.previous = {"version": self.version, "files": self.files}
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+各スクリプトをサブコマンドとして実行する共通のコマンドラインツール
+
+config.py を編集せずに、実行ごとに設定値を上書きして各ステージを実行できます。
+引数に入力ファイル（ディレクトリ）のパスまたは glob パターンを指定すると、一致したすべての入力に
+同じステージを実行します（バッチ実行）。バッチ実行ではプロセスプールを1つだけ起動し、
+各ワーカーはトークナイザーを1度だけ読み込んで、すべての入力の処理に使い回します。
+
+使用方法:
+    python scripts/cli.py --help                      # サブコマンドの一覧
+    python scripts/cli.py split_long_jsonl --help     # サブコマンドの設定項目と現在の値
+    python scripts/cli.py split_long_jsonl            # config.py の設定で実行（各スクリプトの直接実行と同じ）
+
+    # 設定値の上書き（値は JSON として解釈し、解釈できない場合は文字列として扱う）
+    python scripts/cli.py split_long_jsonl --set token_limit=8192 --set 'delimiter="\\n;"'
+
+    # 40 個のシャードを1つのプロセスプールで処理する
+    # （出力先などの文字列の設定値には {stem} / {name} / {parent} / {index} を使用できる）
+    python scripts/cli.py split_long_jsonl 'data/shards/*.jsonl' \\
+        --set 'output_file=data/split/{stem}.jsonl' \\
+        --set 'exceeding_file=data/exceeding/{stem}.jsonl' --jobs 32
+
+    # 他の設定（METRICS_CONFIG など）の値は <設定名>.<キー>=<値> で上書きする
+    python scripts/cli.py count_tokens data/split/a.jsonl --set METRICS_CONFIG.enabled=false
+
+入力がシャード形式のデータセットの場合は、各スクリプトと同様にシャードごとに処理します（shards.py を参照）。
+"""
+
+import argparse
+import glob
+import importlib
+import inspect
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+import config
+from pipeline import STAGE_TYPES
+
+
+# サブコマンドの定義
+#   config: 設定値の既定値として使用する config.py の設定名
+#   input: 位置引数で指定した入力のパスを設定するキー
+#   module / func: 実行する関数（省略時は pipeline.py の STAGE_TYPES と同じ）
+#   params: 設定のキーと関数の引数名が異なる場合の対応（設定のキー -> 引数名）
+#   shards: 入力がシャード形式の場合に実行する関数と、設定のキー -> 引数名の対応
+#   tokenizer: バッチ実行時にワーカーで事前に読み込むトークナイザーのモデル名を持つ設定のキー
+COMMANDS = {
+    "mnm_to_txt": {
+        "config": "MNM_TO_TXT_CONFIG",
+        "input": "directory",
+        "help": "MNMファイルをテキストに変換",
+    },
+    "txt_to_jsonl": {
+        "config": "TXT_TO_JSONL_CONFIG",
+        "input": "input_directories",
+        "params": {"input_directories": "input_dirs"},
+        "help": "テキストをJSONLに変換",
+    },
+    "split_long_txt": {
+        "config": "SPLIT_LONG_TXT_CONFIG",
+        "input": "input_dir",
+        "tokenizer": "model_name",
+        "help": "長いテキストを分割",
+    },
+    "split_long_jsonl": {
+        "config": "SPLIT_LONG_JSONL_CONFIG",
+        "input": "input_file",
+        "tokenizer": "model_name",
+        "shards": {
+            "func": "process_jsonl_shards",
+            "params": {"input_file": "input_dir", "output_file": "output_dir", "exceeding_file": "exceeding_dir",
+                       "token_output": "token_output_dir"},
+        },
+        "help": "長いJSONLエントリを分割",
+    },
+    "merge_jsonl": {
+        "config": "MERGE_JSONL_CONFIG",
+        "input": "file1_path",
+        "help": "2つのJSONLファイルを結合",
+    },
+    "merge_jsonl_by_title": {
+        "config": "MERGE_JSONL_BY_TITLE_CONFIG",
+        "input": "input_file",
+        "help": "JSONLのエントリをtitleごとにマージ",
+    },
+    "remove_short_jsonl": {
+        "config": "REMOVE_SHORT_JSONL_CONFIG",
+        "input": "input_directory",
+        "shards": {"func": "filter_jsonl_shards", "params": {}},
+        "help": "短いJSONLエントリを削除",
+    },
+    "convert_kana": {
+        "config": "CONVERT_KANA_CONFIG",
+        "input": "input_file",
+        "shards": {"func": "convert_kana_shards", "params": {"input_file": "input_dir"}},
+        "help": "半角カタカナを全角カタカナに変換",
+    },
+    "convert_format": {
+        "config": "CONVERT_FORMAT_CONFIG",
+        "input": "input_file",
+        "help": "JSONL と Arrow / Parquet を相互変換",
+    },
+    "split_train_val_jsonl": {
+        "config": "SPLIT_TRAIN_VAL_JSONL_CONFIG",
+        "input": "file_path",
+        "help": "JSONLをトレーニング/検証用に分割",
+    },
+    "pack_sequences": {
+        "config": "PACK_SEQUENCES_CONFIG",
+        "input": "input_file",
+        "tokenizer": "model_name",
+        "help": "分割済みエントリを固定長シーケンスにパッキング",
+    },
+    "catalog": {
+        "config": "CATALOG_CONFIG",
+        "input": "input_files",
+        "tokenizer": "model_name",
+        "help": "エントリのメタデータとトークン数をカタログに登録",
+    },
+    "count_tokens": {
+        "module": "count_tokens",
+        "func": "main",
+        "config": "COUNT_TOKENS_CONFIG",
+        "input": "jsonl_file",
+        "help": "トークン数をカウント・可視化",
+    },
+}
+
+
+def parse_value(text):
+    """--set の値を JSON として解釈する（数値・真偽値・null・リストなど。解釈できない場合は文字列）"""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return text
+
+
+def parse_overrides(command, assignments):
+    """
+    --set <キー>=<値> のリストを {設定名: {キー: 値}} に変換する
+    キーに "." を含む場合は <設定名>.<キー>、含まない場合はサブコマンドの設定のキーとみなす
+    """
+    overrides = {}
+    for assignment in assignments:
+        key, sep, value = assignment.partition("=")
+        if not sep:
+            raise ValueError(f"--set は <キー>=<値> の形式で指定してください: {assignment}")
+        config_name, dot, config_key = key.partition(".")
+        if not dot:
+            config_name, config_key = COMMANDS[command]["config"], key
+        if not isinstance(getattr(config, config_name, None), dict):
+            raise ValueError(f"config.py に {config_name} が定義されていません")
+        overrides.setdefault(config_name, {})[config_key] = parse_value(value)
+    return overrides
+
+
+def apply_overrides(overrides):
+    """config.py の設定値を上書きする（各スクリプトは実行時に同じ辞書を参照する）"""
+    for config_name, values in overrides.items():
+        getattr(config, config_name).update(values)
+
+
+def expand_inputs(patterns):
+    """glob パターンを展開する（一致しないパターンはそのままのパスとして扱う）"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+
+def format_values(values, path, index):
+    """文字列の設定値の {stem} / {name} / {parent} / {index} を入力のパスに応じて置き換える"""
+    from jsonl_io import splitext_jsonl
+    name = os.path.basename(os.path.normpath(path))
+    fields = {
+        "stem": splitext_jsonl(name)[0] if os.path.isfile(path) else name,
+        "name": name,
+        "parent": os.path.basename(os.path.dirname(os.path.abspath(path))),
+        "index": index,
+    }
+    return {key: value.format(**fields) if isinstance(value, str) and "{" in value else value
+            for key, value in values.items()}
+
+
+def build_jobs(command, overrides, inputs):
+    """入力ごとの上書きする設定値のリストを返す（入力を指定しない場合は1件）"""
+    if not inputs:
+        return [overrides]
+    config_name = COMMANDS[command]["config"]
+    jobs = []
+    for index, path in enumerate(inputs):
+        job = {name: format_values(values, path, index) for name, values in overrides.items()}
+        job.setdefault(config_name, {})[COMMANDS[command]["input"]] = path
+        jobs.append(job)
+    return jobs
+
+
+def resolve_call(command):
+    """(関数, 設定のキー -> 引数名の対応, Path で渡す引数) を返す（シャード形式の入力の場合はシャード用の関数）"""
+    spec = COMMANDS[command]
+    stage_type = STAGE_TYPES.get(command, {})
+    module = importlib.import_module(spec.get("module", stage_type.get("module", command)))
+    settings = getattr(config, spec["config"])
+
+    shards = spec.get("shards")
+    if shards:
+        from shards import is_sharded_dataset
+        input_path = settings.get(spec["input"])
+        if isinstance(input_path, str) and is_sharded_dataset(input_path):
+            return getattr(module, shards["func"]), shards["params"], []
+    func = getattr(module, spec.get("func", stage_type.get("func")))
+    return func, spec.get("params", {}), stage_type.get("path_args", [])
+
+
+def run_job(command, job, executor=None):
+    """設定値を上書きしてサブコマンドの関数を1回実行する"""
+    apply_overrides(job)
+    func, params, path_args = resolve_call(command)
+    signature = inspect.signature(func)
+    kwargs = {}
+    for key, value in getattr(config, COMMANDS[command]["config"]).items():
+        name = params.get(key, key)
+        if name in signature.parameters:
+            kwargs[name] = Path(value) if name in path_args else value
+    if executor is not None and "executor" in signature.parameters:
+        kwargs["executor"] = executor
+    return func(**kwargs)
+
+
+def _init_worker(command, overrides):
+    """バッチ実行のワーカーの初期化（設定値を反映し、トークナイザーを事前に読み込む）"""
+    apply_overrides(overrides)
+    key = COMMANDS[command].get("tokenizer")
+    if key:
+        from tokenizer_backend import get_tokenizer
+        get_tokenizer(getattr(config, COMMANDS[command]["config"])[key])
+
+
+def _run_job_in_worker(command, job):
+    start = time.perf_counter()
+    run_job(command, job)
+    return time.perf_counter() - start
+
+
+def accepts_executor(command, job):
+    apply_overrides(job)
+    func, _, _ = resolve_call(command)
+    return "executor" in inspect.signature(func).parameters
+
+
+def run_batch(command, overrides, jobs, num_workers=None):
+    """
+    複数の入力に同じステージを実行する
+    関数がプロセスプールを受け取れる場合（split_long_jsonl など）は入力を順に処理し、各入力の処理で
+    共有のプールを使用する。受け取れない場合は、各入力の処理自体を共有のプールで並列に実行する。
+    戻り値: 失敗した入力のリスト
+    """
+    input_key = COMMANDS[command]["input"]
+    config_name = COMMANDS[command]["config"]
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                             initargs=(command, overrides)) as executor:
+        if accepts_executor(command, jobs[0]):
+            for i, job in enumerate(jobs, 1):
+                path = job[config_name][input_key]
+                print(f"[{i}/{len(jobs)}] {path}", flush=True)
+                start = time.perf_counter()
+                try:
+                    run_job(command, job, executor)
+                except Exception as e:
+                    print(f"[fail] {path}: {e}", flush=True)
+                    failed.append(path)
+                    continue
+                print(f"[done] {path}: {time.perf_counter() - start:.1f}秒", flush=True)
+        else:
+            futures = {executor.submit(_run_job_in_worker, command, job): job[config_name][input_key] for job in jobs}
+            for i, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                try:
+                    elapsed = future.result()
+                except Exception as e:
+                    print(f"[fail] {path}: {e}", flush=True)
+                    failed.append(path)
+                    continue
+                print(f"[done] ({i}/{len(jobs)}) {path}: {elapsed:.1f}秒", flush=True)
+    return failed
+
+
+def format_settings(command):
+    settings = getattr(config, COMMANDS[command]["config"])
+    lines = [f"{COMMANDS[command]['config']} の現在の値（--set で上書き）:"]
+    lines.extend(f"  {key} = {json.dumps(value, ensure_ascii=False)}" for key, value in settings.items())
+    return "\n".join(lines)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="前処理の各ステージを実行します（config.py の設定値を実行ごとに上書きできます）")
+    subparsers = parser.add_subparsers(dest="command", metavar="<サブコマンド>", required=True)
+    for command, spec in COMMANDS.items():
+        subparser = subparsers.add_parser(
+            command, help=spec["help"], description=spec["help"],
+            epilog=format_settings(command), formatter_class=argparse.RawDescriptionHelpFormatter
+        )
+        subparser.add_argument("inputs", nargs="*",
+                               help=f"入力のパスまたは glob パターン（{spec['input']} に設定する。省略時は設定値を使用）")
+        subparser.add_argument("--set", dest="assignments", action="append", default=[], metavar="KEY=VALUE",
+                               help="設定値を上書きする（他の設定は <設定名>.<キー>=<値>）")
+        subparser.add_argument("--jobs", type=int, default=None,
+                               help="バッチ実行時のワーカープロセス数（省略時は CPU 数）")
+        subparser.add_argument("--dry-run", action="store_true", help="各入力に対する設定値を表示するのみ")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        overrides = parse_overrides(args.command, args.assignments)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        return 2
+    inputs = expand_inputs(args.inputs)
+    jobs = build_jobs(args.command, overrides, inputs)
+
+    if args.dry_run:
+        for job in jobs:
+            print(json.dumps(job, ensure_ascii=False))
+        return 0
+
+    if len(jobs) == 1:
+        run_job(args.command, jobs[0])
+        return 0
+
+    # 全入力に共通の設定値（入力ごとに異なる値はジョブごとに反映する）をワーカーの初期化時に反映する
+    apply_overrides(overrides)
+    start = time.perf_counter()
+    failed = run_batch(args.command, overrides, jobs, args.jobs)
+    print(f"\nバッチ実行完了: {len(jobs) - len(failed)}/{len(jobs)} 件成功 ({time.perf_counter() - start:.1f}秒)")
+    for path in failed:
+        print(f"  失敗: {path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(main())
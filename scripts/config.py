@@ -6,6 +6,72 @@
 # 共通設定
 MODEL_NAME = "Qwen/Qwen2.5-Coder-14B-Instruct"
 
+# トークナイザーの読み込みの設定（tokenizer_backend.py）
+TOKENIZER_CONFIG = {
+    # "tokenizers": tokenizer.json を tokenizers ライブラリで直接読み込む（transformers / torch を読み込まないため起動が速い）
+    # "transformers": AutoTokenizer を使用する（tokenizer.json がないモデルの場合）
+    "backend": "tokenizers",
+    # tokenizer.json のローカルパス（ファイルまたはディレクトリ）。指定した場合はモデル名より優先し、Hub にアクセスしない
+    "tokenizer_file": None
+}
+
+# トークナイザーのサービスの設定（tokenizer_service.py）
+# python scripts/tokenizer_service.py で起動したサービスが1つのトークナイザーを保持し、各プロセスの要求をまとめて処理する
+TOKENIZER_SERVICE_CONFIG = {
+    "enabled": False,  # True の場合、サービスが起動していれば各プロセスはトークナイザーを読み込まずにサービスを使用する
+    "socket": "/tmp/data_preprocessing_tokenizer.sock",  # Unix ソケットのパス
+    "model_name": MODEL_NAME,  # サービスで保持するトークナイザー（このモデル名の要求のみサービスで処理する）
+    "coalesce_ms": 2,  # 最初の要求からこの時間内に届いた要求を1回のトークン化にまとめる
+    "max_batch_chars": 1 << 22  # 1回のトークン化の最大文字数
+}
+
+# トークナイザーの呼び出しのバッチの設定（batching.py）
+# テキストを長さ順に並べ、合計文字数が char_budget 以下のバッチにまとめてトークン化する
+BATCHING_CONFIG = {
+    "char_budget": 1 << 20,  # 1バッチの合計文字数の初期値
+    "min_char_budget": 1 << 16,  # auto_tune で調整する範囲
+    "max_char_budget": 1 << 24,
+    "auto_tune": True,  # スループット（文字/秒）を測定して char_budget を調整する
+    "max_batch_size": 4096,  # 1バッチの最大件数
+    "sort_window": 16384,  # 長さ順に並べ替える範囲の件数
+    "window_budgets": 8  # 並べ替える範囲の最大文字数（char_budget の倍数）
+}
+
+# プロセスプールのタスクの割り当ての設定（scheduler.py）
+# split_long_jsonl.py / split_long_txt.py は、テキストの長いエントリ・サイズの大きいファイルから順にワーカーに割り当てる
+SCHEDULER_CONFIG = {
+    "enabled": True,  # False の場合は入力の順に割り当てる
+    "expand_chars": 1 << 20,  # この文字数以上のテキストはトークン化をサブタスクに分け、複数のワーカーで処理する
+    "subtask_chars": 1 << 18,  # セグメントのトークン化のサブタスク1つあたりの文字数
+    "prefetch": 2  # ワーカー数に加えてプールに投入しておくタスク数
+}
+
+# JSONLの読み書きの設定（jsonl_io.py）
+# 拡張子が .jsonl.gz / .jsonl.zst のファイルは自動的に圧縮・展開される
+JSONL_IO_CONFIG = {
+    "level": {"gzip": 6, "zstd": 3},  # 圧縮レベル
+    "threads": -1,  # 圧縮に使用するスレッド数（-1 でCPU数）
+    "seekable": False,  # True の場合、行境界で区切ったフレーム単位で圧縮し、フレームインデックス（.frames.json）を保存する
+    "frame_size": 4 * 1024 * 1024  # フレーム1つあたりの非圧縮バイト数の目安
+}
+
+# 処理時間・件数・メモリ使用量の計測の設定（metrics.py）
+METRICS_CONFIG = {
+    "enabled": True,  # 区間ごとの時間・カウンター・ピークメモリを記録してJSONで出力する
+    "output_dir": "./data/analysis/metrics",  # 出力先が決まっていないステージのメトリクスの保存先
+    "profile": None,  # None / "cprofile" / "py-spy"（プロファイルを行う場合に指定）
+    "profile_dir": "./data/analysis/profile",  # プロファイル結果の保存先
+    "py_spy_rate": 100  # py-spy のサンプリングレート（回/秒）
+}
+
+# 途中経過の保存と再開の設定（checkpoint.py）
+# split_long_jsonl.py はチャンクごとに <出力ファイル>.checkpoint/ に、mnm_to_txt.py はファイルごとに
+# 出力ディレクトリの .mnm_to_txt.journal に処理済みの位置を記録し、中断した場合は次回の実行時に続きから再開する
+CHECKPOINT_CONFIG = {
+    "enabled": True,  # False の場合は前回の途中経過を破棄して最初から処理する
+    "chunk_entries": 10000  # split_long_jsonl.py で1回にコミットするエントリ数
+}
+
 
 # 学習データの作成に関する設定
 """
@@ -33,14 +99,21 @@ TXT_TO_JSONL_CONFIG = {
     "category": "normal",
     "id_prefix": "05",
     "use_delimiter": True,  # デリミタを使用するかどうか
-    "delimiter": ";<h1/>"  # ファイルを分割するデリミタ（use_delimiterがTrueの場合のみ使用）
+    "delimiter": ";<h1/>",  # ファイルを分割するデリミタ（use_delimiterがTrueの場合のみ使用）
+    "shard_size": None,  # 指定するとシャード形式で出力し、新しいファイルのみを追記する（例: 10000）
+    # id の振り方（"sequential": ファイル名順の連番、"hash": 入力ディレクトリの番号・ファイル名・ブロック番号のハッシュ）
+    # どちらもファイルを並列に変換し、"sequential" の id は1つずつ処理した場合と同じになる
+    "id_scheme": "sequential"
 }
 
 # remove_short_jsonl.py の設定
 REMOVE_SHORT_JSONL_CONFIG = {
     "input_directory": "./data/processed/jsonl/merged",
     "output_directory": "./data/processed/jsonl/filtered",
-    "length_limit": 200
+    "length_limit": 200,
+    # 入力がシャード形式の場合、複数マシンで分担するときの担当番号と総数
+    "worker_index": 0,
+    "num_workers": 1
 }
 
 # split_long_txt.py の設定
@@ -51,7 +124,19 @@ SPLIT_LONG_TXT_CONFIG = {
     "exceeding_dir": "./data/processed/jsonl/exceeding_limit_h1",
     "summary_dir": "./data/analysis/split_summary",
     "delimiter": ";<h1/>",  # ;<h1/> or \n;
-    "token_limit": 15872
+    "token_limit": 15872,
+    # token_limit を超えるセグメントを行の境界で分割する（False の場合はファイルを exceeding_dir に保存する）
+    "split_oversized_segments": True,
+    # チャンクのトークン数の計算方法（split_long_jsonl.py の plan_chunks を参照）
+    # "boundary": 区切りの前後の結合を測定し、上限から verify_margin 以内のチャンクは実際にトークン化して検証する
+    # "additive": セグメントのトークン数と delimiter のトークン数の合計（上限を超える場合がある）
+    "chunk_accounting": "boundary",
+    # verify_margin は経験的な余裕（推定の誤差がこれを超えると検証せずに上限を超える可能性がある）
+    # None にすると複数のセグメントからなるチャンクをすべて検証し、token_limit 以下を保証する（処理は遅くなる）
+    "verify_margin": 64,
+    # 出力形式（"files": チャンクごとに .txt ファイルを作成する、
+    # "pack": ワーカーごとのパックファイルに追記し、元のファイル名から引ける index.jsonl を作成する（text_pack.py））
+    "output_format": "files"
 }
 
 # split_long_jsonl.py の設定
@@ -62,7 +147,19 @@ SPLIT_LONG_JSONL_CONFIG = {
     "exceeding_file": "./data/processed/jsonl/exceeding_limit/semicolon/plc_normal_05-2_exceeding.jsonl",
     "summary_dir": "./data/analysis/split_summary",
     "delimiter": "\n;",  # ;<h1/> or \n;
-    "token_limit": 15872
+    "token_limit": 15872,
+    # token_limit を超えるセグメントを行の境界で分割する（False の場合はエントリを exceeding_file に出力する）
+    "split_oversized_segments": True,
+    # チャンクのトークン数の計算方法（"boundary" / "additive"、plan_chunks を参照）と検証するチャンクの範囲
+    # （verify_margin=None の場合は複数のセグメントからなるチャンクをすべて検証する）
+    "chunk_accounting": "boundary",
+    "verify_margin": 64,
+    # 分割時に計算したトークンIDの保存先（token_store.py の形式。None の場合は保存しない）
+    # 例: "./data/processed/tokens/plc_normal_05-2_semicolon" → .bin / .idx.npy / .json を出力
+    "token_output": None,
+    # 入力がシャード形式の場合、output_file / exceeding_file / token_output は出力先ディレクトリとして扱う
+    "worker_index": 0,
+    "num_workers": 1
 }
 
 
@@ -97,7 +194,30 @@ MERGE_JSONL_CONFIG = {
 COUNT_TOKENS_CONFIG = {
     "jsonl_file": './data/processed/jsonl/exceeding_limit/semicolon/plc_normal_05-2_exceeding.jsonl',
     "output_dir": './data/analysis/token_count_plot',
-    "filter_token_limit": 8192  # フィルタリング用のトークン制限値
+    "filter_token_limit": 8192,  # フィルタリング用のトークン制限値
+    # 統計情報（<入力ファイル名>_stats.json）に含めるパーセンタイルと、行数・トークン数を集計する上限値
+    "percentiles": [50, 90, 99],
+    "token_limits": [8192, 15872, 32768],
+    # トークン化したトークン数のキャッシュ（入力ファイルとモデルが同じ場合は再度トークン化しない。None の場合は使用しない）
+    "cache_dir": './data/analysis/token_count_plot/cache',
+    # 複数のファイルを指定した場合は jsonl_file の代わりにこれらを集計し、ファイルごとと全体の統計情報と
+    # 分布を重ねたヒストグラムを <report_name>.json / .png として保存する
+    "jsonl_files": [],
+    "report_name": "token_count_report",
+    # タイトルの集計方法
+    # "title": タイトルごとの総トークン数を title_token_counts.txt に出力（トークン数の多い順）
+    # "program": タイトルから末尾の _partN と _block_N を除いたプログラム名ごとに集計し、上位 top_k 件を
+    #            program_token_counts_top<K>.txt に、すべてのプログラムを program_token_counts.<export_format> に出力
+    "title_aggregation": "title",
+    "top_k": 50,
+    "export_format": "csv",  # csv / parquet（parquet は pyarrow が必要）
+    # True の場合、エントリのトークン数の代わりにトークンIDの頻度を集計し、<ファイル名 or report_name>_token_frequency.json / .npy
+    # （上位 frequency_top_n 件のトークンとその文字列・グループごとのバイト数/トークン数・半角カタカナの変換前後のトークン数）を出力する
+    "token_frequency": False,
+    "frequency_top_n": 100,
+    "frequency_group_by": "category",  # title / category（id の先頭）/ program（タイトルから末尾の _partN と _block_N を除いたもの）
+    "kana_fertility": True,  # 半角カタカナを含むテキストを convert_kana.py と同じ変換をした場合のトークン数と比較する
+    "num_workers": None  # ファイルを分割して並列にトークン化するプロセス数（None の場合は CPU 数）
 }
 
 # generate_sample_jsonl.py の設定
@@ -109,6 +229,20 @@ GENERATE_SAMPLE_JSONL_CONFIG = {
     "max_tokens": 16384
 }
 
+# catalog.py の設定（エントリのメタデータとトークン数を SQLite のカタログに記録する）
+CATALOG_CONFIG = {
+    # True の場合、count_tokens.py / generate_sample_jsonl.py は登録済みのファイルのトークン数をカタログから取得する
+    "enabled": False,
+    "path": "./data/analysis/catalog.sqlite",
+    # python scripts/catalog.py で登録するファイル
+    "input_files": [
+        "./data/processed/jsonl/long_text_splitted/plc_normal_05-3.jsonl",
+    ],
+    "model_name": MODEL_NAME,  # 記録するトークン数のモデル（None の場合はトークン数を記録しない）
+    "batch_size": 10000,  # 1回にトークン化するエントリ数
+    "busy_timeout": 60  # 複数のプロセスで登録する場合にカタログのロックを待つ最大秒数
+}
+
 # remove_files.py の設定
 REMOVE_FILES_CONFIG = {
     "target_directories": [
@@ -120,12 +254,249 @@ REMOVE_FILES_CONFIG = {
 # convert_kana.py の設定
 CONVERT_KANA_CONFIG = {
     "input_file": "./data/processed/jsonl/original/plc_normal_05-1_kana.jsonl",
-    "output_dir": "./data/processed/jsonl/kana"
+    "output_dir": "./data/processed/jsonl/kana",
+    # 入力がシャード形式の場合、output_dir をそのまま出力先のデータセットとする
+    "worker_index": 0,
+    "num_workers": 1
+}
+
+# shards.py の設定（単一のJSONLファイルをシャード形式に変換）
+SHARDS_CONFIG = {
+    "input_file": "./data/processed/jsonl/original/plc_normal_05-1_kana.jsonl",
+    "output_dir": "./data/processed/jsonl/original/plc_normal_05-1_kana",
+    "shard_size": 10000,  # 1シャードあたりの行数
+    "suffix": ".jsonl"  # シャードの拡張子（".jsonl.zst" / ".jsonl.gz" で圧縮）
+}
+
+# job_ledger.py の設定（共有ストレージ上の台帳からジョブを取得して複数のマシンで分担する）
+# enabled が True の場合、シャード形式の入力を処理する split_long_jsonl.py / convert_kana.py / remove_short_jsonl.py と
+# mnm_to_txt.py は、worker_index / num_workers の代わりに出力ディレクトリの台帳（.job_ledger.sqlite）からジョブを取得する
+JOB_LEDGER_CONFIG = {
+    "enabled": False,
+    "worker_id": None,  # 台帳に記録するワーカーの識別子（None の場合は ホスト名-PID）
+    "lease_seconds": 300,  # リースの期限（この時間ハートビートがないジョブは他のワーカーが処理し直す）
+    "heartbeat_seconds": 30,  # リースを延長する間隔
+    "poll_seconds": 5,  # 他のワーカーの処理中のジョブの完了を待つ間隔
+    "max_attempts": 3,  # 1つのジョブを処理する最大回数（超えた場合は失敗とする）
+    "busy_timeout": 60  # 台帳のロックを待つ最大秒数
+}
+
+# arrow_io.py の設定（JSONL と Arrow / Parquet の相互変換。拡張子で判定）
+CONVERT_FORMAT_CONFIG = {
+    "input_file": "./data/processed/jsonl/long_text_splitted/plc_normal_05-3.jsonl",
+    "output_file": "./data/processed/arrow/plc_normal_05-3.arrow"  # .arrow / .parquet / .jsonl
 }
 
 # merge_jsonl_by_title.py の設定
 MERGE_JSONL_BY_TITLE_CONFIG = {
     "input_file": "./data/processed/jsonl/deduplicated/plc_normal_05-2.jsonl",
     "output_file": "./data/processed/jsonl/merged/merged_plc_normal_05-2.jsonl",
-    "text_delimiter": "\n;<h1/>"  # テキスト結合時の区切り文字
+    "text_delimiter": "\n;<h1/>",  # テキスト結合時の区切り文字
+    # 指定すると、各プログラムを1つのテキストにまとめる代わりに block番号順にこのトークン数以下のチャンクにまとめて出力する
+    # （split_long_jsonl.py で再度トークン化して分割する必要がなくなる。例: 15872）
+    "token_budget": None,
+    "model_name": MODEL_NAME  # token_budget を指定した場合に使用するトークナイザー
+}
+
+# pack_sequences.py の設定（分割済みのエントリを固定長のシーケンスにパッキング）
+PACK_SEQUENCES_CONFIG = {
+    "model_name": MODEL_NAME,  # トークン数が保存されていない入力（JSONL）の場合に使用
+    "input_file": "./data/processed/jsonl/splitted_train-val/plc_normal_05-3_train.jsonl",
+    "output_file": "./data/processed/jsonl/packed/plc_normal_05-3_train_packed.jsonl",
+    "report_file": "./data/analysis/pack_report/plc_normal_05-3_train.json",
+    "seq_length": 16384,  # シーケンス長（split_long_jsonl.py の token_limit 以上にすること）
+    "sep_tokens": 1  # 文書の区切り（EOS など）として各文書に加えるトークン数
+}
+
+# benchmark.py の設定（合成コーパスによるベンチマーク）
+BENCHMARK_CONFIG = {
+    "work_dir": "./cache/benchmark",  # 合成コーパス・ローカルのトークナイザー・各ステージの出力の保存先
+    "results_dir": "./data/analysis/benchmark",  # 計測結果（JSON）の保存先
+    "corpus_size_mb": 100,  # 合成コーパスのサイズ（--size-mb で上書き可能）
+    "max_file_kb": 4096,  # .mnm ファイル1つあたりの最大サイズ
+    "seed": 0,
+    "tokenizer_vocab_size": 4000,  # ローカルで学習するBPEトークナイザーの語彙数
+    "token_limit": 4096,  # split_long_jsonl の token_limit（小さな語彙でも分割が発生する値）
+    "length_limit": 200  # remove_short_jsonl の length_limit
+}
+
+# pipeline.py の設定
+"""
+stages の各要素:
+- name: ステージ名（一意）
+- type: ステージの種類（pipeline.py の STAGE_TYPES を参照）
+- deps: 依存するステージ名のリスト（依存のないステージ同士は並列に実行される）
+- config: ステージの関数に渡す引数
+"""
+PIPELINE_CONFIG = {
+    "cache_dir": "./cache/pipeline",  # フィンガープリントとハッシュキャッシュの保存先
+    "max_workers": 2,  # 同時に実行するステージ数
+    "stages": [
+        # --- 通常 ---
+        {
+            "name": "normal_mnm_to_txt",
+            "type": "mnm_to_txt",
+            "config": {
+                "directory": "./data/raw/通常",
+                "output_directory": "./data/processed/txt/通常",
+                "error_directory": "./data/raw/encoding_error/通常"
+            }
+        },
+        {
+            "name": "normal_txt_to_jsonl",
+            "type": "txt_to_jsonl",
+            "deps": ["normal_mnm_to_txt"],
+            "config": {
+                "input_dirs": "./data/processed/txt/通常",
+                "output_dir": "./data/processed/jsonl/original",
+                "output_filename": "plc_normal.jsonl",
+                "category": "normal",
+                "id_prefix": "05",
+                "use_delimiter": True,
+                "delimiter": ";<h1/>"
+            }
+        },
+        {
+            "name": "normal_split_h1",
+            "type": "split_long_jsonl",
+            "deps": ["normal_txt_to_jsonl"],
+            "config": {
+                "input_file": "./data/processed/jsonl/original/plc_normal.jsonl",
+                "output_file": "./data/processed/jsonl/long_text_splitted/plc_normal_h1.jsonl",
+                "exceeding_file": "./data/processed/jsonl/exceeding_limit/h1/plc_normal_exceeding.jsonl",
+                "summary_dir": "./data/analysis/split_summary",
+                "delimiter": ";<h1/>",
+                "token_limit": 15872
+            }
+        },
+        {
+            "name": "normal_split_semicolon",
+            "type": "split_long_jsonl",
+            "deps": ["normal_split_h1"],
+            "config": {
+                "input_file": "./data/processed/jsonl/exceeding_limit/h1/plc_normal_exceeding.jsonl",
+                "output_file": "./data/processed/jsonl/long_text_splitted/plc_normal_semicolon.jsonl",
+                "exceeding_file": "./data/processed/jsonl/exceeding_limit/semicolon/plc_normal_exceeding.jsonl",
+                "summary_dir": "./data/analysis/split_summary",
+                "delimiter": "\n;",
+                "token_limit": 15872
+            }
+        },
+        {
+            "name": "normal_merge",
+            "type": "merge_jsonl",
+            "deps": ["normal_split_h1", "normal_split_semicolon"],
+            "config": {
+                "file1_path": "./data/processed/jsonl/long_text_splitted/plc_normal_h1.jsonl",
+                "file2_path": "./data/processed/jsonl/long_text_splitted/plc_normal_semicolon.jsonl",
+                "output_path": "./data/processed/jsonl/merged/normal/plc_normal.jsonl"
+            }
+        },
+        {
+            "name": "normal_remove_short",
+            "type": "remove_short_jsonl",
+            "deps": ["normal_merge"],
+            "config": {
+                "input_directory": "./data/processed/jsonl/merged/normal",
+                "output_directory": "./data/processed/jsonl/short_removed/normal",
+                "length_limit": 200
+            }
+        },
+        {
+            "name": "normal_train_val",
+            "type": "split_train_val_jsonl",
+            "deps": ["normal_remove_short"],
+            "config": {
+                "file_path": "./data/processed/jsonl/short_removed/normal/filtered_plc_normal.jsonl",
+                "train_ratio": 0.95,
+                "output_dir": "./data/processed/jsonl/splitted_train-val",
+                "train_output": "plc_normal_train.jsonl",
+                "val_output": "plc_normal_val.jsonl",
+                "seed": 42
+            }
+        },
+        # --- STG命令使用 ---
+        {
+            "name": "stg_mnm_to_txt",
+            "type": "mnm_to_txt",
+            "config": {
+                "directory": "./data/raw/STG命令使用",
+                "output_directory": "./data/processed/txt/STG命令使用",
+                "error_directory": "./data/raw/encoding_error/STG命令使用"
+            }
+        },
+        {
+            "name": "stg_txt_to_jsonl",
+            "type": "txt_to_jsonl",
+            "deps": ["stg_mnm_to_txt"],
+            "config": {
+                "input_dirs": "./data/processed/txt/STG命令使用",
+                "output_dir": "./data/processed/jsonl/original",
+                "output_filename": "plc_stg.jsonl",
+                "category": "STG",
+                "id_prefix": "05",
+                "use_delimiter": True,
+                "delimiter": ";<h1/>"
+            }
+        },
+        {
+            "name": "stg_split_h1",
+            "type": "split_long_jsonl",
+            "deps": ["stg_txt_to_jsonl"],
+            "config": {
+                "input_file": "./data/processed/jsonl/original/plc_stg.jsonl",
+                "output_file": "./data/processed/jsonl/long_text_splitted/plc_stg_h1.jsonl",
+                "exceeding_file": "./data/processed/jsonl/exceeding_limit/h1/plc_stg_exceeding.jsonl",
+                "summary_dir": "./data/analysis/split_summary",
+                "delimiter": ";<h1/>",
+                "token_limit": 15872
+            }
+        },
+        {
+            "name": "stg_split_semicolon",
+            "type": "split_long_jsonl",
+            "deps": ["stg_split_h1"],
+            "config": {
+                "input_file": "./data/processed/jsonl/exceeding_limit/h1/plc_stg_exceeding.jsonl",
+                "output_file": "./data/processed/jsonl/long_text_splitted/plc_stg_semicolon.jsonl",
+                "exceeding_file": "./data/processed/jsonl/exceeding_limit/semicolon/plc_stg_exceeding.jsonl",
+                "summary_dir": "./data/analysis/split_summary",
+                "delimiter": "\n;",
+                "token_limit": 15872
+            }
+        },
+        {
+            "name": "stg_merge",
+            "type": "merge_jsonl",
+            "deps": ["stg_split_h1", "stg_split_semicolon"],
+            "config": {
+                "file1_path": "./data/processed/jsonl/long_text_splitted/plc_stg_h1.jsonl",
+                "file2_path": "./data/processed/jsonl/long_text_splitted/plc_stg_semicolon.jsonl",
+                "output_path": "./data/processed/jsonl/merged/stg/plc_stg.jsonl"
+            }
+        },
+        {
+            "name": "stg_remove_short",
+            "type": "remove_short_jsonl",
+            "deps": ["stg_merge"],
+            "config": {
+                "input_directory": "./data/processed/jsonl/merged/stg",
+                "output_directory": "./data/processed/jsonl/short_removed/stg",
+                "length_limit": 200
+            }
+        },
+        {
+            "name": "stg_train_val",
+            "type": "split_train_val_jsonl",
+            "deps": ["stg_remove_short"],
+            "config": {
+                "file_path": "./data/processed/jsonl/short_removed/stg/filtered_plc_stg.jsonl",
+                "train_ratio": 0.95,
+                "output_dir": "./data/processed/jsonl/splitted_train-val",
+                "train_output": "plc_stg_train.jsonl",
+                "val_output": "plc_stg_val.jsonl",
+                "seed": 42
+            }
+        }
+    ]
 }
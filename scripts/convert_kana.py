@@ -1,8 +1,47 @@
 import os
-import json
 import jaconv
 from config import CONVERT_KANA_CONFIG
+from shards import is_sharded_dataset, process_shards
+from jsonl_io import iter_records, RecordWriter, splitext_jsonl
+from metrics import measure_stage, count
 
+def convert_jsonl_file(input_file, output_file):
+    """
+    1つのJSONL（または Arrow / Parquet）ファイルの"text"フィールドの半角カタカナを全角カタカナに変換して output_file に書き込む。
+    
+    Returns:
+        (total_count, converted_count): 処理した行数と変換が行われた行数
+    """
+    converted_count = 0
+    total_count = 0
+    
+    def on_error(line_num, e):
+        print(f"JSON解析エラー（行をスキップ）: {e}")
+    
+    with RecordWriter(output_file) as writer:
+        for data in iter_records(input_file, on_error=on_error):
+            total_count += 1
+            
+            # "text"フィールドが存在する場合のみ変換
+            if "text" in data and data["text"]:
+                original_text = data["text"]
+                # 半角カタカナを全角カタカナに変換
+                converted_text = jaconv.hankaku2zenkaku(original_text, kana=True, ascii=False, digit=False)
+                
+                # 変換が行われた場合のみカウント
+                if original_text != converted_text:
+                    converted_count += 1
+                
+                data["text"] = converted_text
+            
+            # 変換後のエントリを出力
+            writer.write(data)
+    
+    count("records", total_count)
+    count("records_converted", converted_count)
+    return total_count, converted_count
+
+@measure_stage("convert_kana")
 def convert_hankaku_to_zenkaku_kana(input_file, output_dir):
     """
     JSONLファイルの"text"フィールドに含まれる半角カタカナを全角カタカナに変換します。
@@ -17,55 +56,40 @@ def convert_hankaku_to_zenkaku_kana(input_file, output_dir):
         
         # 入力ファイル名から出力ファイル名を生成（末尾に_kanaを追加）
         input_filename = os.path.basename(input_file)
-        name, ext = os.path.splitext(input_filename)
+        name, ext = splitext_jsonl(input_filename)
         output_filename = f"{name}_kana{ext}"
         output_file = os.path.join(output_dir, output_filename)
         
-        converted_count = 0
-        total_count = 0
-        
         # JSONLファイルを読み込み、変換して出力
-        with open(input_file, 'r', encoding='utf-8') as infile, \
-             open(output_file, 'w', encoding='utf-8') as outfile:
-            
-            for line in infile:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                try:
-                    # JSON行をパース
-                    data = json.loads(line)
-                    total_count += 1
-                    
-                    # "text"フィールドが存在する場合のみ変換
-                    if "text" in data and data["text"]:
-                        original_text = data["text"]
-                        # 半角カタカナを全角カタカナに変換
-                        converted_text = jaconv.hankaku2zenkaku(original_text, kana=True, ascii=False, digit=False)
-                        
-                        # 変換が行われた場合のみカウント
-                        if original_text != converted_text:
-                            converted_count += 1
-                        
-                        data["text"] = converted_text
-                    
-                    # 変換後のJSONを出力
-                    json_line = json.dumps(data, ensure_ascii=False)
-                    outfile.write(json_line + '\n')
-                    
-                except json.JSONDecodeError as e:
-                    print(f"JSON解析エラー（行をスキップ）: {e}")
-                    continue
+        total_count, converted_count = convert_jsonl_file(input_file, output_file)
         
         print(f"変換完了: {output_file}")
         print(f"処理した行数: {total_count}")
         print(f"変換が行われた行数: {converted_count}")
         
     except FileNotFoundError:
+        # 呼び出し元（pipeline.py など）が失敗を検出できるように例外を送出し直す
         print(f"エラー: 入力ファイルが見つかりません: {input_file}")
+        raise
     except Exception as e:
         print(f"エラーが発生しました: {e}")
+        raise
+
+@measure_stage("convert_kana_shards")
+def convert_kana_shards(input_dir, output_dir, worker_index=0, num_workers=1):
+    """
+    シャード形式のデータセットを変換する（shards.py を参照）
+    新規・変更されたシャードのみを変換し、同名のシャードとして output_dir に出力する。
+    """
+    def process_shard(input_path, output_path):
+        total_count, _ = convert_jsonl_file(input_path, output_path)
+        # 変換によりトークン数が変わるため、トークン数は記録しない
+        return {"rows": total_count, "tokens": None}
+
+    processed, skipped = process_shards(input_dir, output_dir, process_shard, {"stage": "convert_kana"},
+                                        worker_index, num_workers)
+    print(f"シャード処理完了: 処理 {len(processed)} 件 / スキップ {len(skipped)} 件")
+    return processed, skipped
 
 def main():
     """
@@ -78,7 +102,16 @@ def main():
     print(f"出力ディレクトリ: {output_dir}")
     print("半角カタカナ → 全角カタカナ変換を開始します...")
     
-    convert_hankaku_to_zenkaku_kana(input_file, output_dir)
+    if is_sharded_dataset(input_file):
+        # 入力がシャード形式の場合は output_dir をそのまま出力先のデータセットとする
+        convert_kana_shards(
+            input_file,
+            output_dir,
+            worker_index=CONVERT_KANA_CONFIG.get("worker_index", 0),
+            num_workers=CONVERT_KANA_CONFIG.get("num_workers", 1)
+        )
+    else:
+        convert_hankaku_to_zenkaku_kana(input_file, output_dir)
 
 if __name__ == "__main__":
     main()
@@ -1,139 +1,787 @@
 import os
+import csv
+import itertools
 import json
-import matplotlib.pyplot as plt
 import numpy as np
-import matplotlib.ticker as ticker
+from functools import partial
 from tqdm import tqdm
-from transformers import AutoTokenizer
 from config import COUNT_TOKENS_CONFIG, MODEL_NAME
+from jsonl_io import iter_records, is_arrow_file, splitext_jsonl
+from mmap_jsonl import MappedJsonl, map_ranges, iter_range_lines
+from metrics import measure_stage, timer, count
+from tokenizer_backend import get_tokenizer
+from batching import iter_token_counts, tokenize_batched
+from checkpoint import input_fingerprint, iter_chunks
+from merge_jsonl_by_title import extract_program_name
 
-# --- ファイルパスの設定 ---
-jsonl_file = COUNT_TOKENS_CONFIG["jsonl_file"]
-output_dir = COUNT_TOKENS_CONFIG["output_dir"]
-filter_token_limit = COUNT_TOKENS_CONFIG["filter_token_limit"]
-os.makedirs(output_dir, exist_ok=True)
-
-# --- Hugging Face のトークナイザーを取得 ---
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-
-# --- 総行数の取得 ---
-with open(jsonl_file, 'r', encoding='utf-8') as f:
-    total_lines = sum(1 for _ in f)
-
-# --- テキストとタイトルの読み込み ---
-texts = []
-titles = []
-with open(jsonl_file, 'r', encoding='utf-8') as f:
-    for line in tqdm(f, total=total_lines, desc="テキスト読み込み", dynamic_ncols=True):
-        data = json.loads(line)
-        texts.append(data.get("text", ""))
-        titles.append(data.get("title", "不明"))
-
-# --- 一括トークン化とタイトルごとの集計（バッチ処理） ---
-batch_size = 1000  # バッチサイズは必要に応じて調整
-title_token_counts = {}  # タイトルごとのトークン数を保持
-token_counts = []  # 全体の統計用
-
-for i in tqdm(range(0, len(texts), batch_size), desc="トークン化", dynamic_ncols=True):
-    batch_texts = texts[i: i+batch_size]
-    batch_titles = titles[i: i+batch_size]
-    batch_encoding = tokenizer(batch_texts, add_special_tokens=False)
-    
-    # バッチ内の各テキストのトークン数をタイトルごとに集計
-    for title, token_ids in zip(batch_titles, batch_encoding["input_ids"]):
+# トークン数は int64 の numpy 配列として扱う（統計値・ヒストグラムはすべて配列から一括で計算する）
+COUNT_DTYPE = np.int64
+# トークン数のキャッシュの形式（変更した場合は以前のキャッシュを使用しない）
+CACHE_FORMAT = 2
+# プログラムごとの集計で1回に処理するエントリ数
+AGGREGATE_BATCH_SIZE = 100000
+# トークンIDの頻度の集計で1回にトークン化するエントリ数
+FREQUENCY_BATCH_SIZE = 10000
+
+
+def load_texts_and_titles(jsonl_file):
+    """JSONL（または Arrow / Parquet）ファイルからテキストとタイトルを読み込む"""
+    texts = []
+    titles = []
+    if is_arrow_file(jsonl_file):
+        from arrow_io import count_rows
+        total_lines = count_rows(jsonl_file)
+        records = iter_records(jsonl_file)
+        reader = None
+    else:
+        # 行のインデックスから総行数を求める（ファイルを2回読む必要がない）
+        reader = MappedJsonl(jsonl_file)
+        total_lines = len(reader)
+        records = reader.iter_records()
+
+    # --- テキストとタイトルの読み込み ---
+    with timer("read"):
+        for data in tqdm(records, total=total_lines, desc="テキスト読み込み", dynamic_ncols=True):
+            texts.append(data.get("text", ""))
+            titles.append(data.get("title", "不明"))
+    if reader is not None:
+        reader.close()
+    return total_lines, texts, titles
+
+
+def iter_title_text_batches(jsonl_file, batch_size=AGGREGATE_BATCH_SIZE):
+    """
+    JSONL（または Arrow / Parquet）ファイルのエントリを batch_size 件ずつ (タイトルのリスト, テキストのリスト) として返す
+    （ファイル全体のテキストを保持せずにトークン化するためのもの）
+    """
+    if is_arrow_file(jsonl_file):
+        from arrow_io import count_rows
+        total_lines = count_rows(jsonl_file)
+        records = iter_records(jsonl_file)
+        reader = None
+    else:
+        reader = MappedJsonl(jsonl_file)
+        total_lines = len(reader)
+        records = reader.iter_records()
+
+    batches = iter_chunks(records, batch_size)
+    try:
+        with tqdm(total=total_lines, desc="トークン化", dynamic_ncols=True) as progress:
+            while True:
+                with timer("read"):
+                    batch = next(batches, None)
+                if batch is None:
+                    return
+                yield [data.get("title", "不明") for data in batch], [data.get("text", "") for data in batch]
+                progress.update(len(batch))
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+def load_cached_token_counts(jsonl_file):
+    """
+    Arrow / Parquet ファイルに計算済みのトークン数がある場合、
+    token_count 列と title 列のみを読み込む（本文は読み込まずトークン化も行わない）。
+    戻り値: (token_counts, titles) または None
+    """
+    if not is_arrow_file(jsonl_file):
+        return None
+    from arrow_io import read_table
+    table = read_table(jsonl_file, columns=["title", "token_count"])
+    if table.column("token_count").null_count:
+        return None
+    titles = [title if title is not None else "不明" for title in table.column("title").to_pylist()]
+    return table.column("token_count").to_pylist(), titles
+
+
+def tokenize_and_count(texts, titles, tokenizer):
+    """一括トークン化とタイトルごとの集計（長さ順・文字数の予算ごとのバッチ処理、batching.py）"""
+    title_token_counts = {}  # タイトルごとのトークン数を保持
+    token_counts = []  # 全体の統計用
+
+    counts = iter_token_counts(tokenizer, texts, add_special_tokens=False)
+    for title, token_count in zip(titles, tqdm(counts, total=len(texts), desc="トークン化", dynamic_ncols=True)):
         if title not in title_token_counts:
             title_token_counts[title] = 0
-        title_token_counts[title] += len(token_ids)
-        token_counts.append(len(token_ids))  # 全体の統計用に追加
-
-# タイトルごとのトークン数を出力
-output_file = os.path.join(output_dir, 'title_token_counts.txt')
-with open(output_file, 'w', encoding='utf-8') as f:
-    f.write("タイトルごとの総トークン数\n")
-    f.write("=" * 30 + "\n\n")
-    for title, count in title_token_counts.items():
-        f.write(f"{title}: {count}トークン\n")
-
-print(f"タイトルごとの総トークン数を保存しました: {output_file}")
-
-# --- 統計値の計算 ---
-if token_counts:
-    sum_tokens = sum(token_counts)
-    avg_tokens = sum_tokens / len(token_counts)
-    max_tokens = max(token_counts)
-    min_tokens = min(token_counts)
-else:
-    sum_tokens = avg_tokens = max_tokens = min_tokens = 0
-
-print(f"総行数:{total_lines}")
-print(f"総トークン数: {sum_tokens}")
-print(f"平均トークン数: {avg_tokens}")
-print(f"最大トークン数: {max_tokens}")
-print(f"最小トークン数: {min_tokens}")
-
-# --- ヒストグラムプロット1: 全体のデータ ---
-fig, ax = plt.subplots(figsize=(10, 6))
-bins = 50
-ax.hist(token_counts, bins=bins, color='skyblue', edgecolor='black')
-ax.set_title('Token Count Distribution (All Data)')
-ax.set_xlabel('Token Count')
-ax.set_ylabel('Frequency')
-ax.grid(True)
-
-# --- x軸の目盛り設定 ---
-# 1) 目盛りの最大数を10に制限 (必要に応じて変更)
-ax.xaxis.set_major_locator(ticker.MaxNLocator(10))
-
-# 2) x軸ラベルを45度回転
-ax.tick_params(axis='x', rotation=45)
-
-# --- プロット画像の保存（全体） ---
-input_filename = os.path.basename(jsonl_file)
-png_filename_all = os.path.splitext(input_filename)[0] + "_all.png"
-plot_path_all = os.path.join(output_dir, png_filename_all)
-
-plt.savefig(plot_path_all, bbox_inches='tight')  # bbox_inches='tight' でラベル切れを防ぐ
-plt.close()
-
-print("全体のプロット結果を保存しました:", plot_path_all)
-
-# --- 設定値以下のデータをフィルタリング ---
-token_counts_filtered = [count for count in token_counts if count <= filter_token_limit]
-
-if token_counts_filtered:
-    # --- 設定値以下の統計値の計算 ---
-    sum_tokens_filtered = sum(token_counts_filtered)
-    avg_tokens_filtered = sum_tokens_filtered / len(token_counts_filtered)
-    max_tokens_filtered = max(token_counts_filtered)
-    min_tokens_filtered = min(token_counts_filtered)
-    
-    print(f"\n{filter_token_limit}トークン以下のデータ統計:")
-    print(f"対象行数: {len(token_counts_filtered)}")
-    print(f"総トークン数: {sum_tokens_filtered}")
-    print(f"平均トークン数: {avg_tokens_filtered}")
-    print(f"最大トークン数: {max_tokens_filtered}")
-    print(f"最小トークン数: {min_tokens_filtered}")
-    
-    # --- ヒストグラムプロット2: 設定値以下のデータ ---
+        title_token_counts[title] += token_count
+        token_counts.append(token_count)  # 全体の統計用に追加
+    return token_counts, title_token_counts
+
+
+def token_count_cache_path(jsonl_file, cache_dir):
+    """
+    トークン数のキャッシュファイルのパス（入力ファイルのパス・サイズ・更新時刻とモデル名から決まる）
+    入力ファイルやモデルが変わった場合は別のパスになるため、古いキャッシュは使用されない。
+    """
+    fingerprint = input_fingerprint(jsonl_file, model_name=MODEL_NAME, cache_format=CACHE_FORMAT)
+    base = splitext_jsonl(os.path.basename(jsonl_file))[0]
+    return os.path.join(cache_dir, f"{base}.{fingerprint[:16]}.npz")
+
+
+def pack_titles(titles):
+    """
+    タイトルを UTF-8 で連結したバイト列（uint8 の配列）と各タイトルの終了位置の配列に変換する
+    （固定長の Unicode 配列は全要素が最長のタイトルの長さで確保されるため、キャッシュにはこの形式で保存する）
+    """
+    encoded = [title.encode('utf-8') if isinstance(title, str) else str(title).encode('utf-8') for title in titles]
+    ends = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), ends
+
+
+def unpack_titles(title_bytes, title_ends):
+    """pack_titles で変換したタイトルをリストに戻す"""
+    buffer = title_bytes.tobytes()
+    starts = itertools.chain([0], title_ends[:-1].tolist())
+    return [buffer[start:end].decode('utf-8') for start, end in zip(starts, title_ends.tolist())]
+
+
+def load_token_counts(jsonl_file, cache_dir=None, aggregator=None):
+    """
+    ファイルの各エントリのトークン数とタイトルを返す
+    Arrow / Parquet の token_count 列 → カタログ（catalog.py） → cache_dir のキャッシュ → トークン化 の順に使用し、
+    トークン化した場合は cache_dir にトークン数とタイトルを保存する（次回以降はトークン化しない）。
+    トークン化する場合は AGGREGATE_BATCH_SIZE 件ずつ読み込み、テキストはバッチの処理後に破棄する。
+    aggregator: 指定された場合、エントリをプログラムごとに集計する（ProgramAggregator）。トークン化する場合は
+        読み込んだバッチごとに加算し、キャッシュに保存しない場合はタイトルを保持しない（titles は None）
+    戻り値: (token_counts: int64 の numpy 配列, titles: リスト or None)
+    """
+    cached = load_cached_token_counts(jsonl_file)
+    if cached is not None:
+        token_counts, titles = cached
+        print(f"計算済みのトークン数（token_count 列）を使用します: {jsonl_file}")
+        token_counts = np.asarray(token_counts, dtype=COUNT_DTYPE)
+        if aggregator is not None:
+            aggregate_programs(aggregator, jsonl_file, token_counts, titles)
+        return token_counts, titles
+
+    from catalog import open_catalog
+    catalog = open_catalog()
+    if catalog is not None:
+        with catalog:
+            cataloged = catalog.token_counts(jsonl_file, MODEL_NAME)
+        if cataloged is not None and None not in cataloged[0]:
+            print(f"カタログのトークン数を使用します: {catalog.path}")
+            count("catalog_hits")
+            token_counts, titles = np.asarray(cataloged[0], dtype=COUNT_DTYPE), cataloged[1]
+            if aggregator is not None:
+                aggregate_programs(aggregator, jsonl_file, token_counts, titles)
+            return token_counts, titles
+
+    cache_path = token_count_cache_path(jsonl_file, cache_dir) if cache_dir else None
+    if cache_path is not None and os.path.exists(cache_path):
+        with timer("read_cache"), np.load(cache_path) as data:
+            token_counts = data["token_counts"]
+            titles = unpack_titles(data["title_bytes"], data["title_ends"])
+        print(f"キャッシュしたトークン数を使用します: {cache_path}")
+        count("cache_hits")
+        if aggregator is not None:
+            aggregate_programs(aggregator, jsonl_file, token_counts, titles)
+        return token_counts, titles
+
+    # --- トークナイザーを取得（tokenizer_backend.py を参照） ---
+    tokenizer = get_tokenizer(MODEL_NAME)
+    # Arrow / Parquet は base_name 列で集計するため、トークン化の後にまとめて集計する
+    stream_programs = aggregator is not None and not is_arrow_file(jsonl_file)
+    keep_titles = cache_path is not None or not stream_programs
+    batch_counts = []
+    titles = [] if keep_titles else None
+    for batch_titles, batch_texts in iter_title_text_batches(jsonl_file):
+        counts = np.fromiter(iter_token_counts(tokenizer, batch_texts, add_special_tokens=False),
+                             dtype=COUNT_DTYPE, count=len(batch_texts))
+        batch_counts.append(counts)
+        if keep_titles:
+            titles.extend(batch_titles)
+        if stream_programs:
+            with timer("aggregate"):
+                aggregator.add_titles(batch_titles, counts)
+    token_counts = np.concatenate(batch_counts) if batch_counts else np.zeros(0, dtype=COUNT_DTYPE)
+    if aggregator is not None and not stream_programs:
+        aggregate_programs(aggregator, jsonl_file, token_counts, titles)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # タイトルは UTF-8 のバイト列と終了位置の配列として保存する（pickle を使用せずに読み込める）
+        title_bytes, title_ends = pack_titles(titles)
+        with timer("write_cache"):
+            np.savez(cache_path, token_counts=token_counts, title_bytes=title_bytes, title_ends=title_ends)
+    return token_counts, titles
+
+
+def sum_by_title(token_counts, titles):
+    title_token_counts = {}
+    for title, count in zip(titles, token_counts):
+        title_token_counts[title] = title_token_counts.get(title, 0) + count
+    return title_token_counts
+
+
+def write_title_token_counts(title_token_counts, output_dir):
+    """タイトルごとのトークン数をトークン数の多い順に出力"""
+    output_file = os.path.join(output_dir, 'title_token_counts.txt')
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write("タイトルごとの総トークン数\n")
+        f.write("=" * 30 + "\n\n")
+        for title, count in sorted(title_token_counts.items(), key=lambda item: (-item[1], item[0])):
+            f.write(f"{title}: {count}トークン\n")
+
+    print(f"タイトルごとの総トークン数を保存しました: {output_file}")
+
+
+class ProgramAggregator:
+    """
+    タイトルから抽出したプログラム名（merge_jsonl_by_title.py の extract_program_name で末尾の _partN と
+    _block_N を除いたもの）ごとに、エントリ数・トークン数・エントリの最大トークン数を集計する。
+
+    ベース名は初めて出現した順の整数コードに変換し、集計値はコードを添字とする numpy 配列に
+    バッチごとに np.bincount で加算する。タイトルの文字列はバッチの処理後に破棄するため、
+    メモリ使用量はエントリ数ではなくプログラム数に比例する。
+    """
+
+    def __init__(self):
+        self.codes = {}  # ベース名 → 整数コード
+        self.names = []
+        self.num_entries = np.zeros(0, dtype=COUNT_DTYPE)
+        self.num_tokens = np.zeros(0, dtype=COUNT_DTYPE)
+        self.max_tokens = np.zeros(0, dtype=COUNT_DTYPE)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def add_titles(self, titles, token_counts):
+        """タイトルとトークン数のバッチを加算する"""
+        self.add_names([extract_program_name(title) for title in titles], token_counts)
+
+    def add_names(self, base_names, token_counts):
+        """ベース名とトークン数のバッチを加算する"""
+        codes = np.fromiter((self._code(name) for name in base_names), dtype=np.int64, count=len(base_names))
+        self._add_codes(codes, token_counts)
+
+    def add_encoded(self, dictionary, indices, token_counts):
+        """辞書エンコードしたベース名（dictionary[indices[i]] が i 番目のベース名）とトークン数のバッチを加算する"""
+        mapping = np.fromiter((self._code(name) for name in dictionary), dtype=np.int64, count=len(dictionary))
+        self._add_codes(mapping[np.asarray(indices, dtype=np.int64)], token_counts)
+
+    def _add_codes(self, codes, token_counts):
+        token_counts = np.asarray(token_counts, dtype=COUNT_DTYPE)
+        size = len(self.names)
+        if len(self.num_entries) < size:
+            grow = size - len(self.num_entries)
+            self.num_entries = np.concatenate([self.num_entries, np.zeros(grow, dtype=COUNT_DTYPE)])
+            self.num_tokens = np.concatenate([self.num_tokens, np.zeros(grow, dtype=COUNT_DTYPE)])
+            self.max_tokens = np.concatenate([self.max_tokens, np.zeros(grow, dtype=COUNT_DTYPE)])
+        self.num_entries += np.bincount(codes, minlength=size)
+        self.num_tokens += np.bincount(codes, weights=token_counts, minlength=size).astype(COUNT_DTYPE)
+        np.maximum.at(self.max_tokens, codes, token_counts)
+
+    def order(self, k=None):
+        """トークン数の多い順（同じ場合はベース名の順）のコード。k を指定した場合は上位 k 件のみ"""
+        n = len(self.names)
+        if k is not None and k < n:
+            # 上位 k 件の候補（k 番目と同じトークン数のものを含む）のみを並べ替える
+            threshold = np.partition(self.num_tokens, n - k)[n - k]
+            candidates = np.flatnonzero(self.num_tokens >= threshold)
+        else:
+            candidates = np.arange(n)
+        ranked = sorted(candidates.tolist(), key=lambda code: (-int(self.num_tokens[code]), self.names[code]))
+        return ranked[:k] if k is not None else ranked
+
+    def rows(self, k=None):
+        """(ベース名, エントリ数, トークン数, エントリの最大トークン数) のリスト（order の順）"""
+        return [(self.names[code], int(self.num_entries[code]), int(self.num_tokens[code]), int(self.max_tokens[code]))
+                for code in self.order(k)]
+
+
+def aggregate_programs(aggregator, jsonl_file, token_counts, titles):
+    """ファイルのエントリをプログラムごとに集計する"""
+    with timer("aggregate"):
+        if is_arrow_file(jsonl_file):
+            # Arrow / Parquet は変換時に抽出した base_name 列を辞書エンコードして使用する（タイトルを解析しない）
+            # base_name は _block_N のみを除いたもので末尾の _partN が残るため、辞書の値（プログラムの数だけ）から除く
+            from arrow_io import read_table
+            column = read_table(jsonl_file, columns=["base_name"]).column("base_name")
+            offset = 0
+            for chunk in column.chunks:
+                encoded = chunk.fill_null("").dictionary_encode()
+                aggregator.add_encoded([extract_program_name(name) for name in encoded.dictionary.to_pylist()],
+                                       encoded.indices.to_numpy(zero_copy_only=False),
+                                       token_counts[offset:offset + len(chunk)])
+                offset += len(chunk)
+        else:
+            for start in range(0, len(titles), AGGREGATE_BATCH_SIZE):
+                aggregator.add_titles(titles[start:start + AGGREGATE_BATCH_SIZE],
+                                      token_counts[start:start + AGGREGATE_BATCH_SIZE])
+
+
+def write_program_report(aggregator, output_dir, top_k=50, export_format="csv"):
+    """
+    プログラムごとの集計結果を出力する
+    - program_token_counts_top<K>.txt: トークン数の多い上位 K 件のプログラム
+    - program_token_counts.csv / .parquet: すべてのプログラムの集計値（トークン数の多い順）
+    """
+    print(f"\nプログラム数: {len(aggregator)}")
+    top_rows = aggregator.rows(top_k)
+    top_file = os.path.join(output_dir, f'program_token_counts_top{top_k}.txt')
+    with open(top_file, 'w', encoding='utf-8') as f:
+        f.write(f"総トークン数の多いプログラム（上位{top_k}件）\n")
+        f.write("=" * 30 + "\n\n")
+        for rank, (name, num_entries, num_tokens, max_tokens) in enumerate(top_rows, 1):
+            line = f"{rank}. {name}: {num_tokens}トークン（{num_entries}エントリ、最大{max_tokens}トークン）"
+            f.write(line + "\n")
+            if rank <= 10:
+                print(line)
+    print(f"上位{top_k}件のプログラムを保存しました: {top_file}")
+
+    rows = aggregator.rows()
+    header = ["program", "num_entries", "num_tokens", "max_entry_tokens"]
+    if export_format == "parquet":
+        from arrow_io import write_columns
+        export_file = os.path.join(output_dir, 'program_token_counts.parquet')
+        write_columns(export_file, {key: [row[i] for row in rows] for i, key in enumerate(header)})
+    elif export_format == "csv":
+        export_file = os.path.join(output_dir, 'program_token_counts.csv')
+        with open(export_file, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+    else:
+        raise ValueError(f"不明な出力形式です: {export_format}")
+    print(f"プログラムごとの総トークン数を保存しました: {export_file}")
+
+
+def compute_stats(token_counts, token_limits=(), percentiles=(50, 90, 99)):
+    """
+    トークン数の統計値を計算する（ソートと累積和を1回ずつ行い、各上限値の集計は二分探索で求める）
+
+    戻り値: {"num_entries", "sum", "mean", "std", "min", "max", "percentiles": {"p50": ...},
+             "limits": {"8192": {"num_entries", "ratio", "sum", "mean", "min", "max", "num_exceeding"}, ...}}
+    """
+    token_counts = np.asarray(token_counts, dtype=COUNT_DTYPE)
+    n = len(token_counts)
+    stats = {"num_entries": n, "sum": 0, "mean": 0.0, "std": 0.0, "min": 0, "max": 0, "percentiles": {}, "limits": {}}
+    if n == 0:
+        for limit in token_limits:
+            stats["limits"][str(limit)] = {"num_entries": 0, "ratio": 0.0, "sum": 0, "mean": 0.0, "min": 0, "max": 0,
+                                           "num_exceeding": 0}
+        return stats
+
+    sorted_counts = np.sort(token_counts)
+    cumsum = np.cumsum(sorted_counts)
+    stats.update({
+        "sum": int(cumsum[-1]),
+        "mean": float(cumsum[-1] / n),
+        "std": float(sorted_counts.std()),
+        "min": int(sorted_counts[0]),
+        "max": int(sorted_counts[-1]),
+    })
+    if len(percentiles):
+        values = np.percentile(sorted_counts, percentiles)
+        stats["percentiles"] = {f"p{p:g}": float(value) for p, value in zip(percentiles, values)}
+
+    # 各上限値以下のエントリ数（ソート済みの配列での位置）
+    positions = np.searchsorted(sorted_counts, np.asarray(token_limits, dtype=COUNT_DTYPE), side='right')
+    for limit, k in zip(token_limits, positions.tolist()):
+        stats["limits"][str(limit)] = {
+            "num_entries": k,
+            "ratio": k / n,
+            "sum": int(cumsum[k - 1]) if k else 0,
+            "mean": float(cumsum[k - 1] / k) if k else 0.0,
+            "min": int(sorted_counts[0]) if k else 0,
+            "max": int(sorted_counts[k - 1]) if k else 0,
+            "num_exceeding": n - k,
+        }
+    return stats
+
+
+def print_stats(stats):
+    print(f"総行数:{stats['num_entries']}")
+    print(f"総トークン数: {stats['sum']}")
+    print(f"平均トークン数: {stats['mean']}")
+    print(f"最大トークン数: {stats['max']}")
+    print(f"最小トークン数: {stats['min']}")
+    if stats["percentiles"]:
+        print("パーセンタイル: " + ", ".join(f"{name}={value:.0f}" for name, value in stats["percentiles"].items()))
+    for limit, limit_stats in stats["limits"].items():
+        print(f"{limit}トークン以下: {limit_stats['num_entries']}行 ({limit_stats['ratio'] * 100:.2f}%)、"
+              f"超過: {limit_stats['num_exceeding']}行")
+
+
+def histogram(token_counts, bins=50, value_range=None):
+    """ヒストグラムの度数と区間の境界（np.histogram）"""
+    token_counts = np.asarray(token_counts, dtype=COUNT_DTYPE)
+    if value_range is None and len(token_counts) == 0:
+        value_range = (0, 1)
+    return np.histogram(token_counts, bins=bins, range=value_range)
+
+
+def plot_histogram(token_counts, title, color, plot_path):
+    with timer("plot"):
+        hist, edges = histogram(token_counts)
+        _plot_histograms([(None, hist, edges, color)], title, plot_path)
+
+
+def plot_overlay(named_token_counts, title, plot_path, bins=50):
+    """複数のファイルのトークン数の分布を、共通の区間で1つの図に重ねて表示する"""
+    with timer("plot"):
+        upper = max((int(counts.max()) for _, counts in named_token_counts if len(counts)), default=1)
+        colors = ['skyblue', 'lightgreen', 'salmon', 'orange', 'orchid', 'gold', 'turquoise', 'gray']
+        series = []
+        for i, (name, counts) in enumerate(named_token_counts):
+            hist, edges = histogram(counts, bins, (0, upper))
+            series.append((name, hist, edges, colors[i % len(colors)]))
+        _plot_histograms(series, title, plot_path)
+
+
+def _plot_histograms(series, title, plot_path):
+    """集計済みのヒストグラム（名前, 度数, 区間の境界, 色）のリストをプロットする"""
+    # matplotlib は読み込みに時間がかかるため、プロットするときに読み込む
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+
     fig, ax = plt.subplots(figsize=(10, 6))
-    bins = 50
-    ax.hist(token_counts_filtered, bins=bins, color='lightgreen', edgecolor='black')
-    ax.set_title(f'Token Count Distribution (≤{filter_token_limit} tokens)')
+    overlay = len(series) > 1
+    for name, hist, edges, color in series:
+        # 度数は計算済みのため、元のデータではなく区間ごとの度数を描画する
+        ax.stairs(hist, edges, fill=True, color=color, alpha=0.5 if overlay else 1.0, label=name)
+        if not overlay:
+            ax.stairs(hist, edges, color='black', linewidth=0.5)
+    ax.set_title(title)
     ax.set_xlabel('Token Count')
     ax.set_ylabel('Frequency')
     ax.grid(True)
-    
+    if overlay:
+        ax.legend()
+
     # --- x軸の目盛り設定 ---
+    # 1) 目盛りの最大数を10に制限 (必要に応じて変更)
     ax.xaxis.set_major_locator(ticker.MaxNLocator(10))
+
+    # 2) x軸ラベルを45度回転
     ax.tick_params(axis='x', rotation=45)
-    
-    # --- プロット画像の保存（設定値以下） ---
-    png_filename_filtered = os.path.splitext(input_filename)[0] + f"_filtered_{filter_token_limit}.png"
-    plot_path_filtered = os.path.join(output_dir, png_filename_filtered)
-    
-    plt.savefig(plot_path_filtered, bbox_inches='tight')
+
+    plt.savefig(plot_path, bbox_inches='tight')  # bbox_inches='tight' でラベル切れを防ぐ
     plt.close()
-    
-    print(f"{filter_token_limit}トークン以下のプロット結果を保存しました:", plot_path_filtered)
-else:
-    print(f"{filter_token_limit}トークン以下のデータが見つかりませんでした。")
+
+
+def write_stats(stats, output_path):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(stats, f, indent=4, ensure_ascii=False)
+    print(f"統計情報を保存しました: {output_path}")
+
+
+def report(jsonl_file, output_dir, filter_token_limit, token_counts, token_limits=(), percentiles=(50, 90, 99)):
+    token_counts = np.asarray(token_counts, dtype=COUNT_DTYPE)
+    # --- 統計値の計算（フィルタリング用の上限値も同時に集計する） ---
+    limits = sorted(set(token_limits) | {filter_token_limit})
+    with timer("stats"):
+        stats = compute_stats(token_counts, limits, percentiles)
+    print_stats(stats)
+
+    input_filename = os.path.basename(jsonl_file)
+    base = splitext_jsonl(input_filename)[0]
+    write_stats(stats, os.path.join(output_dir, base + "_stats.json"))
+
+    # --- ヒストグラムプロット1: 全体のデータ ---
+    png_filename_all = base + "_all.png"
+    plot_path_all = os.path.join(output_dir, png_filename_all)
+    plot_histogram(token_counts, 'Token Count Distribution (All Data)', 'skyblue', plot_path_all)
+
+    print("全体のプロット結果を保存しました:", plot_path_all)
+
+    # --- 設定値以下のデータ（統計値は compute_stats で計算済み） ---
+    filtered_stats = stats["limits"][str(filter_token_limit)]
+    if filtered_stats["num_entries"]:
+        print(f"\n{filter_token_limit}トークン以下のデータ統計:")
+        print(f"対象行数: {filtered_stats['num_entries']}")
+        print(f"総トークン数: {filtered_stats['sum']}")
+        print(f"平均トークン数: {filtered_stats['mean']}")
+        print(f"最大トークン数: {filtered_stats['max']}")
+        print(f"最小トークン数: {filtered_stats['min']}")
+
+        # --- ヒストグラムプロット2: 設定値以下のデータ ---
+        png_filename_filtered = base + f"_filtered_{filter_token_limit}.png"
+        plot_path_filtered = os.path.join(output_dir, png_filename_filtered)
+        plot_histogram(token_counts[token_counts <= filter_token_limit],
+                       f'Token Count Distribution (≤{filter_token_limit} tokens)', 'lightgreen', plot_path_filtered)
+
+        print(f"{filter_token_limit}トークン以下のプロット結果を保存しました:", plot_path_filtered)
+    else:
+        print(f"{filter_token_limit}トークン以下のデータが見つかりませんでした。")
+    return stats
+
+
+def validate_title_aggregation(title_aggregation):
+    if title_aggregation not in ("title", "program"):
+        raise ValueError(f"不明なタイトルの集計方法です: {title_aggregation}")
+
+
+def report_files(jsonl_files, output_dir, token_limits=(), percentiles=(50, 90, 99), cache_dir=None,
+                 report_name="token_count_report", title_aggregation="title", top_k=50, export_format="csv"):
+    """
+    複数のファイルのトークン数を1つのレポートにまとめる
+    ファイルごとと全体の統計値を <report_name>.json に、分布を重ねたヒストグラムを <report_name>.png に保存する。
+    title_aggregation: "title" の場合はタイトルごと、"program" の場合はすべてのファイルのプログラムごとに集計する
+    """
+    validate_title_aggregation(title_aggregation)
+    per_file = {}
+    named_token_counts = []
+    title_token_counts = {}
+    aggregator = ProgramAggregator() if title_aggregation == "program" else None
+    for jsonl_file in jsonl_files:
+        token_counts, titles = load_token_counts(jsonl_file, cache_dir, aggregator)
+        name = splitext_jsonl(os.path.basename(jsonl_file))[0]
+        with timer("stats"):
+            per_file[jsonl_file] = compute_stats(token_counts, token_limits, percentiles)
+        named_token_counts.append((name, token_counts))
+        if aggregator is None:
+            for title, title_count in sum_by_title(token_counts.tolist(), titles).items():
+                title_token_counts[title] = title_token_counts.get(title, 0) + title_count
+
+    with timer("stats"):
+        combined = compute_stats(np.concatenate([counts for _, counts in named_token_counts]), token_limits, percentiles)
+    print(f"{len(jsonl_files)} ファイルの合計:")
+    print_stats(combined)
+
+    if aggregator is not None:
+        write_program_report(aggregator, output_dir, top_k, export_format)
+    else:
+        write_title_token_counts(title_token_counts, output_dir)
+    write_stats({"files": per_file, "combined": combined}, os.path.join(output_dir, report_name + ".json"))
+    plot_path = os.path.join(output_dir, report_name + ".png")
+    plot_overlay(named_token_counts, 'Token Count Distribution', plot_path)
+    print("分布を重ねたプロット結果を保存しました:", plot_path)
+    return per_file, combined
+
+
+def _frequency_group(entry, group_by):
+    """バイト数・トークン数を集計するグループ（title / category / program）"""
+    title = entry.get("title", "不明")
+    if group_by == "category":
+        from catalog import entry_category
+        return entry_category(entry) or "不明"
+    if group_by == "program":
+        return extract_program_name(title) if isinstance(title, str) else "不明"
+    return title
+
+
+def _iter_part_records(path, part):
+    """map_ranges の範囲 part のエントリ（Arrow / Parquet は part=None でファイル全体）"""
+    if part is None:
+        yield from iter_records(path)
+        return
+    for line in iter_range_lines(path, part):
+        yield json.loads(bytes(line))
+
+
+def count_token_frequency(path, part, model_name, group_by="category", kana_fertility=False):
+    """
+    範囲 part のエントリのトークンIDの頻度（語彙サイズの np.bincount）と、グループごとのバイト数・トークン数を集計する
+    ワーカーごとに配列を作り、map_ranges の呼び出し元で合計する。
+    kana_fertility=True の場合、半角カタカナを含むテキストは convert_kana.py と同じ変換後のトークン数も数える。
+
+    戻り値: (frequency, groups, kana)
+        frequency: トークンIDごとの出現回数（int64 の配列）
+        groups: {グループ: [エントリ数, バイト数, 文字数, トークン数]}
+        kana: [変換されたエントリ数, 変換前の文字数, 変換前のトークン数, 変換後の文字数, 変換後のトークン数]
+    """
+    tokenizer = get_tokenizer(model_name)
+    frequency = np.zeros(len(tokenizer), dtype=COUNT_DTYPE)
+    groups = {}
+    kana = [0, 0, 0, 0, 0]
+    if kana_fertility:
+        import jaconv
+
+    for batch in iter_chunks(_iter_part_records(path, part), FREQUENCY_BATCH_SIZE):
+        texts = [entry.get("text", "") for entry in batch]
+        ids_list = tokenize_batched(tokenizer, texts, add_special_tokens=False)["input_ids"]
+        lengths = [len(ids) for ids in ids_list]
+        with timer("bincount"):
+            ids = np.fromiter(itertools.chain.from_iterable(ids_list), dtype=np.int64, count=sum(lengths))
+            counts = np.bincount(ids, minlength=len(frequency))
+            if len(counts) > len(frequency):
+                frequency = np.concatenate([frequency, np.zeros(len(counts) - len(frequency), dtype=COUNT_DTYPE)])
+            frequency += counts
+        for entry, text, num_tokens in zip(batch, texts, lengths):
+            stats = groups.setdefault(_frequency_group(entry, group_by), [0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += len(text.encode('utf-8'))
+            stats[2] += len(text)
+            stats[3] += num_tokens
+
+        if kana_fertility:
+            changed = []
+            for text, num_tokens in zip(texts, lengths):
+                converted = jaconv.hankaku2zenkaku(text, kana=True, ascii=False, digit=False)
+                if converted != text:
+                    changed.append(converted)
+                    kana[0] += 1
+                    kana[1] += len(text)
+                    kana[2] += num_tokens
+                    kana[3] += len(converted)
+            kana[4] += sum(iter_token_counts(tokenizer, changed, add_special_tokens=False))
+    count("records", sum(stats[0] for stats in groups.values()))
+    return frequency, groups, kana
+
+
+def merge_token_frequency(results):
+    """count_token_frequency のワーカーごとの結果を合計する"""
+    size = max(len(frequency) for frequency, _, _ in results)
+    frequency = np.zeros(size, dtype=COUNT_DTYPE)
+    groups = {}
+    kana = [0, 0, 0, 0, 0]
+    for part_frequency, part_groups, part_kana in results:
+        frequency[:len(part_frequency)] += part_frequency
+        for group, stats in part_groups.items():
+            merged = groups.setdefault(group, [0, 0, 0, 0])
+            for i, value in enumerate(stats):
+                merged[i] += value
+        kana = [a + b for a, b in zip(kana, part_kana)]
+    return frequency, groups, kana
+
+
+def _ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+@measure_stage("token_frequency")
+def token_frequency_report(jsonl_files, output_dir, report_name, model_name=MODEL_NAME, top_n=100, group_by="category",
+                           kana_fertility=True, num_workers=None):
+    """
+    ファイルのトークンIDの頻度を集計し、<report_name>_token_frequency.json（上位 top_n 件のトークンとその文字列、
+    グループごとのバイト数/トークン数、半角カタカナの変換前後のトークン数）と頻度の配列 .npy を保存する
+    各ファイルを行の境界で分割してプロセスプールで並列にトークン化する。
+    """
+    if group_by not in ("title", "category", "program"):
+        raise ValueError(f"不明なグループの集計方法です: {group_by}")
+    func = partial(count_token_frequency, model_name=model_name, group_by=group_by, kana_fertility=kana_fertility)
+    results = []
+    for jsonl_file in jsonl_files:
+        print(f"トークンIDの頻度を集計します: {jsonl_file}")
+        if is_arrow_file(jsonl_file):
+            results.append(func(jsonl_file, None))
+        else:
+            results.extend(map_ranges(jsonl_file, func, num_workers))
+    frequency, groups, kana = merge_token_frequency(results)
+
+    tokenizer = get_tokenizer(model_name)
+    total_tokens = int(frequency.sum())
+    order = np.argsort(-frequency, kind="stable")[:top_n]
+    top_tokens = [
+        {"id": int(token_id), "count": int(frequency[token_id]), "share": _ratio(int(frequency[token_id]), total_tokens),
+         "text": tokenizer.decode([int(token_id)])}
+        for token_id in order if frequency[token_id]
+    ]
+    total_bytes = sum(stats[1] for stats in groups.values())
+    total_chars = sum(stats[2] for stats in groups.values())
+    result = {
+        "files": list(jsonl_files),
+        "model_name": model_name,
+        "totals": {
+            "entries": sum(stats[0] for stats in groups.values()),
+            "bytes": total_bytes,
+            "chars": total_chars,
+            "tokens": total_tokens,
+            "bytes_per_token": _ratio(total_bytes, total_tokens),
+            "tokens_per_char": _ratio(total_tokens, total_chars),
+            "distinct_tokens": int(np.count_nonzero(frequency)),
+            "vocab_size": len(frequency)
+        },
+        "top_tokens": top_tokens,
+        "group_by": group_by,
+        "groups": [
+            {"group": group, "entries": stats[0], "bytes": stats[1], "chars": stats[2], "tokens": stats[3],
+             "bytes_per_token": _ratio(stats[1], stats[3]), "tokens_per_char": _ratio(stats[3], stats[2])}
+            for group, stats in sorted(groups.items(), key=lambda item: (-item[1][3], item[0]))
+        ]
+    }
+    if kana_fertility:
+        result["kana_fertility"] = {
+            "entries_converted": kana[0],
+            "chars_before": kana[1],
+            "tokens_before": kana[2],
+            "chars_after": kana[3],
+            "tokens_after": kana[4],
+            "tokens_per_char_before": _ratio(kana[2], kana[1]),
+            "tokens_per_char_after": _ratio(kana[4], kana[3]),
+            "token_ratio": _ratio(kana[4], kana[2])
+        }
+
+    os.makedirs(output_dir, exist_ok=True)
+    json_path = os.path.join(output_dir, f"{report_name}_token_frequency.json")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=4, ensure_ascii=False)
+    np.save(os.path.join(output_dir, f"{report_name}_token_frequency.npy"), frequency)
+
+    print(f"総トークン数: {total_tokens}（使用されたトークンID: {result['totals']['distinct_tokens']} / {len(frequency)}）")
+    print(f"バイト数/トークン数: {result['totals']['bytes_per_token']}")
+    print("出現回数の多いトークン:")
+    for token in top_tokens[:20]:
+        print(f"  {token['id']:>7} {token['count']:>12} {token['text']!r}")
+    if kana_fertility:
+        fertility = result["kana_fertility"]
+        print(f"半角カタカナの変換: {fertility['entries_converted']} エントリ、"
+              f"トークン数 {fertility['tokens_before']} → {fertility['tokens_after']}（{fertility['token_ratio']} 倍）")
+    print(f"トークンIDの頻度を保存しました: {json_path}")
+    return result
+
+
+def _metrics_file(args):
+    """メトリクスはプロットと同じディレクトリに <入力ファイル名>_metrics.json として保存する"""
+    if COUNT_TOKENS_CONFIG.get("jsonl_files"):
+        base = COUNT_TOKENS_CONFIG.get("report_name", "token_count_report")
+    else:
+        base = splitext_jsonl(os.path.basename(COUNT_TOKENS_CONFIG["jsonl_file"]))[0]
+    return os.path.join(COUNT_TOKENS_CONFIG["output_dir"], base + "_metrics.json")
+
+
+@measure_stage("count_tokens", _metrics_file)
+def main():
+    # --- ファイルパスの設定 ---
+    jsonl_file = COUNT_TOKENS_CONFIG["jsonl_file"]
+    output_dir = COUNT_TOKENS_CONFIG["output_dir"]
+    filter_token_limit = COUNT_TOKENS_CONFIG["filter_token_limit"]
+    token_limits = COUNT_TOKENS_CONFIG.get("token_limits", [])
+    percentiles = COUNT_TOKENS_CONFIG.get("percentiles", [50, 90, 99])
+    cache_dir = COUNT_TOKENS_CONFIG.get("cache_dir")
+    title_aggregation = COUNT_TOKENS_CONFIG.get("title_aggregation", "title")
+    top_k = COUNT_TOKENS_CONFIG.get("top_k", 50)
+    export_format = COUNT_TOKENS_CONFIG.get("export_format", "csv")
+    validate_title_aggregation(title_aggregation)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # --- 複数のファイルを指定した場合は1つのレポートにまとめる ---
+    jsonl_files = COUNT_TOKENS_CONFIG.get("jsonl_files")
+    if COUNT_TOKENS_CONFIG.get("token_frequency", False):
+        files = jsonl_files or [jsonl_file]
+        report_name = COUNT_TOKENS_CONFIG.get("report_name", "token_count_report") if jsonl_files \
+            else splitext_jsonl(os.path.basename(jsonl_file))[0]
+        token_frequency_report(files, output_dir, report_name, MODEL_NAME, COUNT_TOKENS_CONFIG.get("frequency_top_n", 100),
+                               COUNT_TOKENS_CONFIG.get("frequency_group_by", "category"),
+                               COUNT_TOKENS_CONFIG.get("kana_fertility", True), COUNT_TOKENS_CONFIG.get("num_workers"))
+        return
+    if jsonl_files:
+        report_files(jsonl_files, output_dir, token_limits, percentiles, cache_dir,
+                     COUNT_TOKENS_CONFIG.get("report_name", "token_count_report"), title_aggregation, top_k, export_format)
+        return
+
+    # --- 計算済みのトークン数（token_count 列・キャッシュ）がない場合のみトークン化する ---
+    # --- タイトルごと、またはタイトルから抽出したプログラムごと（読み込みながら）に集計する ---
+    aggregator = ProgramAggregator() if title_aggregation == "program" else None
+    token_counts, titles = load_token_counts(jsonl_file, cache_dir, aggregator)
+    if aggregator is not None:
+        write_program_report(aggregator, output_dir, top_k, export_format)
+    else:
+        write_title_token_counts(sum_by_title(token_counts.tolist(), titles), output_dir)
+    report(jsonl_file, output_dir, filter_token_limit, token_counts, token_limits, percentiles)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,39 @@
-import json
 import random
 import os
-from transformers import AutoTokenizer
-from config import GENERATE_SAMPLE_JSONL_CONFIG
+from config import GENERATE_SAMPLE_JSONL_CONFIG, CATALOG_CONFIG, MODEL_NAME
+from jsonl_io import iter_records, write_records
+from tokenizer_backend import get_tokenizer
+from batching import tokenize_batched
+from catalog import open_catalog, read_entries
+
+SAMPLE_MODEL_NAME = "Qwen/Qwen2.5-Coder-32B-Instruct"
+
+def sample_from_catalog(input_filename, num_samples):
+    """
+    CATALOG_CONFIG の enabled が True で入力ファイルが CATALOG_CONFIG の model_name のトークン数とともにカタログに登録済みの場合、
+    無作為に num_samples 件を抽出して (エントリのリスト, トークン数のリスト) を返す（それ以外は理由を表示して None）
+    カタログのトークン数は MODEL_NAME（Qwen2.5 の14B）で記録されるが、SAMPLE_MODEL_NAME とトークナイザーが同じため、そのまま使用する。
+    """
+    if not CATALOG_CONFIG.get("enabled", False):
+        return None
+    model_name = CATALOG_CONFIG.get("model_name", MODEL_NAME)
+    if model_name is None:
+        print("カタログにトークン数が記録されていないため（CATALOG_CONFIG の model_name が None）、入力ファイル全体を読み込みます")
+        return None
+    catalog = open_catalog()
+    if catalog is None:
+        print(f"カタログが見つからないため、入力ファイル全体を読み込みます: {CATALOG_CONFIG['path']}")
+        return None
+    with catalog:
+        rows = catalog.sample(input_filename, num_samples, model_name)
+    if rows is None:
+        print(f"入力ファイルが {model_name} のトークン数とともにカタログに登録されていない（または登録後に変更された）ため、"
+              f"入力ファイル全体を読み込みます: {input_filename}")
+        return None
+    print(f"カタログから抽出します: {catalog.path}")
+    if len(rows) < num_samples:
+        print(f"警告: 入力ファイルには {len(rows)} 件しかなく、{num_samples} 件に満たないため、全件を使用します。")
+    return read_entries(input_filename, rows), [row["token_count"] for row in rows]
 
 def main():
     # 設定ファイルから値を読み込む
@@ -21,20 +52,27 @@ def main():
     output_file_path = os.path.join(output_folder, output_filename)
 
     # Qwen/Qwen2.5-Coder-32B の tokenizer をロード
-    tokenizer = AutoTokenizer.from_pretrained("Qwen/Qwen2.5-Coder-32B-Instruct", use_fast=True)
+    tokenizer = get_tokenizer(SAMPLE_MODEL_NAME)
+
+    # カタログに登録済みの場合は、抽出したエントリのみを読み込み、max_tokens を超えるエントリのみをトークン化する
+    sampled = sample_from_catalog(input_filename, num_samples)
+    if sampled is not None:
+        sampled_data, token_counts = sampled
+        cut_count = 0
+        for entry, token_count in zip(sampled_data, token_counts):
+            if "text" in entry and token_count > max_tokens:
+                tokens = tokenizer(entry["text"])["input_ids"]
+                entry["text"] = tokenizer.decode(tokens[:max_tokens], skip_special_tokens=True)
+                cut_count += 1
+        write_records(output_file_path, sampled_data)
+        print(f"カットされたエントリ数: {cut_count}")
+        print(f"出力ファイルのパス: {output_file_path}")
+        return
 
     # 入力ファイルから全エントリを読み込む
-    data = []
-    with open(input_filename, "r", encoding="utf-8") as infile:
-        for line in infile:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                entry = json.loads(line)
-                data.append(entry)
-            except json.JSONDecodeError as e:
-                print(f"JSONのパースに失敗しました: {e}")
+    def on_error(line_num, e):
+        print(f"JSONのパースに失敗しました: {e}")
+    data = list(iter_records(input_filename, on_error=on_error))
 
     # エントリ数が足りなければ全件使用、足りる場合は無作為に num_samples 件を抽出
     if len(data) < num_samples:
@@ -44,20 +82,18 @@ def main():
         sampled_data = random.sample(data, num_samples)
 
     # 各エントリの "text" フィールドをチェックし、トークン数が32700を超えている場合は切り詰める
+    # トークン化は長さ順・文字数の予算ごとのバッチでまとめて行う（batching.py）
+    entries = [entry for entry in sampled_data if "text" in entry]
+    tokenized = tokenize_batched(tokenizer, [entry["text"] for entry in entries])
     cut_count = 0
-    for entry in sampled_data:
-        if "text" in entry:
-            tokens = tokenizer.encode(entry["text"])
-            if len(tokens) > max_tokens:
-                truncated_tokens = tokens[:max_tokens]
-                entry["text"] = tokenizer.decode(truncated_tokens, skip_special_tokens=True)
-                cut_count += 1
+    for entry, tokens in zip(entries, tokenized["input_ids"]):
+        if len(tokens) > max_tokens:
+            truncated_tokens = tokens[:max_tokens]
+            entry["text"] = tokenizer.decode(truncated_tokens, skip_special_tokens=True)
+            cut_count += 1
 
     # 新しい JSONL ファイルとして指定したフォルダに保存
-    with open(output_file_path, "w", encoding="utf-8") as outfile:
-        for entry in sampled_data:
-            json_line = json.dumps(entry, ensure_ascii=False)
-            outfile.write(json_line + "\n")
+    write_records(output_file_path, sampled_data)
 
     print(f"カットされたエントリ数: {cut_count}")
     print(f"出力ファイルのパス: {output_file_path}")
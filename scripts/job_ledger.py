@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+複数のマシンでジョブ（シャード・ディレクトリ）を分担して処理するための、共有ストレージ上のジョブ台帳
+
+worker_index / num_workers による分担は担当をシャードの番号で固定するため、処理の遅いマシンや
+途中で停止したマシンの担当分が最後まで残ります。JobLedger は出力ディレクトリの SQLite ファイルに
+ジョブを登録し、各ワーカーは空いたときに1件ずつリース（期限付きの担当）を取得して処理します。
+
+    1. 各ワーカーは起動時にすべてのジョブを登録します（登録済みのジョブはキーが変わった場合のみ未処理に戻す）。
+    2. claim() で未処理のジョブ、またはリースの期限が切れたジョブをコストの大きい順に1件取得します。
+    3. 処理中はハートビートのスレッドが heartbeat_seconds ごとにリースを延長します。ワーカーが停止すると
+       リースが延長されなくなり、lease_seconds 後に他のワーカーが取得し直します（max_attempts 回まで）。
+    4. 結果は一時ファイルに書き込んでからリネームし、その後に complete() で完了を記録します。
+    5. 取得できるジョブがなく他のワーカーが処理中の場合は、すべて完了するまで待ちます
+       （処理中のワーカーが停止した場合にジョブを引き継ぐため）。
+
+    ledger = JobLedger(os.path.join(output_dir, LEDGER_FILE))
+    ledger.register({name: (key, cost) for ...})
+    while True:
+        name = ledger.claim(worker_id)  # すべて完了した場合は None
+        if name is None:
+            break
+        with ledger.lease(name, worker_id):  # 正常に終了すると完了、例外の場合は未処理に戻す
+            process(name)
+
+SQLite のロックはファイルシステムのロック（fcntl）を使用するため、共有ストレージはロックに対応している必要があります
+（NFS は lock オプション付きでマウントする）。WAL モードは複数のマシンから使用できないため、既定のジャーナルを使用します。
+リースの期限は各マシンの時刻で判定するため、lease_seconds はマシン間の時刻のずれより十分に長くしてください。
+
+失敗したジョブ（max_attempts 回失敗したジョブ）はワーカーを起動し直しても処理せず、キーが変わった場合か、
+--reset-failed で明示的に未処理に戻した場合のみ処理し直します（起動したワーカーごとに失敗したジョブを
+処理し直すと、処理できないジョブを max_attempts 回ずつ繰り返すため）。
+
+使用方法（台帳の状態を表示）:
+    python scripts/job_ledger.py <出力ディレクトリ>
+使用方法（失敗したジョブを未処理に戻す）:
+    python scripts/job_ledger.py <出力ディレクトリ> --reset-failed
+
+設定:
+    config.pyのJOB_LEDGER_CONFIGで設定を変更可能
+"""
+
+import contextlib
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import JOB_LEDGER_CONFIG
+
+LEDGER_FILE = ".job_ledger.sqlite"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    cost REAL NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated REAL
+)
+"""
+
+
+def default_worker_id():
+    """ワーカーの識別子（設定されていない場合は ホスト名-PID）"""
+    return JOB_LEDGER_CONFIG.get("worker_id") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def ledger_enabled():
+    return JOB_LEDGER_CONFIG.get("enabled", False)
+
+
+class JobLedger:
+    """SQLite ファイルに記録したジョブのリースを取得・延長・完了する"""
+
+    def __init__(self, path, lease_seconds=None, heartbeat_seconds=None, poll_seconds=None, max_attempts=None):
+        self.path = str(path)
+        self.lease_seconds = lease_seconds or JOB_LEDGER_CONFIG["lease_seconds"]
+        self.heartbeat_seconds = heartbeat_seconds or JOB_LEDGER_CONFIG["heartbeat_seconds"]
+        self.poll_seconds = poll_seconds or JOB_LEDGER_CONFIG["poll_seconds"]
+        self.max_attempts = max_attempts or JOB_LEDGER_CONFIG["max_attempts"]
+        with self._transaction() as conn:
+            conn.execute(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """書き込みロックを取得したトランザクション（スレッドごとに接続を作るため、呼び出しごとに接続する）"""
+        conn = sqlite3.connect(self.path, timeout=JOB_LEDGER_CONFIG.get("busy_timeout", 60), isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        """台帳の書き込みロックを保持したまま処理する（全ワーカーで1回ずつ行う後処理の排他に使用する）"""
+        with self._transaction():
+            yield
+
+    def register(self, jobs, reset_failed=False):
+        """
+        ジョブを登録する
+        jobs: {ジョブ名: (キー, コスト)}。キーは入力と設定から決まる値で、登録済みのジョブのキーが
+            変わった場合は（完了済み・失敗でも）未処理に戻す。コストの大きいジョブから割り当てる。
+        reset_failed: True の場合はキーが変わっていない失敗したジョブも未処理に戻す
+            （False の場合は失敗のまま残す。各ワーカーの起動時に戻すと他のワーカーが失敗としたジョブを繰り返すため）
+        jobs にないジョブは台帳から削除する。
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            existing = dict(conn.execute("SELECT name, key FROM jobs"))
+            for name, (key, cost) in jobs.items():
+                if name not in existing:
+                    conn.execute("INSERT INTO jobs (name, key, cost, status, updated) VALUES (?, ?, ?, ?, ?)",
+                                 (name, key, cost, PENDING, now))
+                elif existing[name] != key:
+                    conn.execute("UPDATE jobs SET key = ?, cost = ?, status = ?, owner = NULL, lease_expires = NULL, "
+                                 "attempts = 0, updated = ? WHERE name = ?", (key, cost, PENDING, now, name))
+            if reset_failed:
+                self._reset_failed(conn, now)
+            removed = [name for name in existing if name not in jobs]
+            conn.executemany("DELETE FROM jobs WHERE name = ?", [(name,) for name in removed])
+
+    @staticmethod
+    def _reset_failed(conn, now):
+        return conn.execute("UPDATE jobs SET status = ?, owner = NULL, lease_expires = NULL, attempts = 0, updated = ? "
+                            "WHERE status = ?", (PENDING, now, FAILED)).rowcount
+
+    def reset_failed(self):
+        """失敗したジョブを未処理に戻し、戻したジョブ数を返す（原因を取り除いた後に処理し直す場合）"""
+        with self._transaction() as conn:
+            return self._reset_failed(conn, time.time())
+
+    def reset(self, names):
+        """完了済みのジョブを未処理に戻す（出力が失われた場合など）"""
+        with self._transaction() as conn:
+            conn.executemany("UPDATE jobs SET status = ?, owner = NULL, lease_expires = NULL, attempts = 0 "
+                             "WHERE name = ? AND status = ?", [(PENDING, name, DONE) for name in names])
+
+    def _try_claim(self, worker_id):
+        """(取得したジョブ名 or None, 未完了のジョブがあるか) を返す"""
+        now = time.time()
+        with self._transaction() as conn:
+            # 期限切れのリースのうち、試行回数を使い切ったジョブは失敗とする
+            conn.execute("UPDATE jobs SET status = ?, owner = NULL, updated = ? "
+                         "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                         (FAILED, now, RUNNING, now, self.max_attempts))
+            row = conn.execute("SELECT name FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                               "ORDER BY cost DESC, name LIMIT 1", (PENDING, RUNNING, now)).fetchone()
+            if row is None:
+                remaining = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (RUNNING,)).fetchone()[0]
+                return None, remaining > 0
+            conn.execute("UPDATE jobs SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                         "updated = ? WHERE name = ?", (RUNNING, worker_id, now + self.lease_seconds, now, row[0]))
+            return row[0], True
+
+    def claim(self, worker_id, wait=True):
+        """
+        未処理のジョブを1件取得して名前を返す（すべてのジョブが完了・失敗した場合は None）
+        wait=True の場合、他のワーカーが処理中のジョブが残っている間は poll_seconds ごとに取得し直す。
+        """
+        while True:
+            name, remaining = self._try_claim(worker_id)
+            if name is not None or not remaining or not wait:
+                return name
+            time.sleep(self.poll_seconds)
+
+    def heartbeat(self, name, worker_id):
+        """リースを延長する（他のワーカーに取得し直されていた場合は False）"""
+        with self._transaction() as conn:
+            cursor = conn.execute("UPDATE jobs SET lease_expires = ?, updated = ? "
+                                  "WHERE name = ? AND owner = ? AND status = ?",
+                                  (time.time() + self.lease_seconds, time.time(), name, worker_id, RUNNING))
+            return cursor.rowcount == 1
+
+    def complete(self, name, worker_id):
+        """
+        ジョブを完了とする（結果をコミットした後に呼ぶこと）
+        リースが失効して他のワーカーが処理している場合も、同じ入力から同じ結果が作られるため完了とする。
+        戻り値: 自分のリースのまま完了した場合は True
+        """
+        with self._transaction() as conn:
+            owner = conn.execute("SELECT owner FROM jobs WHERE name = ?", (name,)).fetchone()
+            conn.execute("UPDATE jobs SET status = ?, owner = ?, lease_expires = NULL, updated = ? WHERE name = ?",
+                         (DONE, worker_id, time.time(), name))
+            return owner is not None and owner[0] == worker_id
+
+    def release(self, name, worker_id):
+        """処理に失敗したジョブを未処理に戻す（試行回数を使い切った場合は失敗とする）"""
+        with self._transaction() as conn:
+            conn.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, owner = NULL, "
+                         "lease_expires = NULL, updated = ? WHERE name = ? AND owner = ? AND status = ?",
+                         (self.max_attempts, FAILED, PENDING, time.time(), name, worker_id, RUNNING))
+
+    @contextlib.contextmanager
+    def lease(self, name, worker_id):
+        """処理中はハートビートでリースを延長し、正常に終了した場合は完了、例外の場合は未処理に戻す"""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_seconds):
+                if not self.heartbeat(name, worker_id):
+                    print(f"警告: {name} のリースが失効しました（他のワーカーが処理し直す可能性があります）")
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        except BaseException:
+            stop.set()
+            thread.join()
+            self.release(name, worker_id)
+            raise
+        stop.set()
+        thread.join()
+        self.complete(name, worker_id)
+
+    def names(self, status):
+        conn = sqlite3.connect(self.path, timeout=JOB_LEDGER_CONFIG.get("busy_timeout", 60))
+        try:
+            return [row[0] for row in conn.execute("SELECT name FROM jobs WHERE status = ? ORDER BY name", (status,))]
+        finally:
+            conn.close()
+
+    def status(self):
+        """{状態: ジョブ数}"""
+        conn = sqlite3.connect(self.path, timeout=JOB_LEDGER_CONFIG.get("busy_timeout", 60))
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+        finally:
+            conn.close()
+
+
+def open_ledger(output_dir):
+    """出力ディレクトリの台帳を開く"""
+    os.makedirs(output_dir, exist_ok=True)
+    return JobLedger(os.path.join(output_dir, LEDGER_FILE))
+
+
+def main():
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != "--reset-failed"):
+        print("使用方法: python scripts/job_ledger.py <出力ディレクトリ> [--reset-failed]")
+        sys.exit(1)
+    path = os.path.join(sys.argv[1], LEDGER_FILE)
+    if not os.path.exists(path):
+        print(f"台帳が見つかりません: {path}")
+        sys.exit(1)
+    ledger = JobLedger(path)
+    if len(sys.argv) == 3:
+        print(f"失敗したジョブを未処理に戻しました: {ledger.reset_failed()}")
+    counts = ledger.status()
+    for status in (PENDING, RUNNING, DONE, FAILED):
+        print(f"{status}: {counts.get(status, 0)}")
+    for name in ledger.names(FAILED):
+        print(f"  失敗: {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,491 @@
+"""
+JSONLファイルの読み書きを行う共通モジュール
+
+拡張子が .jsonl.gz / .jsonl.zst のファイルは透過的に圧縮・展開します。
+圧縮・展開はバックグラウンドのスレッドで行うため、呼び出し側の処理（JSONのパースや
+トークン化）と並行して進みます。zstd は zstandard ライブラリ（オプション）を使用します。
+
+seekable=True で書き込むと、行の境界で区切った独立したフレーム（gzip はメンバー、
+zstd はフレーム）ごとに圧縮し、各フレームの位置を <ファイル名>.frames.json に保存します。
+フレーム単位で展開できるため、圧縮ファイルでも任意の位置から読み込んだり、
+フレーム単位で複数のワーカーに分割して処理したりできます。
+
+iter_records / RecordWriter は拡張子が .arrow / .parquet のファイルも扱います（arrow_io.py を参照）。
+各スクリプトはこれらを使うことで、JSONL と列指向形式のどちらでも入出力できます。
+"""
+
+import gzip
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import JSONL_IO_CONFIG
+
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+JSONL_SUFFIXES = (".jsonl", ".jsonl.gz", ".jsonl.zst")
+ARROW_SUFFIXES = (".arrow", ".parquet")
+FRAME_INDEX_SUFFIX = ".frames.json"
+
+# バックグラウンドスレッドとの間で受け渡すデータの単位とキューの長さ
+_CHUNK_SIZE = 1 << 20
+_QUEUE_SIZE = 8
+_SENTINEL = None
+
+
+def compression_of(path):
+    """拡張子から圧縮形式（"gzip" / "zstd" / None）を判定する"""
+    return COMPRESSION_SUFFIXES.get(os.path.splitext(str(path))[1])
+
+
+def is_jsonl_file(file_name):
+    """.jsonl / .jsonl.gz / .jsonl.zst のいずれかであれば True"""
+    return str(file_name).endswith(JSONL_SUFFIXES)
+
+
+def is_record_file(file_name):
+    """JSONL（圧縮を含む）または Arrow / Parquet ファイルであれば True"""
+    return str(file_name).endswith(JSONL_SUFFIXES + ARROW_SUFFIXES)
+
+
+def is_arrow_file(file_name):
+    return str(file_name).endswith(ARROW_SUFFIXES)
+
+
+def splitext_jsonl(file_name):
+    """
+    圧縮拡張子を含めて拡張子を分割する
+    例: "a.jsonl.zst" -> ("a", ".jsonl.zst"), "a.jsonl" -> ("a", ".jsonl"), "a.arrow" -> ("a", ".arrow")
+    """
+    file_name = str(file_name)
+    for suffix in sorted(JSONL_SUFFIXES + ARROW_SUFFIXES, key=len, reverse=True):
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)], suffix
+    return os.path.splitext(file_name)
+
+
+def frame_index_path(path):
+    return str(path) + FRAME_INDEX_SUFFIX
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd 圧縮ファイルを扱うには zstandard が必要です: pip install zstandard")
+    return zstandard
+
+
+def _frame_compress_func(kind, level, threads):
+    """1フレーム（独立して展開できる単位）を圧縮する関数を返す"""
+    if kind == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=level, mtime=0)
+    zstandard = _import_zstd()
+    # フレーム単位の並列化は呼び出し側で行うため、各フレームはシングルスレッドで圧縮する
+    local = threading.local()
+
+    def compress(data):
+        if not hasattr(local, "cctx"):
+            local.cctx = zstandard.ZstdCompressor(level=level)
+        return local.cctx.compress(data)
+    return compress
+
+
+def _stream_compressor(kind, level, threads):
+    """ストリーム全体を1つの圧縮ストリームとして圧縮するオブジェクト（compress / flush を持つ）を返す"""
+    if kind == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 31)
+    zstandard = _import_zstd()
+    return zstandard.ZstdCompressor(level=level, threads=threads).compressobj()
+
+
+class _CompressingWriter(io.RawIOBase):
+    """
+    書き込まれたバイト列をバックグラウンドスレッドで圧縮してファイルに書き込む。
+    seekable=True の場合は行境界でフレームに区切り、フレームをスレッドプールで並列に圧縮する。
+    """
+
+    def __init__(self, path, kind, level, threads, seekable, frame_size):
+        self.path = str(path)
+        self.kind = kind
+        self.seekable_frames = seekable
+        self.frame_size = frame_size
+        self.level = level
+        self.threads = threads
+        self.file = open(self.path, 'wb')
+        self.pending = bytearray()
+        self.queue = queue.Queue(maxsize=_QUEUE_SIZE)
+        self.error = None
+        self.finished = False
+        self.frames = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._check_error()
+        self.pending += data
+        if len(self.pending) >= _CHUNK_SIZE:
+            self.queue.put(bytes(self.pending))
+            self.pending.clear()
+        return len(data)
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        try:
+            if self.seekable_frames:
+                self._run_frames()
+            else:
+                self._run_stream()
+        except BaseException as e:
+            self.error = e
+            # 書き込み側がブロックしないように終了の合図までキューを空にする
+            while not self.finished and self.queue.get() is not _SENTINEL:
+                pass
+
+    def _next_chunk(self):
+        data = self.queue.get()
+        if data is _SENTINEL:
+            self.finished = True
+        return data
+
+    def _run_stream(self):
+        compressor = _stream_compressor(self.kind, self.level, self.threads)
+        while True:
+            data = self._next_chunk()
+            if data is _SENTINEL:
+                break
+            self.file.write(compressor.compress(data))
+        self.file.write(compressor.flush())
+
+    def _run_frames(self):
+        compress = _frame_compress_func(self.kind, self.level, self.threads)
+        max_workers = self.threads if self.threads and self.threads > 0 else os.cpu_count() or 1
+        in_flight = deque()
+        buffer = bytearray()
+        offsets = {"compressed": 0, "uncompressed": 0}
+
+        def write_done(block):
+            # 順序を保つため、先頭のフレームから順に書き込む
+            while in_flight and (block or in_flight[0][0].done()):
+                future, size, lines = in_flight.popleft()
+                compressed = future.result()
+                self.file.write(compressed)
+                self.frames.append([offsets["compressed"], len(compressed), offsets["uncompressed"], size, lines])
+                offsets["compressed"] += len(compressed)
+                offsets["uncompressed"] += size
+
+        def submit(frame):
+            while len(in_flight) >= max_workers * 2:
+                in_flight[0][0].result()
+                write_done(False)
+            in_flight.append((executor.submit(compress, frame), len(frame), frame.count(b'\n')))
+            write_done(False)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                data = self._next_chunk()
+                if data is _SENTINEL:
+                    break
+                buffer += data
+                while len(buffer) >= self.frame_size:
+                    # フレームは必ず行の境界で区切る（1行が frame_size を超える場合はその行全体を1フレームとする）
+                    cut = buffer.rfind(b'\n', 0, self.frame_size)
+                    if cut < 0:
+                        cut = buffer.find(b'\n', self.frame_size)
+                        if cut < 0:
+                            break
+                    submit(bytes(buffer[:cut + 1]))
+                    del buffer[:cut + 1]
+            if buffer:
+                submit(bytes(buffer))
+            write_done(True)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.pending:
+                self.queue.put(bytes(self.pending))
+                self.pending.clear()
+            self.queue.put(_SENTINEL)
+            self.thread.join()
+            self.file.close()
+            self._check_error()
+            if self.seekable_frames:
+                index = {"format": "jsonl-frames", "compression": self.kind, "frames": self.frames}
+                with open(frame_index_path(self.path), 'w', encoding='utf-8') as f:
+                    json.dump(index, f)
+            elif os.path.exists(frame_index_path(self.path)):
+                # 以前の書き込みで作られたフレームインデックスは無効になるため削除する
+                os.remove(frame_index_path(self.path))
+        finally:
+            super().close()
+
+
+class _DecompressingReader(io.RawIOBase):
+    """圧縮ファイルをバックグラウンドスレッドで展開しながら読み込む"""
+
+    def __init__(self, path, kind):
+        self.path = str(path)
+        self.kind = kind
+        self.queue = queue.Queue(maxsize=_QUEUE_SIZE)
+        self.error = None
+        self.buffer = b''
+        self.position = 0
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def _put(self, data):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(data, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            with open(self.path, 'rb') as f:
+                for data in self._decompress(f):
+                    if data and not self._put(data):
+                        return
+        except BaseException as e:
+            self.error = e
+        self._put(_SENTINEL)
+
+    def _decompress(self, f):
+        if self.kind == "gzip":
+            # 複数メンバー（seekable で書き込んだフレーム）が連結された gzip にも対応する
+            decompressor = zlib.decompressobj(31)
+            while True:
+                data = f.read(_CHUNK_SIZE)
+                if not data:
+                    break
+                while data:
+                    yield decompressor.decompress(data)
+                    if decompressor.eof:
+                        data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(31)
+                    else:
+                        data = b''
+            yield decompressor.flush()
+        else:
+            zstandard = _import_zstd()
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+            while True:
+                data = reader.read(_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+
+    def readinto(self, b):
+        while self.position >= len(self.buffer):
+            if self.eof:
+                return 0
+            data = self.queue.get()
+            if data is _SENTINEL:
+                self.eof = True
+                if self.error is not None:
+                    raise self.error
+                return 0
+            self.buffer = data
+            self.position = 0
+        size = min(len(b), len(self.buffer) - self.position)
+        b[:size] = self.buffer[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+        super().close()
+
+
+def open_jsonl(path, mode='r', seekable=None, frame_size=None, level=None, threads=None):
+    """
+    JSONLファイルを開く。拡張子が .gz / .zst の場合は透過的に圧縮・展開する。
+
+    Args:
+        mode: 'r' / 'w'（テキストモード）または 'rb' / 'wb'（バイナリモード。行をデコードせずにコピーする場合に使用）
+            （非圧縮ファイルの場合は open() と同じモードを指定可能）
+        seekable: True の場合、行境界で区切ったフレームごとに圧縮し、フレームインデックスを保存する
+        frame_size: フレーム1つあたりの非圧縮バイト数の目安
+        level: 圧縮レベル
+        threads: 圧縮に使用するスレッド数（-1 でCPU数）
+        （省略した値は config.py の JSONL_IO_CONFIG を使用）
+    """
+    kind = compression_of(path)
+    if kind is None:
+        if 'b' in mode:
+            return open(path, mode)
+        return open(path, mode, encoding='utf-8')
+
+    if mode in ('r', 'rt', 'rb'):
+        reader = io.BufferedReader(_DecompressingReader(path, kind), _CHUNK_SIZE)
+        return reader if mode == 'rb' else io.TextIOWrapper(reader, encoding='utf-8')
+    if mode in ('w', 'wt', 'wb'):
+        if seekable is None:
+            seekable = JSONL_IO_CONFIG.get("seekable", False)
+        if level is None:
+            level = JSONL_IO_CONFIG.get("level", {}).get(kind, 3 if kind == "zstd" else 6)
+        raw = _CompressingWriter(
+            path,
+            kind,
+            level,
+            threads if threads is not None else JSONL_IO_CONFIG.get("threads", -1),
+            seekable,
+            frame_size or JSONL_IO_CONFIG.get("frame_size", 4 << 20)
+        )
+        writer = io.BufferedWriter(raw, _CHUNK_SIZE)
+        return writer if mode == 'wb' else io.TextIOWrapper(writer, encoding='utf-8')
+    raise ValueError(f"圧縮ファイルはモード 'r' / 'w' / 'rb' / 'wb' のみに対応しています: {mode}")
+
+
+def iter_records(path, on_error=None):
+    """
+    JSONL（圧縮を含む）または Arrow / Parquet ファイルの各エントリを辞書として返す（空行はスキップ）
+
+    Args:
+        on_error: JSONL の行のパースに失敗した場合に on_error(行番号, 例外) を呼び出してその行をスキップする。
+            None の場合は例外をそのまま送出する。
+    """
+    if is_arrow_file(path):
+        from arrow_io import iter_records as iter_arrow_records
+        yield from iter_arrow_records(path)
+        return
+
+    with open_jsonl(path) as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                if on_error is None:
+                    raise
+                on_error(line_num, e)
+                continue
+            yield entry
+
+
+class RecordWriter:
+    """
+    エントリを JSONL（圧縮を含む）または Arrow / Parquet ファイルに書き込む（拡張子で判定）
+    token_count を渡すと、Arrow / Parquet の場合は token_count 列に保存する（JSONL では無視される）。
+    """
+
+    def __init__(self, path):
+        self.count = 0
+        if is_arrow_file(path):
+            from arrow_io import ArrowRecordWriter
+            self.arrow_writer = ArrowRecordWriter(path)
+            self.file = None
+        else:
+            self.arrow_writer = None
+            self.file = open_jsonl(path, 'w')
+
+    def write(self, entry, token_count=None):
+        if self.arrow_writer is not None:
+            self.arrow_writer.write(entry, token_count)
+        else:
+            self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.count += 1
+
+    def close(self):
+        if self.arrow_writer is not None:
+            self.arrow_writer.close()
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def write_records(path, entries, token_counts=None):
+    """エントリを書き込み、書き込んだ件数を返す"""
+    with RecordWriter(path) as writer:
+        if token_counts is None:
+            for entry in entries:
+                writer.write(entry)
+        else:
+            for entry, token_count in zip(entries, token_counts):
+                writer.write(entry, token_count)
+    return writer.count
+
+
+def load_frame_index(path):
+    """seekable で書き込んだ圧縮ファイルのフレームインデックスを読み込む（存在しなければ None）"""
+    index_path = frame_index_path(path)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_frame(path, frame, kind=None):
+    """
+    フレーム1つを展開して返す
+    frame: フレームインデックスの要素 [圧縮オフセット, 圧縮サイズ, 非圧縮オフセット, 非圧縮サイズ, 行数]
+    """
+    kind = kind or compression_of(path)
+    with open(path, 'rb') as f:
+        f.seek(frame[0])
+        data = f.read(frame[1])
+    if kind == "gzip":
+        return gzip.decompress(data)
+    return _import_zstd().ZstdDecompressor().decompress(data)
+
+
+def frame_ranges(path, num_parts):
+    """
+    フレームを非圧縮サイズがほぼ均等になるように num_parts 個に分割する
+    戻り値: [(開始フレーム番号, 終了フレーム番号（含まない）), ...]
+    """
+    frames = load_frame_index(path)["frames"]
+    total = sum(frame[3] for frame in frames)
+    ranges = []
+    start = 0
+    accumulated = 0
+    for i, frame in enumerate(frames):
+        accumulated += frame[3]
+        if accumulated * num_parts >= total * (len(ranges) + 1) and len(ranges) < num_parts - 1:
+            ranges.append((start, i + 1))
+            start = i + 1
+    if start < len(frames):
+        ranges.append((start, len(frames)))
+    return ranges
+
+
+def iter_frame_lines(path, start_frame, end_frame):
+    """指定した範囲のフレームを展開し、各行をバイト列（改行を含む）として返す"""
+    index = load_frame_index(path)
+    for frame in index["frames"][start_frame:end_frame]:
+        data = read_frame(path, frame, index["compression"])
+        yield from io.BytesIO(data)
@@ -19,41 +19,78 @@ from typing import List, Dict, Any
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from scripts.config import MERGE_JSONL_CONFIG
+from scripts.jsonl_io import iter_records, write_records, is_jsonl_file, open_jsonl
+from scripts.mmap_jsonl import MappedJsonl
+from scripts.metrics import measure_stage, timer
 
 
 def load_jsonl(file_path: Path) -> List[Dict[str, Any]]:
-    """JSONLファイルを読み込んでリストとして返す"""
+    """JSONL（または Arrow / Parquet）ファイルを読み込んでリストとして返す"""
     entries = []
     
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
-            if not line:
-                continue
-            
-            try:
-                entry = json.loads(line)
-                # 必須フィールドの確認
-                if not all(key in entry for key in ['id', 'title', 'text']):
-                    print(f"警告: {file_path} の {line_num} 行目に必須フィールドが不足しています")
-                    continue
-                entries.append(entry)
-            except json.JSONDecodeError as e:
-                print(f"エラー: {file_path} の {line_num} 行目のJSON解析に失敗しました: {e}")
-                continue
+    def on_error(line_num, e):
+        print(f"エラー: {file_path} の {line_num} 行目のJSON解析に失敗しました: {e}")
     
+    for entry_num, entry in enumerate(iter_records(file_path, on_error=on_error), 1):
+        # 必須フィールドの確認
+        if not all(key in entry for key in ['id', 'title', 'text']):
+            print(f"警告: {file_path} の {entry_num} 件目のエントリに必須フィールドが不足しています")
+            continue
+        entries.append(entry)
+    
+    return entries
+
+
+def load_jsonl_lines(file_path: Path, reader: MappedJsonl) -> List[Dict[str, Any]]:
+    """
+    メモリマップで開いたJSONLファイルから、必須フィールドを持つ行のIDと位置のみを読み込む
+    （本文は保持せず、書き込み時に行をそのままコピーする）
+    """
+    entries = []
+    for line_index, line in enumerate(reader):
+        try:
+            entry = json.loads(line.tobytes())
+        except json.JSONDecodeError as e:
+            print(f"エラー: {file_path} の {line_index + 1} 件目の行のJSON解析に失敗しました: {e}")
+            continue
+        # 必須フィールドの確認
+        if not all(key in entry for key in ['id', 'title', 'text']):
+            print(f"警告: {file_path} の {line_index + 1} 件目の行に必須フィールドが不足しています")
+            continue
+        entries.append({'id': entry['id'], 'line': (reader, line_index)})
     return entries
 
 
+def write_merged_lines(output_path: Path, all_entries: List[Dict[str, Any]]) -> None:
+    """load_jsonl_lines で読み込んだ行を、解析し直さずにそのまま書き込む"""
+    with open_jsonl(output_path, 'wb') as f:
+        for entry in all_entries:
+            reader, line_index = entry['line']
+            f.write(reader[line_index])
+            f.write(b'\n')
+
+
+@measure_stage("merge_jsonl")
 def merge_jsonl_files(file1_path: Path, file2_path: Path, output_path: Path) -> None:
     """2つのJSONLファイルを結合してIDでソートし、出力する"""
+    # JSONL同士の場合は各行のIDと位置のみを保持し、行を解析し直さずにコピーする
+    copy_lines = all(is_jsonl_file(path) for path in (file1_path, file2_path, output_path))
+    readers = []
+    
+    def load(file_path: Path) -> List[Dict[str, Any]]:
+        if not copy_lines:
+            return load_jsonl(file_path)
+        readers.append(MappedJsonl(file_path))
+        return load_jsonl_lines(file_path, readers[-1])
     
     print(f"ファイル1を読み込み中: {file1_path}")
-    entries1 = load_jsonl(file1_path)
+    with timer("read"):
+        entries1 = load(file1_path)
     print(f"  - {len(entries1)} エントリを読み込みました")
     
     print(f"ファイル2を読み込み中: {file2_path}")
-    entries2 = load_jsonl(file2_path)
+    with timer("read"):
+        entries2 = load(file2_path)
     print(f"  - {len(entries2)} エントリを読み込みました")
     
     # エントリを結合
@@ -73,24 +110,28 @@ def merge_jsonl_files(file1_path: Path, file2_path: Path, output_path: Path) ->
             print(f"  - ID '{id_}': {count} 回")
     
     # IDでソート
-    try:
-        # 数値としてソートを試みる
-        all_entries.sort(key=lambda x: int(x['id']))
-        print("\nIDを数値としてソートしました")
-    except ValueError:
-        # 文字列としてソート
-        all_entries.sort(key=lambda x: x['id'])
-        print("\nIDを文字列としてソートしました")
+    with timer("sort"):
+        try:
+            # 数値としてソートを試みる
+            all_entries.sort(key=lambda x: int(x['id']))
+            print("\nIDを数値としてソートしました")
+        except ValueError:
+            # 文字列としてソート
+            all_entries.sort(key=lambda x: x['id'])
+            print("\nIDを文字列としてソートしました")
     
     # 出力ディレクトリの作成
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
     # ファイルに書き込み
     print(f"\n結果を書き込み中: {output_path}")
-    with open(output_path, 'w', encoding='utf-8') as f:
-        for entry in all_entries:
-            json.dump(entry, f, ensure_ascii=False)
-            f.write('\n')
+    with timer("write"):
+        if copy_lines:
+            write_merged_lines(output_path, all_entries)
+            for reader in readers:
+                reader.close()
+        else:
+            write_records(output_path, all_entries)
     
     print(f"完了: {len(all_entries)} エントリを書き込みました")
     
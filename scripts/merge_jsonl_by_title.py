@@ -4,9 +4,12 @@ JSONLファイルをtitleに基づいてマージするスクリプト
 
 同一のファイル名（block_より前の部分）を持つエントリを、
 block_の後の数字順にソートしてマージします。
+
+token_budget を指定した場合は、1つのプログラムのブロックを1つのテキストにまとめる代わりに、
+block番号順に token_budget 以下のチャンクにまとめて出力します（split_long_jsonl.py で
+マージしたテキストを再度トークン化して分割する必要がなくなります）。
 """
 
-import json
 import re
 from pathlib import Path
 from collections import defaultdict
@@ -18,6 +21,9 @@ import os
 script_dir = Path(__file__).parent
 sys.path.append(str(script_dir))
 
+from jsonl_io import iter_records, RecordWriter, splitext_jsonl
+from metrics import timer, count
+
 try:
     from config import MERGE_JSONL_BY_TITLE_CONFIG
 except ImportError:
@@ -54,7 +60,50 @@ def extract_base_name_and_block_num(title: str) -> Tuple[str, int]:
     return base_name, block_num
 
 
-def merge_jsonl_by_title(input_file: Path, output_file: Path, text_delimiter: str = ";") -> None:
+# split_long_jsonl.py / split_long_txt.py が分割したチャンクのタイトルに付ける接尾辞
+PART_SUFFIX = re.compile(r'_part\d+$')
+
+
+def extract_program_name(title: str) -> str:
+    """
+    titleからプログラム名を抽出（末尾の _partN を除き、さらに _block_N 以降を除く）
+    
+    Args:
+        title: "00-9930_積層機_ｻｰﾎﾞ_block_1_part2" のような形式
+        
+    Returns:
+        "00-9930_積層機_ｻｰﾎﾞ"
+    """
+    return extract_base_name_and_block_num(PART_SUFFIX.sub('', title))[0]
+
+
+def plan_merged_chunks(texts: List[str], text_delimiter: str, token_budget: int, tokenizer) -> List[Tuple[str, int]]:
+    """
+    1つのプログラムのブロックのテキスト（block番号順）を token_budget 以下のチャンクにまとめる
+    
+    ブロックを区切りのセグメントとして split_long_jsonl.py の plan_chunks で分割するため、
+    チャンクの分け方・トークン数の計算（区切りの前後の結合の測定と上限付近のチャンクの検証）・
+    token_budget を超えるブロックの行の境界での分割は split_long_jsonl.py と同じです。
+    
+    Returns:
+        [(チャンクのテキスト, トークン数)]（各チャンクの先頭にもマージ時と同じ区切り文字を付ける）
+    """
+    from split_long_jsonl import plan_chunks, chunk_text
+    from batching import tokenize_batched
+    
+    prefix = text_delimiter.replace('\n', '')
+    prefix_tokens = len(tokenizer(prefix, add_special_tokens=False)['input_ids']) if prefix else 0
+    delimiter_cost = len(tokenizer(text_delimiter, add_special_tokens=False)['input_ids'])
+    tokenized = tokenize_batched(tokenizer, texts, add_special_tokens=False, return_offsets_mapping=True)
+    chunks, chunk_token_counts, _ = plan_chunks(
+        texts, tokenized, delimiter_cost, token_budget - prefix_tokens, text_delimiter, tokenizer
+    )
+    return [(prefix + chunk_text(texts, parts, text_delimiter), prefix_tokens + token_count)
+            for parts, token_count in zip(chunks, chunk_token_counts)]
+
+
+def merge_jsonl_by_title(input_file: Path, output_file: Path, text_delimiter: str = ";", token_budget: int = None,
+                         model_name: str = None) -> None:
     """
     JSONLファイルをtitleに基づいてマージ
     
@@ -62,41 +111,40 @@ def merge_jsonl_by_title(input_file: Path, output_file: Path, text_delimiter: st
         input_file: 入力JSONLファイルのパス
         output_file: 出力JSONLファイルのパス
         text_delimiter: テキスト結合時の区切り文字
+        token_budget: 指定した場合、各プログラムを token_budget トークン以下のチャンクに分けて出力する
+            （チャンクが2つ以上の場合、id と title に _part<番号> を付ける。split_long_jsonl.py と同じ）
+        model_name: token_budget を指定した場合に使用するトークナイザーのモデル名
     """
     # データを読み込み、ベース名でグループ化
     grouped_data = defaultdict(list)
     
     # 入力ファイル名（拡張子なし）を取得
-    input_filename = input_file.stem
+    input_filename = splitext_jsonl(input_file.name)[0]
     
     print(f"入力ファイルを読み込み中: {input_file}")
     
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line_num, line in enumerate(f, 1):
-            line = line.strip()
-            if not line:
-                continue
-                
-            try:
-                data = json.loads(line)
-                title = data.get('title', '')
-                text = data.get('text', '')
-                
-                base_name, block_num = extract_base_name_and_block_num(title)
-                grouped_data[base_name].append({
-                    'text': text,
-                    'block_num': block_num,
-                    'original_title': title
-                })
-                
-            except json.JSONDecodeError as e:
-                print(f"警告: 行 {line_num} でJSONデコードエラー: {e}")
-                continue
+    def on_error(line_num, e):
+        print(f"警告: 行 {line_num} でJSONデコードエラー: {e}")
+    
+    for data in iter_records(input_file, on_error=on_error):
+        title = data.get('title', '')
+        text = data.get('text', '')
+        
+        base_name, block_num = extract_base_name_and_block_num(title)
+        grouped_data[base_name].append({
+            'text': text,
+            'block_num': block_num,
+            'original_title': title
+        })
     
     print(f"グループ化完了: {len(grouped_data)} 個のベース名")
     
     # 各グループをblock番号順にソートしてマージ
     merged_results = []
+    tokenizer = None
+    if token_budget:
+        from tokenizer_backend import get_tokenizer
+        tokenizer = get_tokenizer(model_name or MERGE_JSONL_BY_TITLE_CONFIG.get("model_name"))
     
     for base_name, entries in grouped_data.items():
         # block番号順にソート
@@ -106,6 +154,17 @@ def merge_jsonl_by_title(input_file: Path, output_file: Path, text_delimiter: st
         # 先頭のテキストにもdelimiterを付ける（ただし\nは除く）
         delimiter_without_newline = text_delimiter.replace('\n', '')
         texts = [entry['text'] for entry in entries]
+        if token_budget and any(texts):
+            # 空のブロックは split_long_jsonl.py で分割する場合と同じく除く
+            chunks = plan_merged_chunks([text for text in texts if text], text_delimiter, token_budget, tokenizer)
+            count("merged_chunks", len(chunks))
+            merged_results.append({
+                'base_name': base_name,
+                'chunks': chunks,
+                'block_count': len(entries),
+                'block_nums': [entry['block_num'] for entry in entries]
+            })
+            continue
         if texts:
             # 最初のテキストの前にもdelimiterを付ける
             merged_text = delimiter_without_newline + text_delimiter.join(texts)
@@ -125,19 +184,34 @@ def merge_jsonl_by_title(input_file: Path, output_file: Path, text_delimiter: st
     # 出力ファイルに書き込み
     print(f"出力ファイルに書き込み中: {output_file}")
     
-    with open(output_file, 'w', encoding='utf-8') as f:
+    num_records = 0
+    with timer("write"), RecordWriter(output_file) as writer:
         for idx, result in enumerate(merged_results):
-            new_entry = {
-                'id': f"{input_filename}-{idx}",  # 入力ファイル名+連番
-                'title': result['base_name'],
-                'text': result['merged_text']
-            }
+            if 'chunks' not in result:
+                new_entry = {
+                    'id': f"{input_filename}-{idx}",  # 入力ファイル名+連番
+                    'title': result['base_name'],
+                    'text': result['merged_text']
+                }
+                
+                writer.write(new_entry)
+                continue
             
-            f.write(json.dumps(new_entry, ensure_ascii=False) + '\n')
+            # token_budget 以下のチャンクごとに出力する（Arrow / Parquet の場合はトークン数も保存される）
+            chunks = result['chunks']
+            for part, (text, token_count) in enumerate(chunks, start=1):
+                suffix = f"_part{part}" if len(chunks) > 1 else ""
+                writer.write({
+                    'id': f"{input_filename}-{idx}{suffix}",
+                    'title': f"{result['base_name']}{suffix}",
+                    'text': text
+                }, token_count)
+        num_records = writer.count
+    count("records_out", num_records)
     
     print(f"マージ完了:")
     print(f"  - 入力エントリ数: {sum(len(entries) for entries in grouped_data.values())}")
-    print(f"  - 出力エントリ数: {len(merged_results)}")
+    print(f"  - 出力エントリ数: {num_records}")
     print(f"  - マージされたグループ（最大10個表示）:")
     
     # 最大10個のサンプルを表示
@@ -157,11 +231,15 @@ def main():
     input_file = Path(MERGE_JSONL_BY_TITLE_CONFIG['input_file'])
     output_file = Path(MERGE_JSONL_BY_TITLE_CONFIG['output_file'])
     text_delimiter = MERGE_JSONL_BY_TITLE_CONFIG['text_delimiter']
+    token_budget = MERGE_JSONL_BY_TITLE_CONFIG.get('token_budget')
+    model_name = MERGE_JSONL_BY_TITLE_CONFIG.get('model_name')
     
     print(f"config.pyの設定を使用:")
     print(f"  入力ファイル: {input_file}")
     print(f"  出力ファイル: {output_file}")
     print(f"  区切り文字: '{text_delimiter}'")
+    if token_budget:
+        print(f"  トークン数の上限: {token_budget}")
     print()
     
     # 入力ファイルの存在確認
@@ -173,7 +251,7 @@ def main():
     output_file.parent.mkdir(parents=True, exist_ok=True)
     
     try:
-        merge_jsonl_by_title(input_file, output_file, text_delimiter)
+        merge_jsonl_by_title(input_file, output_file, text_delimiter, token_budget, model_name)
         print(f"\n✅ マージが正常に完了しました: {output_file}")
         return 0
         
@@ -0,0 +1,289 @@
+"""
+各スクリプトの処理時間・件数・メモリ使用量を計測する共通モジュール
+
+処理の区間（read / parse / tokenize / partition / serialize / write など）ごとの時間と呼び出し回数、
+バイト数・件数のカウンター、ピークメモリ（RSS）を記録し、ステージごとに JSON で出力します。
+
+    @measure_stage("split_long_jsonl", lambda args: <メトリクスファイルのパス>)
+    def process_jsonl_file(...):
+        with timer("read"):
+            ...
+        count("records_in", len(entries))
+
+ProcessPoolExecutor のワーカー内で記録した値は、タスクの戻り値に pop_delta() を含めて返し、
+親プロセスで merge(delta) して集計します（ワーカーの時間は全ワーカーの合計になります）。
+
+config.py の METRICS_CONFIG で計測の有効・無効と、cProfile / py-spy によるプロファイルを設定します。
+計測が無効の場合、timer() は何もしないコンテキストマネージャーを返すだけなので、ほぼオーバーヘッドはありません。
+"""
+
+import contextlib
+import cProfile
+import functools
+import inspect
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import METRICS_CONFIG
+
+ENABLED = METRICS_CONFIG.get("enabled", True)
+_NULL_TIMER = contextlib.nullcontext()
+
+
+def peak_rss_mb():
+    """このプロセスのピークRSS（MB）。取得できない環境では None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss は Linux では KB、macOS ではバイト単位
+    unit = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / (1 << 20)
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+
+
+class Metrics:
+    """区間ごとの時間（秒・回数）とカウンターを保持する"""
+
+    def __init__(self, enabled=ENABLED):
+        self.enabled = enabled
+        self.timers = {}  # 区間名 -> [秒, 回数]
+        self.counters = {}
+        self.worker_peak_rss_mb = None
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        entry = self.timers.get(name)
+        if entry is None:
+            self.timers[name] = [seconds, calls]
+        else:
+            entry[0] += seconds
+            entry[1] += calls
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def delta(self):
+        """別のプロセス・区間に渡すための値（pickle 可能な辞書）"""
+        return {
+            "timers": {name: list(value) for name, value in self.timers.items()},
+            "counters": dict(self.counters),
+            "peak_rss_mb": peak_rss_mb() if self.enabled else None
+        }
+
+    def merge(self, delta):
+        if not delta:
+            return
+        for name, (seconds, calls) in delta["timers"].items():
+            self.add_time(name, seconds, calls)
+        for name, value in delta["counters"].items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        rss = delta.get("peak_rss_mb")
+        if rss is not None:
+            self.worker_peak_rss_mb = max(self.worker_peak_rss_mb or 0, rss)
+
+    def reset(self):
+        self.timers = {}
+        self.counters = {}
+
+    def as_dict(self):
+        return {
+            "timers": {
+                name: {"seconds": round(seconds, 6), "calls": calls}
+                for name, (seconds, calls) in sorted(self.timers.items(), key=lambda item: -item[1][0])
+            },
+            "counters": self.counters,
+            "peak_rss_mb": peak_rss_mb(),
+            "worker_peak_rss_mb": self.worker_peak_rss_mb
+        }
+
+
+# スレッドごとの計測中の Metrics（pipeline.py はステージをスレッドで並列に実行するため）
+_local = threading.local()
+_process_metrics = Metrics()
+
+
+def _reset_after_fork():
+    # fork したワーカーが親プロセスの計測値を引き継いで二重に集計しないようにする
+    global _process_metrics
+    _process_metrics = Metrics()
+    _local.metrics = None
+    _local.profiling = False
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def current():
+    return getattr(_local, "metrics", None) or _process_metrics
+
+
+def timer(name):
+    """区間の時間を計測するコンテキストマネージャー"""
+    return current().timer(name)
+
+
+def count(name, value=1):
+    current().count(name, value)
+
+
+def merge(delta):
+    """ワーカーから返された pop_delta() の値を集計する"""
+    current().merge(delta)
+
+
+def pop_delta():
+    """ワーカー内で記録した値を返してリセットする（タスクの戻り値に含めて親プロセスに渡す）"""
+    metrics = current()
+    if not metrics.enabled:
+        return None
+    delta = metrics.delta()
+    metrics.reset()
+    return delta
+
+
+@contextlib.contextmanager
+def collect():
+    """ブロック内で記録した値を新しい Metrics に集める（終了時に外側の Metrics にも加算する）"""
+    previous = getattr(_local, "metrics", None)
+    metrics = Metrics()
+    _local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _local.metrics = previous
+        if previous is not None and metrics.enabled:
+            previous.merge(metrics.delta())
+
+
+@contextlib.contextmanager
+def profile(name):
+    """
+    METRICS_CONFIG["profile"] に応じてブロック内をプロファイルする
+        "cprofile": cProfile の結果を <profile_dir>/<name>.prof に保存（snakeviz などで表示）
+        "py-spy":   py-spy record をこのプロセスにアタッチし、<profile_dir>/<name>.svg（フレームグラフ）を保存
+                    （py-spy のインストールと ptrace の権限が必要。ワーカープロセスも含めて記録する）
+    ネストした場合は最も外側のブロックのみをプロファイルする。
+    """
+    mode = METRICS_CONFIG.get("profile")
+    if not mode or getattr(_local, "profiling", False):
+        yield
+        return
+
+    profile_dir = METRICS_CONFIG.get("profile_dir", "./data/analysis/profile")
+    os.makedirs(profile_dir, exist_ok=True)
+    _local.profiling = True
+    try:
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                output = os.path.join(profile_dir, f"{name}.prof")
+                profiler.dump_stats(output)
+                print(f"プロファイルを保存しました: {output}")
+        elif mode == "py-spy":
+            executable = shutil.which("py-spy")
+            if executable is None:
+                print("警告: py-spy が見つからないため、プロファイルを行いません")
+                yield
+                return
+            output = os.path.join(profile_dir, f"{name}.svg")
+            process = subprocess.Popen([
+                executable, "record", "--pid", str(os.getpid()), "--subprocesses",
+                "--rate", str(METRICS_CONFIG.get("py_spy_rate", 100)), "--output", output
+            ])
+            try:
+                yield
+            finally:
+                # SIGINT を送ると py-spy は記録を終了して結果を保存する
+                process.send_signal(signal.SIGINT)
+                process.wait()
+                print(f"プロファイルを保存しました: {output}")
+        else:
+            raise ValueError(f"不明なプロファイルの種類です: {mode}")
+    finally:
+        _local.profiling = False
+
+
+def metrics_path(stage):
+    """出力先が決まっていないステージのメトリクスファイルのパス"""
+    return os.path.join(METRICS_CONFIG.get("output_dir", "./data/analysis/metrics"), f"{stage}_metrics.json")
+
+
+def write_metrics(path, stage, metrics, seconds=None):
+    """計測結果を JSON で保存する"""
+    data = {
+        "stage": stage,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "seconds": round(seconds, 6) if seconds is not None else None
+    }
+    data.update(metrics.as_dict())
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    return data
+
+
+def measure_stage(stage, output=None):
+    """
+    関数の実行全体を計測し、終了後にメトリクスを JSON で保存するデコレーター
+
+    Args:
+        stage: ステージ名（メトリクスとプロファイルのファイル名に使用）
+        output: 関数の引数（引数名 -> 値の辞書）からメトリクスファイルのパスを返す関数
+            （省略時は METRICS_CONFIG["output_dir"]/<stage>_metrics.json）
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED and not METRICS_CONFIG.get("profile"):
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            with collect() as metrics, profile(stage):
+                result = func(*args, **kwargs)
+            if ENABLED:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                path = output(bound.arguments) if output else metrics_path(stage)
+                write_metrics(path, stage, metrics, time.perf_counter() - start)
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,256 @@
+"""
+JSONLファイルをメモリマップで読み込む共通モジュール
+
+ファイル全体を mmap で開き、改行の位置を numpy でまとめて検索して行の位置（バイトオフセット）の
+インデックスを作ります。各行は mmap を参照する memoryview として返すため、読み込み時にコピーや
+UTF-8 のデコードは行われません。JSON として解析する（record）・文字列にする（text）のは必要な行だけで、
+行をそのまま別のファイルにコピーする場合（train/val 分割や結合）はデコードせずに書き出せます。
+
+並列処理では split_ranges でファイルを行の境界に揃えた (開始, 終了) のバイト範囲に分割し、
+各ワーカーは iter_range_lines で担当範囲の行だけを読み込みます（ファイル全体のインデックスは不要）。
+圧縮ファイル（.jsonl.gz / .jsonl.zst）はメモリマップできないため、MappedJsonl は展開した内容を
+メモリ上に保持し、split_ranges / iter_range_lines はフレーム単位の範囲（seekable で書き込んだ場合）を使います。
+
+行の memoryview は mmap を参照しているため、ファイルを閉じた後も使う場合は bytes() でコピーしてください。
+"""
+
+import json
+import mmap
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from jsonl_io import compression_of, load_frame_index, frame_ranges, iter_frame_lines, open_jsonl
+
+# 改行を検索する単位（一時的な配列のメモリ使用量をこのサイズに抑える）
+_SCAN_BLOCK = 64 << 20
+_WHITESPACE = b" \t\r\n"
+# map_ranges で1つのワーカーに割り当てる最小のファイルサイズ（小さいファイルはプロセスを起動せずに処理する）
+_MIN_PART_SIZE = 16 << 20
+
+
+def find_newlines(buffer, start=0, end=None):
+    """buffer[start:end] に含まれる改行のバイトオフセットを numpy の int64 配列で返す"""
+    import numpy as np
+
+    view = np.frombuffer(buffer, dtype=np.uint8)
+    end = len(view) if end is None else min(end, len(view))
+    parts = [np.empty(0, dtype=np.int64)]
+    for block_start in range(start, end, _SCAN_BLOCK):
+        block = view[block_start:min(block_start + _SCAN_BLOCK, end)]
+        parts.append(np.flatnonzero(block == 0x0A).astype(np.int64) + block_start)
+    return np.concatenate(parts)
+
+
+def _line_spans(buffer, newlines, start, end):
+    """改行の位置から各行の (開始, 終了) を求め、空行（空白のみの行を含む）を除いて返す"""
+    import numpy as np
+
+    starts = np.concatenate(([start], newlines + 1)).astype(np.int64)
+    ends = np.concatenate((newlines, [end])).astype(np.int64)
+    keep = ends > starts
+
+    # 先頭が空白の行のみ、空白以外の文字を含むかを個別に確認する（通常のJSONLでは発生しない）
+    view = np.frombuffer(buffer, dtype=np.uint8)
+    first = np.zeros(len(starts), dtype=np.uint8)
+    first[keep] = view[starts[keep]]
+    for i in np.flatnonzero(keep & np.isin(first, list(_WHITESPACE))):
+        keep[i] = bool(bytes(buffer[starts[i]:ends[i]]).strip())
+    return starts[keep], ends[keep]
+
+
+class MappedJsonl:
+    """
+    行の位置のインデックスを持つJSONLファイルのリーダー
+
+    reader[i] で i 行目（空行を除く）を memoryview（改行を含まない）として返す。
+    len(reader) は空行を除いた行数。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._file = None
+        self._mmap = None
+        if compression_of(self.path) is None:
+            self._file = open(self.path, 'rb')
+            if os.fstat(self._file.fileno()).st_size:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = self._mmap if self._mmap is not None else b''
+        else:
+            # 圧縮ファイルは展開した内容をメモリ上に保持する
+            with open_jsonl(self.path, 'rb') as f:
+                buffer = f.read()
+        self._view = memoryview(buffer)
+        self.size = len(self._view)
+        self._starts = None
+        self._ends = None
+
+    def _build_index(self):
+        if self._starts is None:
+            newlines = find_newlines(self._view)
+            self._starts, self._ends = _line_spans(self._view, newlines, 0, self.size)
+
+    @property
+    def offsets(self):
+        """各行の (開始オフセットの配列, 終了オフセットの配列)"""
+        self._build_index()
+        return self._starts, self._ends
+
+    def __len__(self):
+        self._build_index()
+        return len(self._starts)
+
+    def __getitem__(self, i):
+        self._build_index()
+        return self._view[self._starts[i]:self._ends[i]]
+
+    def __iter__(self):
+        self._build_index()
+        for start, end in zip(self._starts.tolist(), self._ends.tolist()):
+            yield self._view[start:end]
+
+    def span(self, start, end):
+        """バイト範囲 [start, end) を memoryview として返す"""
+        return self._view[start:end]
+
+    def text(self, i):
+        """i 行目を文字列として返す"""
+        return str(self[i], 'utf-8')
+
+    def record(self, i):
+        """i 行目をJSONとして解析して返す"""
+        return json.loads(self[i].tobytes())
+
+    def iter_records(self):
+        for line in self:
+            yield json.loads(line.tobytes())
+
+    def iter_spans(self, start=0, end=None):
+        """
+        バイト範囲 [start, end) に開始位置がある行の (開始, 終了) を返す（空行は除く）
+        インデックスを作らずに範囲内のみを走査するため、ワーカーごとの処理に使用する。
+        start は行の先頭（split_ranges の範囲）であること。
+        """
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        # 範囲の最後の行が範囲外で終わる場合は、その行の終わりまで読む
+        scan_end = end
+        if end < self.size:
+            newline = self._find(b'\n', end - 1)
+            scan_end = newline + 1 if newline >= 0 else self.size
+        newlines = find_newlines(self._view, start, scan_end)
+        starts, ends = _line_spans(self._view, newlines, start, scan_end)
+        yield from zip(starts.tolist(), ends.tolist())
+
+    def byte_ranges(self, num_parts):
+        """
+        ファイルをバイト数がほぼ均等になるように num_parts 個の範囲に分割する
+        各範囲の境界は行の先頭に揃える。戻り値: [(開始, 終了), ...]
+        """
+        boundaries = [0]
+        for part in range(1, num_parts):
+            target = self.size * part // num_parts
+            if target <= boundaries[-1]:
+                continue
+            newline = bytes(self._view[target - 1:target]) == b'\n'
+            if newline:
+                boundary = target
+            else:
+                found = self._find(b'\n', target)
+                if found < 0:
+                    break
+                boundary = found + 1
+            if boundary > boundaries[-1] and boundary < self.size:
+                boundaries.append(boundary)
+        boundaries.append(self.size)
+        return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+    def _find(self, sub, start):
+        return self._view.obj.find(sub, start)
+
+    def close(self):
+        self._view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # 行の memoryview が残っている場合は、参照がなくなった時点で解放される
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def split_ranges(path, num_parts):
+    """
+    ファイルを行の境界で num_parts 個の範囲に分割する（ワーカーへの分配用）
+    非圧縮ファイルはバイト範囲、seekable で書き込んだ圧縮ファイルはフレーム番号の範囲を返す。
+    フレームインデックスのない圧縮ファイルは分割できないため、ファイル全体を1つの範囲として返す。
+    """
+    if compression_of(path) is None:
+        with MappedJsonl(path) as reader:
+            return reader.byte_ranges(num_parts)
+    if load_frame_index(path) is not None:
+        return frame_ranges(path, num_parts)
+    return [(0, None)]
+
+
+def iter_range_lines(path, part):
+    """
+    split_ranges で求めた範囲の各行（改行を含まない、空行を除く）を返す
+    非圧縮ファイルは memoryview（次の行を読むと解放されるため、保持する場合は bytes() でコピーすること）、
+    圧縮ファイルは bytes を返す。
+    """
+    start, end = part
+    if compression_of(path) is None:
+        with MappedJsonl(path) as reader:
+            for line_start, line_end in reader.iter_spans(start, end):
+                line = reader.span(line_start, line_end)
+                try:
+                    yield line
+                finally:
+                    line.release()
+        return
+
+    if end is None:
+        with open_jsonl(path, 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\r\n')
+                if line.strip():
+                    yield line
+        return
+    for line in iter_frame_lines(path, start, end):
+        line = line.rstrip(b'\r\n')
+        if line.strip():
+            yield line
+
+
+def map_ranges(path, func, num_workers=None, min_part_size=_MIN_PART_SIZE, executor=None):
+    """
+    ファイルを最大 num_workers 個の範囲に分割し、func(path, part) をプロセスプールで並列に実行する
+    （範囲1つあたりのサイズが min_part_size 未満にならないように分割数を減らす）
+    executor を指定した場合は新しいプロセスプールを起動せずにそのプールを使用する
+    戻り値: 範囲の順に並んだ func の戻り値のリスト
+    """
+    num_workers = num_workers or os.cpu_count() or 1
+    num_parts = max(1, min(num_workers, os.path.getsize(path) // max(min_part_size, 1)))
+    parts = split_ranges(path, num_parts)
+    if len(parts) <= 1:
+        return [func(path, part) for part in parts]
+    with (nullcontext(executor) if executor else ProcessPoolExecutor(max_workers=num_workers)) as pool:
+        return list(pool.map(partial(func, path), parts))
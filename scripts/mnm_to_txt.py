@@ -1,47 +1,69 @@
+import hashlib
 import os
 import sys
 import shutil
 import chardet  # エンコーディング検出ライブラリ
 from config import MNM_TO_TXT_CONFIG
+from metrics import measure_stage, timer, count
+from checkpoint import Journal, FileState, code_version
+from job_ledger import ledger_enabled, open_ledger, default_worker_id, FAILED
 
-def convert_to_plaintext(file_path, output_directory, base_directory):
+# 変換済みのファイルを記録するジャーナル（出力ディレクトリに作成し、すべて変換した時点で削除する）
+JOURNAL_FILE = ".mnm_to_txt.journal"
+# 入力ごとのサイズ・更新時刻・出力ファイル名（実行が完了した時点で保存し、次回は変更のないファイルをスキップする）
+STATE_FILE = ".mnm_to_txt.state.json"
+TMP_SUFFIX = ".tmp"
+
+def output_stem(file_path, base_directory):
+    """指定したディレクトリからの相対パスのディレクトリ部分を先頭に付けた出力ファイル名（拡張子なし）"""
+    # 指定したディレクトリからの相対パスを取得
+    rel_path = os.path.relpath(file_path, base_directory)
+    rel_path_parts = rel_path.split(os.sep)
+    
+    # ファイル名を除いたパス部分を取得
+    path_prefix = "_".join(rel_path_parts[:-1]) if len(rel_path_parts) > 1 else "unknown"
+    
+    base_name = os.path.basename(file_path)
+    name, _ = os.path.splitext(base_name)
+    
+    # 相対パスの部分をファイル名の先頭に追加
+    return f"{path_prefix}_{name}"
+
+def convert_to_plaintext(file_path, output_directory, base_directory, journal=None, output_file=None):
     """
     ファイルをプレーンテキスト形式に変換し、指定したディレクトリに保存する。
     同一のファイル名の場合、内容比較はせずに常に番号を振って新しいファイルを作成する。
     指定したディレクトリからの相対パスの最初の部分をファイル名の先頭に追加する。
     深い階層がある場合は、その階層も含める。
+    journal: 指定された場合、書き込む前に出力ファイル名を、書き込んだ後に完了を記録する
+    output_file: 指定された場合、このパスに上書きする（中断前に記録した出力ファイル名で再変換する場合）
     """
     os.makedirs(output_directory, exist_ok=True)
     
     try:
-        with open(file_path, 'rb') as infile:
+        with timer("read"), open(file_path, 'rb') as infile:
             raw_data = infile.read()
+        count("input_bytes", len(raw_data))
+        with timer("detect_encoding"):
             detected = chardet.detect(raw_data)
-            encoding = detected['encoding']
-            if encoding is None:
-                encoding = 'shift_jis'  # デフォルトを shift_jis に設定
+        encoding = detected['encoding']
+        if encoding is None:
+            encoding = 'shift_jis'  # デフォルトを shift_jis に設定
+        with timer("decode"):
             text = raw_data.decode(encoding)
         
         new_lines = text.splitlines()
 
-        # 指定したディレクトリからの相対パスを取得
         rel_path = os.path.relpath(file_path, base_directory)
-        rel_path_parts = rel_path.split(os.sep)
-        
-        # ファイル名を除いたパス部分を取得
-        path_prefix = "_".join(rel_path_parts[:-1]) if len(rel_path_parts) > 1 else "unknown"
-        
-        base_name = os.path.basename(file_path)
-        name, _ = os.path.splitext(base_name)
-        
-        # 相対パスの部分をファイル名の先頭に追加
-        prefixed_name = f"{path_prefix}_{name}"
+        prefixed_name = output_stem(file_path, base_directory)
         
         # 候補ファイル名は「prefixed_name.txt」
         candidate = os.path.join(output_directory, f"{prefixed_name}.txt")
         
         # 同名ファイルが存在する場合は、内容比較せずに番号を振る
-        if os.path.exists(candidate):
+        if output_file is not None:
+            candidate = output_file
+        elif os.path.exists(candidate):
             counter = 1
             while True:
                 candidate_numbered = os.path.join(output_directory, f"{prefixed_name}_{counter}.txt")
@@ -50,46 +72,75 @@ def convert_to_plaintext(file_path, output_directory, base_directory):
                     break
                 counter += 1
 
-        with open(candidate, 'w', encoding='utf-8') as outfile:
-            outfile.write(text)
+        # 中断しても書き込み途中のファイルが残らないように、一時ファイルに書き込んでからリネームする
+        if journal is not None:
+            journal.record(rel_path, output=os.path.basename(candidate), done=False)
+        with timer("write"):
+            with open(candidate + TMP_SUFFIX, 'w', encoding='utf-8') as outfile:
+                outfile.write(text)
+            os.replace(candidate + TMP_SUFFIX, candidate)
+        if journal is not None:
+            journal.record(rel_path, output=os.path.basename(candidate), done=True)
 
         return candidate
     except Exception as e:
         raise Exception(f"ファイル {file_path} の変換中にエラーが発生しました: {e}")
 
+@measure_stage("mnm_to_txt")
 def process_files(directory, output_directory, error_directory, debug=False):
     """
     指定したディレクトリ内およびそのサブディレクトリ内のすべてのファイルを
     プレーンテキスト形式に変換する。結合はせず、個別のファイルとして保存する。
 
     処理状況は全体の何%完了しているかを同一行上に更新して表示します。
+    出力ファイル名は plan_output_names で決め、前回の実行から変更のないファイルはスキップし、
+    変更・削除されたファイルの以前の出力は削除します（checkpoint.py の FileState）。
+    中断した場合は、再実行時にジャーナルに記録された変換済みのファイルをスキップして続きから処理します。
+    JOB_LEDGER_CONFIG の enabled が True の場合は、複数のワーカーでディレクトリを分担して処理します
+    （process_files_distributed を参照）。
     """
     os.makedirs(error_directory, exist_ok=True)
     os.makedirs(output_directory, exist_ok=True)
+    if ledger_enabled():
+        process_files_distributed(directory, output_directory, error_directory, debug)
+        return
     
-    # 事前に処理対象の非隠しファイル総数をカウント
-    total_files = 0
-    for root, dirs, files in os.walk(directory):
-        total_files += len([f for f in files if not f.startswith('.')])
+    plan = plan_output_names(directory)
+    state = open_state(output_directory)
+    journal = Journal(os.path.join(output_directory, JOURNAL_FILE))
+    if len(journal):
+        print(f"ジャーナルから再開します: {len(journal)} ファイル記録済み")
+    # 書き込み途中で中断した一時ファイルを削除する
+    for file_name in os.listdir(output_directory):
+        if file_name.endswith(TMP_SUFFIX):
+            os.remove(os.path.join(output_directory, file_name))
+    
+    # 処理対象の非隠しファイル総数
+    total_files = sum(len(files) for files in plan.values())
     
     print(f"処理対象のファイル数: {total_files}")
     processed_files = 0
     converted_files = 0
+    skipped_files = 0
 
     try:
-        for root, dirs, files in os.walk(directory):
-            for file in files:
-                # 隠しファイルはスキップ（ただしカウントはする）
-                if file.startswith('.'):
-                    processed_files += 1
+        for files in plan.values():
+            for file_path, output_name in files:
+                processed_files += 1
+                rel_path = os.path.relpath(file_path, directory)
+                stat = os.stat(file_path)
+                
+                # 前回の実行から変更のないファイル・中断前に変換済みのファイルはスキップ
+                entry = journal.get(rel_path)
+                if (entry is not None and entry["done"] and entry["output"] == output_name) or \
+                        state.is_current(rel_path, stat, [output_name]):
+                    state.record(rel_path, stat, [output_name])
+                    skipped_files += 1
+                    count("files_skipped")
                     sys.stdout.write(f'\r進捗: {processed_files/total_files*100:.2f}%')
                     sys.stdout.flush()
                     continue
                 
-                processed_files += 1
-                file_path = os.path.join(root, file)
-                rel_path = os.path.relpath(file_path, directory)
-                
                 try:
                     # デバッグモードの場合、処理中のファイルパスを表示
                     if debug:
@@ -97,8 +148,11 @@ def process_files(directory, output_directory, error_directory, debug=False):
                         print(f"親フォルダ: {os.path.basename(os.path.dirname(file_path))}")
                     
                     # プレーンテキスト形式に変換（指定したディレクトリを渡す）
-                    plaintext_file = convert_to_plaintext(file_path, output_directory, directory)
+                    plaintext_file = convert_to_plaintext(file_path, output_directory, directory, journal,
+                                                          os.path.join(output_directory, output_name))
+                    state.record(rel_path, stat, [output_name])
                     converted_files += 1
+                    count("files_converted")
                     
                     # デバッグモードの場合、変換後のファイル名を表示
                     if debug:
@@ -106,7 +160,7 @@ def process_files(directory, output_directory, error_directory, debug=False):
                 except Exception as e:
                     # エラー発生時は改行してエラーメッセージを表示
                     sys.stdout.write(f"\nエラー: {rel_path} の処理中にエラー発生: {e}\n")
-                    error_path = os.path.join(error_directory, os.path.basename(file))
+                    error_path = os.path.join(error_directory, os.path.basename(file_path))
                     shutil.move(file_path, error_path)
                     sys.stdout.write(f"    -> {rel_path} をエラー用ディレクトリへ移動\n")
                     sys.stdout.flush()
@@ -115,14 +169,118 @@ def process_files(directory, output_directory, error_directory, debug=False):
                 sys.stdout.write(f'\r進捗: {processed_files/total_files*100:.2f}%')
                 sys.stdout.flush()
         sys.stdout.write('\n')  # 進捗表示後に改行
-        print(f"\n{converted_files}個のファイルが {output_directory} に変換されました。")
+        # 変更・削除されたファイルの以前の出力を削除して状態を保存し、ジャーナルを削除する
+        state.save()
+        journal.remove()
+        print(f"\n{converted_files}個のファイルが {output_directory} に変換されました（変更なし: {skipped_files}個）。")
     except Exception as e:
-        print(f"エラーが発生しました: {e}")
-
-# 設定ファイルから値を読み込む
-process_files(
-    directory=MNM_TO_TXT_CONFIG["directory"],
-    output_directory=MNM_TO_TXT_CONFIG["output_directory"],
-    error_directory=MNM_TO_TXT_CONFIG["error_directory"],
-    debug=MNM_TO_TXT_CONFIG["debug"]  # デバッグ情報を表示する場合はTrueに設定
-)
+        # ジャーナルを残したまま例外を送出し直す（呼び出し元が失敗を検出し、再実行時は続きから処理する）
+        print(f"\nエラーが発生しました: {e}")
+        raise
+    finally:
+        journal.close()
+
+def open_state(output_directory):
+    """出力ディレクトリの入力ごとの状態（コードが変わった場合はすべて変換し直す）"""
+    return FileState(os.path.join(output_directory, STATE_FILE), code_version("mnm_to_txt"), output_directory)
+
+def plan_output_names(directory):
+    """
+    入力のディレクトリごとに (ファイルのパス, 出力ファイル名) のリストを返す（{相対パス: [...]}）
+    ディレクトリ・ファイル名の順に処理した場合に convert_to_plaintext が振る名前と同じ規則で、
+    出力ディレクトリの既存のファイルや os.walk の順序に関係なく決まる。1台で実行する場合（process_files）と
+    台帳で分担する場合（process_files_distributed）の両方で使用するため、どちらで実行しても同じ名前になる。
+    """
+    plan = {}
+    used = set()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.startswith('.'):
+                continue
+            file_path = os.path.join(root, file)
+            stem = output_stem(file_path, directory)
+            output_name = f"{stem}.txt"
+            counter = 1
+            while output_name in used:
+                output_name = f"{stem}_{counter}.txt"
+                counter += 1
+            used.add(output_name)
+            plan.setdefault(os.path.relpath(root, directory), []).append((file_path, output_name))
+    return plan
+
+def directory_job_key(files, version):
+    """ディレクトリのジョブのキー（コードのバージョンとファイル名・サイズ・更新時刻・出力ファイル名から計算する）"""
+    digest = hashlib.sha256(version.encode('utf-8'))
+    for file_path, output_name in files:
+        stat = os.stat(file_path)
+        digest.update(f"{file_path}\0{stat.st_size}\0{stat.st_mtime_ns}\0{output_name}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def process_files_distributed(directory, output_directory, error_directory, debug=False):
+    """
+    入力のディレクトリを1つのジョブとして、output_directory の台帳（job_ledger.py）から取得して変換する
+    同じ共有ストレージ上の output_directory に対して、任意の数のワーカーを起動できる。
+    出力ファイル名は plan_output_names で事前に決めるため、処理し直した場合も同じファイルに上書きされる。
+    """
+    worker_id = default_worker_id()
+    plan = plan_output_names(directory)
+    ledger = open_ledger(output_directory)
+    state = open_state(output_directory)
+    ledger.register({rel_dir: (directory_job_key(files, state.version), sum(os.path.getsize(path) for path, _ in files))
+                     for rel_dir, files in plan.items()})
+    # 台帳では完了していても出力が失われたディレクトリは処理し直す
+    ledger.reset([rel_dir for rel_dir, files in plan.items()
+                  if not all(os.path.exists(os.path.join(output_directory, name)) for _, name in files)])
+    print(f"処理対象のディレクトリ数: {len(plan)}（ワーカー: {worker_id}）")
+
+    converted_files = 0
+    while True:
+        rel_dir = ledger.claim(worker_id)
+        if rel_dir is None:
+            break
+        with ledger.lease(rel_dir, worker_id):
+            for file_path, output_name in plan[rel_dir]:
+                rel_path = os.path.relpath(file_path, directory)
+                if not os.path.exists(file_path):
+                    # 他のワーカーがエラー用ディレクトリへ移動したファイル
+                    continue
+                try:
+                    if debug:
+                        print(f"処理中: {file_path}")
+                    convert_to_plaintext(file_path, output_directory, directory,
+                                         output_file=os.path.join(output_directory, output_name))
+                    converted_files += 1
+                    count("files_converted")
+                except Exception as e:
+                    print(f"エラー: {rel_path} の処理中にエラー発生: {e}")
+                    shutil.move(file_path, os.path.join(error_directory, os.path.basename(file_path)))
+                    print(f"    -> {rel_path} をエラー用ディレクトリへ移動")
+            print(f"完了: {rel_dir}（{len(plan[rel_dir])} ファイル）")
+
+    # 最後に終了したワーカーの状態が残るように、すべてのワーカーが台帳のロックを取得して保存する
+    # （エラー用ディレクトリへ移動したファイルと、変更・削除されたファイルの以前の出力は削除される）
+    failed = ledger.names(FAILED)
+    with ledger.exclusive():
+        state = open_state(output_directory)
+        for rel_dir, files in plan.items():
+            for file_path, output_name in files:
+                rel_path = os.path.relpath(file_path, directory)
+                if rel_dir in failed:
+                    state.keep(rel_path)
+                elif os.path.exists(file_path) and os.path.exists(os.path.join(output_directory, output_name)):
+                    state.record(rel_path, os.stat(file_path), [output_name])
+        state.save()
+
+    if failed:
+        print(f"警告: 処理に失敗したディレクトリ（試行回数の上限に達した。job_ledger.py --reset-failed で再実行の対象に戻せます）: {', '.join(failed)}")
+    print(f"\n{converted_files}個のファイルが {output_directory} に変換されました。")
+
+if __name__ == "__main__":
+    # 設定ファイルから値を読み込む
+    process_files(
+        directory=MNM_TO_TXT_CONFIG["directory"],
+        output_directory=MNM_TO_TXT_CONFIG["output_directory"],
+        error_directory=MNM_TO_TXT_CONFIG["error_directory"],
+        debug=MNM_TO_TXT_CONFIG["debug"]  # デバッグ情報を表示する場合はTrueに設定
+    )
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+分割済みのチャンクを固定長の学習用シーケンスにパッキングするスクリプト
+
+split_long_jsonl.py で token_limit 以下に分割したエントリを、長さ seq_length のシーケンス（ビン）に
+Best-Fit Decreasing で詰め込みます。エントリをトークン数の降順に並べ、それぞれを
+「入れても溢れないビンのうち残り容量が最小のビン」に割り当てます。残り容量ごとのビンの有無を
+64分木のセグメント木（ビットマスク）で管理するため、1エントリあたり数回のビット演算で割り当て先が決まります。
+
+出力の各レコードは1つのシーケンスで、含まれる文書とその境界（シーケンス内のトークン位置）を持ちます:
+    {"id": "pack_00000001", "token_count": 16200,
+     "documents": [{"id": "...", "title": "...", "text": "...", "token_offset": 0, "token_count": 9000}, ...]}
+
+トークン数は入力が Arrow / Parquet で token_count 列がある場合はそれを使い、
+ない場合（JSONL など）はトークナイザーで数えます。
+
+使用方法:
+    python scripts/pack_sequences.py
+
+設定:
+    config.pyのPACK_SEQUENCES_CONFIGで設定を変更可能
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from tqdm import tqdm
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import PACK_SEQUENCES_CONFIG
+from jsonl_io import iter_records, is_arrow_file, RecordWriter
+from mmap_jsonl import MappedJsonl
+from metrics import measure_stage, timer, count
+
+
+class CapacityTree:
+    """
+    残り容量（0〜capacity）ごとのビンの数を管理し、指定した値以上で最小の残り容量を検索する
+
+    各節点が64個の子を持つセグメント木で、各節点はビンが存在する子をビットマスク（int）で持つ。
+    検索は各段でビット演算を1回行うだけで済むため、容量 16384 でも3段で検索できる。
+    """
+
+    def __init__(self, capacity):
+        self.counts = [0] * (capacity + 1)
+        self.levels = []
+        size = capacity + 1
+        while True:
+            words = (size + 63) >> 6
+            self.levels.append([0] * words)
+            if words == 1:
+                break
+            size = words
+
+    def add(self, value):
+        counts = self.counts
+        counts[value] += 1
+        if counts[value] > 1:
+            return
+        # 空だった値にビンが入った場合、ビットを立てる（節点が空でなくなった場合は上の段にも反映する）
+        for words in self.levels:
+            index = value >> 6
+            was_empty = not words[index]
+            words[index] |= 1 << (value & 63)
+            if not was_empty:
+                break
+            value = index
+
+    def remove(self, value):
+        counts = self.counts
+        counts[value] -= 1
+        if counts[value]:
+            return
+        for words in self.levels:
+            index = value >> 6
+            words[index] &= ~(1 << (value & 63))
+            if words[index]:
+                break
+            value = index
+
+    def find_min_at_least(self, value):
+        """残り容量が value 以上のビンのうち、最小の残り容量を返す（該当するビンがなければ -1）"""
+        levels = self.levels
+        for depth, words in enumerate(levels):
+            index = value >> 6
+            if index >= len(words):
+                return -1
+            # 節点内で value 以上の位置にあるビット
+            mask = words[index] >> (value & 63) << (value & 63)
+            if mask:
+                value = (index << 6) | ((mask & -mask).bit_length() - 1)
+                # 最も小さい位置の葉まで下る
+                for lower in reversed(levels[:depth]):
+                    mask = lower[value]
+                    value = (value << 6) | ((mask & -mask).bit_length() - 1)
+                return value
+            value = index + 1
+        return -1
+
+
+def pack_best_fit(sizes, capacity):
+    """
+    Best-Fit Decreasing で各要素をビンに割り当てる
+
+    Args:
+        sizes: 各要素のサイズ（トークン数）のリスト
+        capacity: ビン1つあたりの容量
+
+    Returns:
+        (bins, oversized)
+        bins: 各ビンに割り当てた要素のインデックスのリスト（ビンを作成した順）
+        oversized: capacity を超えるため割り当てられなかった要素のインデックスのリスト
+    """
+    order = sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True)
+    tree = CapacityTree(capacity)
+    bins_by_remaining = {}  # 残り容量 -> その残り容量のビン番号のリスト
+    bins = []
+    oversized = []
+
+    for index in order:
+        size = sizes[index]
+        if size > capacity:
+            oversized.append(index)
+            continue
+
+        remaining = tree.find_min_at_least(size)
+        if remaining < 0:
+            # 入るビンがない場合は新しいビンを作る
+            bin_id = len(bins)
+            bins.append([index])
+            new_remaining = capacity - size
+        else:
+            bin_id = bins_by_remaining[remaining].pop()
+            tree.remove(remaining)
+            bins[bin_id].append(index)
+            new_remaining = remaining - size
+
+        tree.add(new_remaining)
+        bins_by_remaining.setdefault(new_remaining, []).append(bin_id)
+
+    return bins, oversized
+
+
+def load_token_counts(input_file, model_name):
+    """
+    各エントリのトークン数を返す
+    Arrow / Parquet の token_count 列があればそれを使い、なければトークナイザーで数える
+    """
+    if is_arrow_file(input_file):
+        from arrow_io import token_counts
+        counts = token_counts(input_file)
+        if counts is not None:
+            print("計算済みのトークン数（token_count 列）を使用します")
+            return counts.tolist()
+
+    from tokenizer_backend import get_tokenizer
+    tokenizer = get_tokenizer(model_name)
+
+    from batching import iter_token_counts
+    texts = (entry.get("text", "") for entry in iter_records(input_file))
+    return list(tqdm(iter_token_counts(tokenizer, texts, add_special_tokens=False), desc="トークン化", dynamic_ncols=True))
+
+
+@measure_stage("pack_sequences", lambda args: os.path.splitext(args["report_file"])[0] + "_metrics.json")
+def pack_sequences(input_file, output_file, report_file, seq_length=16384, sep_tokens=1, model_name=None):
+    """
+    input_file のエントリを seq_length トークンのシーケンスにパッキングして output_file に出力する
+
+    Args:
+        sep_tokens: 文書の区切り（EOS など）として各文書に加えるトークン数
+        model_name: トークン数が保存されていない場合に使用するトークナイザー
+
+    Returns:
+        パッキングの結果（report_file に保存する内容）
+    """
+    token_counts = load_token_counts(input_file, model_name or PACK_SEQUENCES_CONFIG["model_name"])
+    sizes = [count + sep_tokens for count in token_counts]
+
+    start_time = time.perf_counter()
+    with timer("pack"):
+        bins, oversized = pack_best_fit(sizes, seq_length)
+    elapsed = time.perf_counter() - start_time
+    count("records_in", len(sizes))
+    count("sequences", len(bins))
+
+    # 各エントリをインデックスで参照する（JSONL はメモリマップで必要な行のみ解析する）
+    if is_arrow_file(input_file):
+        reader = None
+        entries = list(iter_records(input_file))
+        get_entry = entries.__getitem__
+    else:
+        reader = MappedJsonl(input_file)
+        get_entry = reader.record
+
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with timer("write"), RecordWriter(output_file) as writer:
+        for bin_id, indices in enumerate(tqdm(bins, desc="書き込み", dynamic_ncols=True), 1):
+            # シーケンス内の文書は元の順序に並べる
+            documents = []
+            offset = 0
+            for index in sorted(indices):
+                entry = get_entry(index)
+                documents.append({
+                    "id": entry.get("id", ""),
+                    "title": entry.get("title", ""),
+                    "text": entry.get("text", ""),
+                    "token_offset": offset,
+                    "token_count": token_counts[index]
+                })
+                offset += sizes[index]
+            writer.write({"id": f"pack_{bin_id:08d}", "token_count": offset, "documents": documents})
+    oversized_entries = [
+        {"id": get_entry(index).get("id", ""), "token_count": token_counts[index]} for index in oversized
+    ]
+    if reader is not None:
+        reader.close()
+
+    packed_tokens = sum(sizes) - sum(sizes[index] for index in oversized)
+    num_packed_entries = len(sizes) - len(oversized)
+    report = {
+        "input_file": os.path.basename(input_file),
+        "output_file": os.path.basename(output_file),
+        "seq_length": seq_length,
+        "sep_tokens": sep_tokens,
+        "num_entries": len(sizes),
+        "num_sequences": len(bins),
+        "num_oversized_entries": len(oversized),
+        "packed_tokens": packed_tokens,
+        "padding_tokens": len(bins) * seq_length - packed_tokens,
+        # 埋まっているトークンの割合（パッキングしない場合は1エントリ1シーケンス）
+        "packing_efficiency": packed_tokens / (len(bins) * seq_length) if bins else 0.0,
+        "unpacked_efficiency": packed_tokens / (num_packed_entries * seq_length) if num_packed_entries else 0.0,
+        "avg_documents_per_sequence": num_packed_entries / len(bins) if bins else 0.0,
+        "packing_seconds": elapsed,
+        "oversized_entries": oversized_entries
+    }
+
+    os.makedirs(os.path.dirname(report_file) or ".", exist_ok=True)
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+
+    print("パッキング完了:")
+    print(f"  エントリ数: {report['num_entries']}")
+    print(f"  シーケンス数: {report['num_sequences']}")
+    print(f"  パッキング効率: {report['packing_efficiency']:.2%}（パッキングなし: {report['unpacked_efficiency']:.2%}）")
+    print(f"  割り当て時間: {elapsed:.2f} 秒")
+    if oversized:
+        print(f"  警告: {len(oversized)} 件のエントリが seq_length を超えるため除外されました")
+    return report
+
+
+def main():
+    pack_sequences(
+        input_file=PACK_SEQUENCES_CONFIG["input_file"],
+        output_file=PACK_SEQUENCES_CONFIG["output_file"],
+        report_file=PACK_SEQUENCES_CONFIG["report_file"],
+        seq_length=PACK_SEQUENCES_CONFIG["seq_length"],
+        sep_tokens=PACK_SEQUENCES_CONFIG["sep_tokens"],
+        model_name=PACK_SEQUENCES_CONFIG["model_name"]
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""
+前処理パイプラインを DAG として実行するスクリプト
+
+config.py の PIPELINE_CONFIG に定義されたステージを依存関係の順に実行します。
+各ステージは「入力ファイルの内容ハッシュ」「ステージのコード（スクリプト）のハッシュ」
+「ステージの設定値」から計算したフィンガープリントで管理し、
+前回実行時からフィンガープリントが変わっていないステージはスキップします。
+依存関係のないステージ（通常 / STG命令使用 などのカテゴリごとのブランチ）は並列に実行します。
+
+使用方法:
+    python scripts/pipeline.py                 # 変更のあったステージのみ実行
+    python scripts/pipeline.py --dry-run       # 実行予定のステージを表示するのみ
+    python scripts/pipeline.py --force         # すべてのステージを再実行
+    python scripts/pipeline.py normal_split_h1 # 指定したステージ（と依存先）のみ実行
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import PIPELINE_CONFIG
+from token_store import token_store_paths
+from checkpoint import checkpoint_dir, code_version
+
+
+def _join(config, dir_key, name_key):
+    return os.path.join(config[dir_key], config[name_key])
+
+
+# ステージの種類ごとの定義
+#   module / func: 実行する関数
+#   inputs / outputs: 設定値から入力・出力パスのリストを返す関数
+#   checkpoint: 中断時に残るジャーナル・チェックポイントのパスを返す関数
+#               （存在する場合は前回の実行が完了していないため最新とみなさず、続きから再開する）
+#   ファイル単位で出力するステージ（mnm_to_txt / split_long_txt）は入力ごとの状態を出力ディレクトリに保存し、
+#   変更・削除された入力の出力のみを作り直す・削除する（checkpoint.py の FileState）
+#   path_args: pathlib.Path で渡す必要のある引数
+STAGE_TYPES = {
+    "mnm_to_txt": {
+        "module": "mnm_to_txt",
+        "func": "process_files",
+        "inputs": lambda c: [c["directory"]],
+        "outputs": lambda c: [c["output_directory"]],
+        "checkpoint": lambda c: os.path.join(c["output_directory"], ".mnm_to_txt.journal"),
+    },
+    "txt_to_jsonl": {
+        "module": "txt_to_jsonl",
+        "func": "txt_files_to_jsonl",
+        "inputs": lambda c: [c["input_dirs"]] if isinstance(c["input_dirs"], str) else list(c["input_dirs"]),
+        "outputs": lambda c: [_join(c, "output_dir", "output_filename")],
+    },
+    "split_long_txt": {
+        "module": "split_long_txt",
+        "func": "process_directory",
+        "inputs": lambda c: [c["input_dir"]],
+        "outputs": lambda c: [c["output_dir"]],
+    },
+    "split_long_jsonl": {
+        "module": "split_long_jsonl",
+        "func": "process_jsonl_file",
+        "inputs": lambda c: [c["input_file"]],
+        "outputs": lambda c: [c["output_file"]] + ([c["exceeding_file"]] if c.get("exceeding_file") else [])
+                             + (list(token_store_paths(c["token_output"])) if c.get("token_output") else []),
+        "checkpoint": lambda c: checkpoint_dir(c["output_file"]),
+    },
+    "merge_jsonl": {
+        "module": "merge_jsonl",
+        "func": "merge_jsonl_files",
+        "inputs": lambda c: [c["file1_path"], c["file2_path"]],
+        "outputs": lambda c: [c["output_path"]],
+        "path_args": ["file1_path", "file2_path", "output_path"],
+    },
+    "merge_jsonl_by_title": {
+        "module": "merge_jsonl_by_title",
+        "func": "merge_jsonl_by_title",
+        "inputs": lambda c: [c["input_file"]],
+        "outputs": lambda c: [c["output_file"]],
+        "path_args": ["input_file", "output_file"],
+    },
+    "remove_short_jsonl": {
+        "module": "remove_short_jsonl",
+        "func": "filter_jsonl_files",
+        "inputs": lambda c: [c["input_directory"]],
+        "outputs": lambda c: [c["output_directory"]],
+    },
+    "convert_kana": {
+        "module": "convert_kana",
+        "func": "convert_hankaku_to_zenkaku_kana",
+        "inputs": lambda c: [c["input_file"]],
+        "outputs": lambda c: [c["output_dir"]],
+    },
+    "convert_format": {
+        "module": "arrow_io",
+        "func": "convert",
+        "inputs": lambda c: [c["input_file"]],
+        "outputs": lambda c: [c["output_file"]],
+    },
+    "split_train_val_jsonl": {
+        "module": "split_train_val_jsonl",
+        "func": "split_jsonl",
+        "inputs": lambda c: [c["file_path"]],
+        "outputs": lambda c: [_join(c, "output_dir", "train_output"), _join(c, "output_dir", "val_output")],
+    },
+    "catalog": {
+        "module": "catalog",
+        "func": "catalog_files",
+        "inputs": lambda c: [c["input_files"]] if isinstance(c["input_files"], str) else list(c["input_files"]),
+        "outputs": lambda c: [c["path"]],
+    },
+    "pack_sequences": {
+        "module": "pack_sequences",
+        "func": "pack_sequences",
+        "inputs": lambda c: [c["input_file"]],
+        "outputs": lambda c: [c["output_file"], c["report_file"]],
+    },
+}
+
+
+class FileHashCache:
+    """
+    ファイル内容のハッシュを (サイズ, 更新時刻) をキーにキャッシュする。
+    内容の変わっていないファイルを毎回読み直さずに済むようにするためのもの。
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def file_hash(self, path):
+        abs_path = os.path.abspath(path)
+        stat = os.stat(abs_path)
+        key = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            cached = self.entries.get(abs_path)
+        if cached and cached[:2] == key:
+            return cached[2]
+
+        digest = hashlib.sha256()
+        with open(abs_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        value = digest.hexdigest()
+        with self.lock:
+            self.entries[abs_path] = key + [value]
+        return value
+
+    def path_hash(self, path):
+        """ファイルまたはディレクトリ（配下の全ファイル）の内容ハッシュを返す"""
+        if not os.path.exists(path):
+            return "missing"
+        if os.path.isfile(path):
+            return self.file_hash(path)
+
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for file in sorted(files):
+                file_path = os.path.join(root, file)
+                rel_path = os.path.relpath(file_path, path)
+                digest.update(rel_path.encode('utf-8'))
+                digest.update(self.file_hash(file_path).encode('ascii'))
+        return digest.hexdigest()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        with self.lock:
+            tmp_file = self.cache_file + ".tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+            os.replace(tmp_file, self.cache_file)
+
+
+def stage_fingerprint(stage, hash_cache):
+    """入力内容・コード・設定値からステージのフィンガープリントを計算する"""
+    stage_type = STAGE_TYPES[stage["type"]]
+    config = stage["config"]
+    payload = {
+        "type": stage["type"],
+        "code": code_version(stage_type["module"]),
+        "config": config,
+        "inputs": {path: hash_cache.path_hash(path) for path in stage_type["inputs"](config)},
+    }
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def load_stages(config):
+    """設定からステージを読み込み、依存関係を検証する"""
+    stages = {}
+    for stage in config["stages"]:
+        name = stage["name"]
+        if name in stages:
+            raise ValueError(f"ステージ名が重複しています: {name}")
+        if stage["type"] not in STAGE_TYPES:
+            raise ValueError(f"未知のステージ種別です: {stage['type']} ({name})")
+        stages[name] = {"deps": [], **stage}
+
+    for name, stage in stages.items():
+        for dep in stage["deps"]:
+            if dep not in stages:
+                raise ValueError(f"ステージ {name} の依存先 {dep} が定義されていません")
+
+    # 循環依存のチェック
+    visiting, visited = set(), set()
+
+    def visit(name):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError(f"ステージの依存関係が循環しています: {name}")
+        visiting.add(name)
+        for dep in stages[name]["deps"]:
+            visit(dep)
+        visiting.remove(name)
+        visited.add(name)
+
+    for name in stages:
+        visit(name)
+    return stages
+
+
+def select_stages(stages, targets):
+    """指定されたステージと、その依存先をすべて含むステージ名の集合を返す"""
+    if not targets:
+        return set(stages)
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in stages:
+            raise ValueError(f"ステージ {name} が定義されていません")
+        if name not in selected:
+            selected.add(name)
+            pending.extend(stages[name]["deps"])
+    return selected
+
+
+class PipelineRunner:
+    def __init__(self, config, force=False, dry_run=False):
+        self.config = config
+        self.force = force
+        self.dry_run = dry_run
+        self.stages = load_stages(config)
+        self.state_dir = os.path.join(config["cache_dir"], "state")
+        self.hash_cache = FileHashCache(os.path.join(config["cache_dir"], "file_hashes.json"))
+        self.print_lock = threading.Lock()
+
+    def log(self, message):
+        with self.print_lock:
+            print(message, flush=True)
+
+    def state_file(self, name):
+        return os.path.join(self.state_dir, f"{name}.json")
+
+    def load_state(self, name):
+        path = self.state_file(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_state(self, name, state):
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_file = self.state_file(name) + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_file, self.state_file(name))
+
+    def has_checkpoint(self, name):
+        """前回の実行が中断し、ジャーナル・チェックポイントが残っているか"""
+        stage = self.stages[name]
+        stage_type = STAGE_TYPES[stage["type"]]
+        return "checkpoint" in stage_type and os.path.exists(stage_type["checkpoint"](stage["config"]))
+
+    def is_up_to_date(self, name, fingerprint):
+        """フィンガープリントが一致し、出力がすべて存在し、中断したチェックポイントが残っていなければ最新とみなす"""
+        if self.force:
+            return False
+        state = self.load_state(name)
+        if not state or state.get("fingerprint") != fingerprint:
+            return False
+        if self.has_checkpoint(name):
+            return False
+        stage = self.stages[name]
+        outputs = STAGE_TYPES[stage["type"]]["outputs"](stage["config"])
+        return all(os.path.exists(path) for path in outputs)
+
+    def run_stage(self, name):
+        """ステージを1つ実行する。戻り値は 'skipped' / 'ran' / 'planned'"""
+        stage = self.stages[name]
+        stage_type = STAGE_TYPES[stage["type"]]
+        fingerprint = stage_fingerprint(stage, self.hash_cache)
+
+        if self.is_up_to_date(name, fingerprint):
+            self.log(f"[skip] {name}: 変更なし")
+            return "skipped"
+        if self.dry_run:
+            self.log(f"[plan] {name}: 実行予定")
+            return "planned"
+
+        kwargs = dict(stage["config"])
+        for key in stage_type.get("path_args", []):
+            kwargs[key] = Path(kwargs[key])
+        # 実行中に失敗・中断した場合に以前の状態で最新と判定されないよう、先に状態を削除する
+        if os.path.exists(self.state_file(name)):
+            os.remove(self.state_file(name))
+
+        self.log(f"[run ] {name}")
+        start = time.time()
+        module = importlib.import_module(stage_type["module"])
+        getattr(module, stage_type["func"])(**kwargs)
+        elapsed = time.time() - start
+        if self.has_checkpoint(name):
+            raise RuntimeError(f"{name} が完了しませんでした（チェックポイントが残っています）")
+
+        # 正常に終了した場合のみ記録する（ステージによっては入力を移動・変更するため、実行後の状態で記録する）
+        self.save_state(name, {
+            "fingerprint": stage_fingerprint(stage, self.hash_cache),
+            "type": stage["type"],
+            "elapsed_seconds": round(elapsed, 3),
+            "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        })
+        self.log(f"[done] {name}: {elapsed:.1f}秒")
+        return "ran"
+
+    def run(self, targets=None):
+        selected = select_stages(self.stages, targets)
+        remaining = {name: set(self.stages[name]["deps"]) & selected for name in selected}
+        results = {}
+
+        with ThreadPoolExecutor(max_workers=self.config.get("max_workers", 2)) as executor:
+            running = {}
+            while remaining or running:
+                # 依存先がすべて完了したステージを投入する
+                for name in sorted(remaining):
+                    deps = remaining[name]
+                    if any(results.get(dep) == "failed" for dep in deps):
+                        self.log(f"[fail] {name}: 依存先のステージが失敗したため実行しません")
+                        results[name] = "failed"
+                        del remaining[name]
+                    elif all(dep in results for dep in deps):
+                        running[executor.submit(self.run_stage, name)] = name
+                        del remaining[name]
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        self.log(f"[fail] {name}: {e}")
+                        results[name] = "failed"
+
+        self.hash_cache.save()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前処理パイプラインを DAG として実行します")
+    parser.add_argument("stages", nargs="*", help="実行するステージ名（省略時はすべて）")
+    parser.add_argument("--force", action="store_true", help="フィンガープリントに関係なく再実行する")
+    parser.add_argument("--dry-run", action="store_true", help="実行予定のステージを表示するのみ")
+    args = parser.parse_args()
+
+    runner = PipelineRunner(PIPELINE_CONFIG, force=args.force, dry_run=args.dry_run)
+    results = runner.run(args.stages)
+
+    counts = {}
+    for status in results.values():
+        counts[status] = counts.get(status, 0) + 1
+    print("\nパイプライン完了:")
+    for status in ("ran", "skipped", "planned", "failed"):
+        if status in counts:
+            print(f"  {status}: {counts[status]} ステージ")
+    return 1 if counts.get("failed") else 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,36 +1,107 @@
 import os
 import json
 import random
+from functools import partial
 from config import REMOVE_SHORT_JSONL_CONFIG
+from shards import is_sharded_dataset, process_shards
+from jsonl_io import iter_records, write_records, is_record_file, compression_of, is_jsonl_file, open_jsonl
+from mmap_jsonl import MappedJsonl, map_ranges
+from metrics import measure_stage, timer, count
 
-def filter_jsonl_files(input_directory, output_directory, length_limit):
+def filter_jsonl_file(file_path, length_limit):
+    """
+    1つのJSONL（または Arrow / Parquet）ファイルを読み込み、'text' が length_limit 文字より長いエントリのみを残す。
+    
+    Returns:
+        (filtered_entries, removed_texts): 残したエントリのリストと削除した'text'値のリスト
+    """
+    filtered_entries = []
+    removed_texts = []
+    # JSONとして解析できない行は無視する
+    for data in iter_records(file_path, on_error=lambda line_num, e: None):
+        if 'text' in data and isinstance(data['text'], str):
+            if len(data['text']) > length_limit:
+                filtered_entries.append(data)
+            else:
+                removed_texts.append(data['text'])
+    return filtered_entries, removed_texts
+
+def filter_line_range(file_path, part, length_limit):
+    """
+    非圧縮のJSONLファイルのバイト範囲 part = (開始, 終了) の行をフィルタリングする（並列処理用）
+
+    Returns:
+        (kept_spans, removed_texts): 残す行の (開始, 終了) のリストと削除した'text'値のリスト
+    """
+    kept_spans = []
+    removed_texts = []
+    with MappedJsonl(file_path) as reader:
+        for start, end in reader.iter_spans(*part):
+            # JSONとして解析できない行は無視する
+            try:
+                data = json.loads(reader.span(start, end).tobytes())
+            except json.JSONDecodeError:
+                continue
+            if 'text' in data and isinstance(data['text'], str):
+                if len(data['text']) > length_limit:
+                    kept_spans.append((start, end))
+                else:
+                    removed_texts.append(data['text'])
+    return kept_spans, removed_texts
+
+def filter_jsonl_file_to(file_path, output_path, length_limit, executor=None):
+    """
+    file_path をフィルタリングして output_path に書き込む。
+    入力が非圧縮のJSONLで出力もJSONLの場合は、ファイルを行の境界で分割して並列に解析し、
+    残す行を解析し直さずにそのままコピーする。
+    executor を指定した場合は新しいプロセスプールを起動せずにそのプールを使用する（cli.py のバッチ実行）。
+
+    Returns:
+        (num_kept, removed_texts): 残したエントリ数と削除した'text'値のリスト
+    """
+    if not (is_jsonl_file(file_path) and compression_of(file_path) is None and is_jsonl_file(output_path)):
+        with timer("filter"):
+            filtered_entries, removed_texts = filter_jsonl_file(file_path, length_limit)
+        with timer("write"):
+            write_records(output_path, filtered_entries)
+        count("records_out", len(filtered_entries))
+        count("records_removed", len(removed_texts))
+        return len(filtered_entries), removed_texts
+
+    with timer("filter"):
+        results = map_ranges(file_path, partial(filter_line_range, length_limit=length_limit), executor=executor)
+    num_kept = 0
+    removed_texts = []
+    with timer("write"), MappedJsonl(file_path) as reader, open_jsonl(output_path, 'wb') as f:
+        for kept_spans, part_removed_texts in results:
+            for start, end in kept_spans:
+                f.write(reader.span(start, end))
+                f.write(b'\n')
+            num_kept += len(kept_spans)
+            removed_texts.extend(part_removed_texts)
+    count("records_out", num_kept)
+    count("records_removed", len(removed_texts))
+    return num_kept, removed_texts
+
+@measure_stage("remove_short_jsonl")
+def filter_jsonl_files(input_directory, output_directory, length_limit, executor=None):
     try:
         # 出力フォルダが存在しない場合は作成する
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
             print(f"出力フォルダ {output_directory} を作成しました。")
 
-        # 入力ディレクトリ内のすべての.jsonlファイルを取得
+        # 入力ディレクトリ内のすべての.jsonl（.jsonl.gz / .jsonl.zst / .arrow / .parquet を含む）ファイルを取得
         for file_name in os.listdir(input_directory):
-            if file_name.endswith('.jsonl'):
+            if is_record_file(file_name):
                 file_path = os.path.join(input_directory, file_name)
 
-                # フィルタリングされたデータを格納するリスト
-                filtered_lines = []
-                removed_texts = []
-
-                # ファイルを読み込む
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    for line in file:
-                        try:
-                            data = json.loads(line)
-                            if 'text' in data and isinstance(data['text'], str):
-                                if len(data['text']) > length_limit:
-                                    filtered_lines.append(json.dumps(data, ensure_ascii=False))
-                                else:
-                                    removed_texts.append(data['text'])
-                        except json.JSONDecodeError:
-                            continue
+                # 出力ファイルのパスを設定（ファイル名にプレフィックス "filtered_" を付与）
+                new_file_name = "filtered_" + file_name
+                new_file_path = os.path.join(output_directory, new_file_name)
+
+                # ファイルを読み込み、フィルタリングしたデータを新しいファイルに保存する
+                num_kept, removed_texts = filter_jsonl_file_to(file_path, new_file_path, length_limit, executor)
 
                 # ランダムに50個の削除されたテキストを表示
                 if removed_texts:
@@ -40,24 +111,43 @@ def filter_jsonl_files(input_directory, output_directory, length_limit):
                         print("--------------------------------------------")
                         print(text)
 
-                # 出力ファイルのパスを設定（ファイル名にプレフィックス "filtered_" を付与）
-                new_file_name = "filtered_" + file_name
-                new_file_path = os.path.join(output_directory, new_file_name)
-
-                # フィルタリング後のデータを新しいファイルに保存
-                with open(new_file_path, 'w', encoding='utf-8') as file:
-                    file.write('\n'.join(filtered_lines))
-
                 # 保存された行数と省かれた行数を表示
                 print(f"{file_name} をフィルタリングしました。")
-                print(f"  保存された行数: {len(filtered_lines)}")
+                print(f"  保存された行数: {num_kept}")
                 print(f"  省かれた行数: {len(removed_texts)}")
                 print(f"  -> {new_file_name} に保存")
     except Exception as e:
+        # 呼び出し元（pipeline.py など）が失敗を検出できるように例外を送出し直す
         print(f"エラーが発生しました: {e}")
+        raise
+
+@measure_stage("remove_short_jsonl_shards")
+def filter_jsonl_shards(input_directory, output_directory, length_limit, worker_index=0, num_workers=1, executor=None):
+    """
+    シャード形式のデータセットをフィルタリングする（shards.py を参照）
+    新規・変更されたシャードのみを処理し、同名のシャードとして output_directory に出力する。
+    """
+    def process_shard(input_path, output_path):
+        num_kept, removed_texts = filter_jsonl_file_to(input_path, output_path, length_limit, executor)
+        return {"rows": num_kept, "tokens": None}
+
+    processed, skipped = process_shards(input_directory, output_directory, process_shard,
+                                        {"length_limit": length_limit}, worker_index, num_workers)
+    print(f"シャード処理完了: 処理 {len(processed)} 件 / スキップ {len(skipped)} 件")
+    return processed, skipped
 
-# 設定ファイルから値を読み込む
-input_directory = REMOVE_SHORT_JSONL_CONFIG["input_directory"]
-output_directory = REMOVE_SHORT_JSONL_CONFIG["output_directory"]
-length_limit = REMOVE_SHORT_JSONL_CONFIG["length_limit"]
-filter_jsonl_files(input_directory, output_directory, length_limit)
+if __name__ == "__main__":
+    # 設定ファイルから値を読み込む
+    input_directory = REMOVE_SHORT_JSONL_CONFIG["input_directory"]
+    output_directory = REMOVE_SHORT_JSONL_CONFIG["output_directory"]
+    length_limit = REMOVE_SHORT_JSONL_CONFIG["length_limit"]
+    if is_sharded_dataset(input_directory):
+        filter_jsonl_shards(
+            input_directory,
+            output_directory,
+            length_limit,
+            worker_index=REMOVE_SHORT_JSONL_CONFIG.get("worker_index", 0),
+            num_workers=REMOVE_SHORT_JSONL_CONFIG.get("num_workers", 1)
+        )
+    else:
+        filter_jsonl_files(input_directory, output_directory, length_limit)
@@ -0,0 +1,132 @@
+"""
+プロセスプールで処理するタスクの順序を決める共通モジュール（大きい順のスケジューリングとサブタスク）
+
+ディレクトリ・ファイルの順にタスクを割り当てると、巨大なプログラムが最後に割り当てられた場合に
+1つのワーカーの処理が終わるまで他のワーカーが待つことになります。このモジュールは
+
+    1. 各タスクのコスト（ファイルサイズ・テキストの文字数）を見積もり、大きい順に割り当てます（LPT）。
+    2. 巨大な文書は、全体のトークン化とセグメントのトークン化のサブタスクに分けます。
+       サブタスクはプールの共有キューに入るため、空いたワーカーが順に取って処理します。
+    3. すべてのサブタスクが終わった文書は、結果を使って残りの処理を行うタスクを最優先で割り当てます。
+    4. 結果は入力の順序に戻して返します（出力は入力の順に処理した場合と同じ）。
+
+プールに投入するタスクは（ワーカー数 + prefetch）件までとし、残りは親プロセスの優先度付きキューに保持します。
+まとめて投入すると、後から作られるタスク（3.）がすべてのタスクの後に並ぶためです。
+
+    from scheduler import run_scheduled, Subtasks
+    results = run_scheduled(pool, process_func, entries, costs=[len(entry["text"]) for entry in entries],
+                            expand=plan_subtasks, progress=progress)
+
+config.py の SCHEDULER_CONFIG で、有効・無効とサブタスクに分ける文書の大きさを設定します。
+"""
+
+import heapq
+import os
+import sys
+from concurrent.futures import wait, FIRST_COMPLETED
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import SCHEDULER_CONFIG
+from metrics import count
+
+# タスクの種類
+_ITEM = 0
+_SUBTASK = 1
+_FINISH = 2
+
+
+class Subtasks:
+    """
+    1つの item を独立したサブタスクに分けて処理する計画
+
+    tasks: [(コスト, 引数なしで呼び出せる関数)] のリスト（ワーカーに送るため、partial などのピクル化可能な関数）
+    finish: サブタスクの結果のリスト（tasks の順）を受け取り、item の結果を計算する関数（引数なし）を返す。
+        親プロセスで呼び出され、返された関数はワーカーで実行される
+    """
+
+    def __init__(self, tasks, finish):
+        self.tasks = tasks
+        self.finish = finish
+        self.results = [None] * len(tasks)
+        self.remaining = len(tasks)
+
+
+def group_by_cost(costs, budget):
+    """連続する要素をコストの合計が budget 以下になるようにまとめる（戻り値: (開始, 終了) のリスト）"""
+    groups = []
+    start = 0
+    total = 0
+    for i, cost in enumerate(costs):
+        if i > start and total + cost > budget:
+            groups.append((start, i))
+            start = i
+            total = 0
+        total += cost
+    if start < len(costs):
+        groups.append((start, len(costs)))
+    return groups
+
+
+def pool_size(pool):
+    """プールのワーカー数（取得できない場合は CPU 数）"""
+    return getattr(pool, "_max_workers", None) or os.cpu_count() or 1
+
+
+def run_scheduled(pool, func, items, costs, expand=None, progress=None):
+    """
+    items の各要素を pool で func(item) として処理し、結果を items の順のリストで返す
+
+    Args:
+        costs: 各要素の処理時間の見積もり（大きい順に割り当てる）
+        expand: expand(item) が Subtasks を返す要素はサブタスクに分けて処理する（None を返す要素はそのまま処理する）
+        progress: 指定された場合、要素の処理が終わるごとに progress.update(1) を呼び出す
+    """
+    enabled = SCHEDULER_CONFIG.get("enabled", True)
+    results = [None] * len(items)
+    # (優先度, 順番, 種類, 要素のインデックス, サブタスクの番号, 呼び出す関数) のヒープ
+    ready = []
+    for i, item in enumerate(items):
+        plan = expand(item) if enabled and expand is not None else None
+        if plan is None:
+            priority = -costs[i] if enabled else 0
+            ready.append((priority, i, _ITEM, i, None, None))
+            continue
+        count("scheduled_subtasks", len(plan.tasks))
+        for k, (cost, task) in enumerate(plan.tasks):
+            ready.append((-cost, i, _SUBTASK, i, k, (plan, task)))
+    heapq.heapify(ready)
+    order = len(items)
+
+    max_in_flight = pool_size(pool) + SCHEDULER_CONFIG.get("prefetch", 2)
+    in_flight = {}
+    while ready or in_flight:
+        while ready and len(in_flight) < max_in_flight:
+            _, _, kind, i, k, payload = heapq.heappop(ready)
+            if kind == _ITEM:
+                future = pool.submit(func, items[i])
+            elif kind == _SUBTASK:
+                future = pool.submit(payload[1])
+            else:
+                future = pool.submit(payload)
+            in_flight[future] = (kind, i, k, payload)
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            kind, i, k, payload = in_flight.pop(future)
+            if kind == _SUBTASK:
+                plan = payload[0]
+                plan.results[k] = future.result()
+                plan.remaining -= 1
+                if plan.remaining == 0:
+                    # 残りの処理は他のタスクより先に割り当てる（この文書の完了を待つ時間を短くする）
+                    order += 1
+                    heapq.heappush(ready, (float("-inf"), order, _FINISH, i, None, plan.finish(plan.results)))
+                continue
+            results[i] = future.result()
+            if progress is not None:
+                progress.update(1)
+    return results
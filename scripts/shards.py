@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+シャード形式のJSONLデータセットを扱う共通モジュール
+
+レイアウト:
+    <dataset_dir>/
+        shard-00000.jsonl             # 固定行数ごとに分割したJSONL（.jsonl.gz / .jsonl.zst も可）
+        shard-00000.manifest.json     # シャードごとのマニフェスト
+        shard-00001.jsonl
+        shard-00001.manifest.json
+        ...
+        manifest.json                 # 全シャードのマニフェストをまとめたもの
+
+シャードごとのマニフェストには行数・バイト数・トークン数・チェックサム（sha256）と、
+どの入力シャードをどの設定で処理した結果かを記録します。
+各ステージは入力シャードのチェックサムと設定が変わっていないシャードをスキップするため、
+新しいデータを追加した場合は追加されたシャードのみが処理されます。
+シャードごとにマニフェストを持つため、複数のマシンで別々のシャードを並列に処理できます。
+
+使用方法（単一のJSONLファイルをシャード形式に変換）:
+    python scripts/shards.py
+
+設定:
+    config.pyのSHARDS_CONFIGで設定を変更可能
+"""
+
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from jsonl_io import open_jsonl, splitext_jsonl, frame_index_path
+from mmap_jsonl import MappedJsonl
+
+MANIFEST_FILE = "manifest.json"
+SHARD_META_SUFFIX = ".manifest.json"
+DEFAULT_SHARD_SIZE = 10000
+
+
+def shard_name(index, suffix=".jsonl"):
+    return f"shard-{index:05d}{suffix}"
+
+
+def is_sharded_dataset(path):
+    """path がシャード形式のデータセット（manifest.json を持つディレクトリ）かどうか"""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_FILE))
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def params_hash(params):
+    """ステージの設定値のハッシュ（設定が変わったシャードを再処理するために使用）"""
+    encoded = json.dumps(params, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _write_json_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def shard_meta_path(dataset_dir, name):
+    return os.path.join(dataset_dir, splitext_jsonl(name)[0] + SHARD_META_SUFFIX)
+
+
+def load_shard_meta(dataset_dir, name):
+    path = shard_meta_path(dataset_dir, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def remove_shard_meta(dataset_dir, name):
+    path = shard_meta_path(dataset_dir, name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def write_shard_meta(dataset_dir, name, rows, tokens=None, source=None, params=None):
+    """シャードのマニフェストを書き込む（シャード本体の書き込み完了後に呼ぶこと）"""
+    path = os.path.join(dataset_dir, name)
+    meta = {
+        "name": name,
+        "rows": rows,
+        "bytes": os.path.getsize(path),
+        "tokens": tokens,
+        "sha256": file_sha256(path),
+        "source": source,
+        "params": params
+    }
+    _write_json_atomic(shard_meta_path(dataset_dir, name), meta)
+    return meta
+
+
+def load_manifest(dataset_dir):
+    with open(os.path.join(dataset_dir, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def build_manifest(dataset_dir, **extra):
+    """
+    シャードごとのマニフェストを集約して manifest.json を作り直す。
+    extra に指定した値は manifest.json にそのまま保存される（既存の値は引き継ぐ）。
+    """
+    manifest_path = os.path.join(dataset_dir, MANIFEST_FILE)
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+
+    shards = []
+    for file_name in sorted(os.listdir(dataset_dir)):
+        if file_name.endswith(SHARD_META_SUFFIX):
+            with open(os.path.join(dataset_dir, file_name), 'r', encoding='utf-8') as f:
+                shards.append(json.load(f))
+
+    token_values = [shard["tokens"] for shard in shards]
+    manifest = {key: value for key, value in previous.items() if key not in ("shards", "totals")}
+    manifest.update(extra)
+    manifest["totals"] = {
+        "shards": len(shards),
+        "rows": sum(shard["rows"] for shard in shards),
+        "bytes": sum(shard["bytes"] for shard in shards),
+        # トークン数が不明なシャードが1つでもあれば合計も不明とする
+        "tokens": sum(token_values) if shards and None not in token_values else None
+    }
+    manifest["shards"] = shards
+    _write_json_atomic(manifest_path, manifest)
+    return manifest
+
+
+class ShardWriter:
+    """
+    エントリを固定行数ごとのシャードに書き込む。
+    append=True の場合、既存のシャードには手を加えず新しいシャードとして追記する。
+    suffix に ".jsonl.zst" などを指定すると圧縮したシャードを書き込む。
+    """
+
+    def __init__(self, dataset_dir, shard_size=DEFAULT_SHARD_SIZE, append=False, suffix=".jsonl"):
+        self.dataset_dir = dataset_dir
+        self.shard_size = shard_size
+        self.suffix = suffix
+        os.makedirs(dataset_dir, exist_ok=True)
+
+        self.next_index = 0
+        if append and is_sharded_dataset(dataset_dir):
+            existing = [shard["name"] for shard in load_manifest(dataset_dir)["shards"]]
+            if existing:
+                self.next_index = int(existing[-1].split('-')[1].split('.')[0]) + 1
+
+        self.file = None
+        self.rows = 0
+        self.tokens = 0
+        self.written_shards = []
+
+    def _open_shard(self):
+        self.current_name = shard_name(self.next_index, self.suffix)
+        self.next_index += 1
+        # 圧縮形式を拡張子で判定するため、一時ファイルは拡張子を保ったまま先頭に印を付ける
+        self.tmp_path = os.path.join(self.dataset_dir, ".tmp-" + self.current_name)
+        self.file = open_jsonl(self.tmp_path, 'w')
+        self.rows = 0
+        self.tokens = 0
+
+    def _close_shard(self):
+        self.file.close()
+        self.file = None
+        final_path = os.path.join(self.dataset_dir, self.current_name)
+        os.replace(self.tmp_path, final_path)
+        if os.path.exists(frame_index_path(self.tmp_path)):
+            os.replace(frame_index_path(self.tmp_path), frame_index_path(final_path))
+        write_shard_meta(self.dataset_dir, self.current_name, self.rows, tokens=self.tokens)
+        self.written_shards.append(self.current_name)
+
+    def write(self, entry, tokens=None):
+        if self.file is None:
+            self._open_shard()
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.rows += 1
+        # トークン数が渡されないエントリが1つでもあればシャードのトークン数は不明とする
+        if tokens is None or self.tokens is None:
+            self.tokens = None
+        else:
+            self.tokens += tokens
+        if self.rows >= self.shard_size:
+            self._close_shard()
+
+    def close(self, **manifest_extra):
+        if self.file is not None:
+            self._close_shard()
+        return build_manifest(self.dataset_dir, **manifest_extra)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self.file is not None:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+
+def _is_current(output_dir, name, source, stage_params):
+    """出力のシャードが同じ入力シャード・設定で作成済みかどうか"""
+    existing = load_shard_meta(output_dir, name)
+    return bool(existing) and existing.get("source") == source and existing.get("params") == stage_params \
+        and os.path.exists(os.path.join(output_dir, name))
+
+
+def _remove_deleted_shards(output_dir, input_names):
+    """入力から削除されたシャードの出力を削除する"""
+    for file_name in os.listdir(output_dir):
+        if file_name.endswith(SHARD_META_SUFFIX):
+            with open(os.path.join(output_dir, file_name), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get("source") and meta["source"]["name"] not in input_names:
+                os.remove(os.path.join(output_dir, meta["name"]))
+                remove_shard_meta(output_dir, meta["name"])
+
+
+def process_shards(input_dir, output_dir, process_shard, params, worker_index=0, num_workers=1):
+    """
+    入力データセットのシャードを1つずつ処理し、同名のシャードとして output_dir に出力する。
+    入力シャードのチェックサムと設定値（params）が前回と同じで出力が存在するシャードはスキップする。
+    JOB_LEDGER_CONFIG の enabled が True の場合は、担当を固定せずに output_dir の台帳からシャードを取得する
+    （process_shards_distributed を参照）。
+
+    Args:
+        process_shard: process_shard(input_path, output_path) -> {"rows": int, "tokens": int or None}
+        params: ステージの設定値（変更されると全シャードを再処理する）
+        worker_index, num_workers: 複数マシンで分担する場合の担当番号と総数
+            （シャード番号 % num_workers == worker_index のシャードのみを処理する）
+
+    Returns:
+        (processed, skipped): 処理したシャード名のリストとスキップしたシャード名のリスト
+    """
+    from job_ledger import ledger_enabled
+    if ledger_enabled():
+        return process_shards_distributed(input_dir, output_dir, process_shard, params)
+
+    manifest = load_manifest(input_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    stage_params = params_hash(params)
+
+    processed = []
+    skipped = []
+    input_names = set()
+    for index, shard in enumerate(manifest["shards"]):
+        name = shard["name"]
+        input_names.add(name)
+        if index % num_workers != worker_index:
+            continue
+
+        source = {"name": name, "sha256": shard["sha256"]}
+        output_path = os.path.join(output_dir, name)
+        if _is_current(output_dir, name, source, stage_params):
+            skipped.append(name)
+            continue
+
+        # マニフェストを先に削除しておき、処理途中で中断した場合は次回に再処理されるようにする
+        remove_shard_meta(output_dir, name)
+        stats = process_shard(os.path.join(input_dir, name), output_path)
+        write_shard_meta(output_dir, name, stats["rows"], stats.get("tokens"), source, stage_params)
+        processed.append(name)
+
+    # 入力から削除されたシャードの出力を削除する（分担処理時は担当0のみが行う）
+    if worker_index == 0:
+        _remove_deleted_shards(output_dir, input_names)
+
+    build_manifest(output_dir)
+    return processed, skipped
+
+
+def process_shards_distributed(input_dir, output_dir, process_shard, params, worker_id=None):
+    """
+    process_shards と同じ処理を、output_dir の台帳（job_ledger.py）からシャードを1つずつ取得して行う。
+    同じ共有ストレージ上の output_dir に対して、任意の数のワーカー（マシン・プロセス）を起動できる。
+
+    各シャードは一時ファイルに出力してからリネームし、その後にシャードのマニフェストと台帳の完了を記録する。
+    途中で停止したワーカーのシャードはリースの期限が切れた後に他のワーカーが処理し直す。
+    すべてのシャードが完了した後、各ワーカーは台帳のロックを保持したまま削除されたシャードの出力の削除と
+    manifest.json の作成を行う（同じ結果になるため、最後に終了したワーカーのものが残る）。
+    """
+    from checkpoint import replace_file
+    from job_ledger import open_ledger, default_worker_id, FAILED
+
+    worker_id = worker_id or default_worker_id()
+    manifest = load_manifest(input_dir)
+    stage_params = params_hash(params)
+    ledger = open_ledger(output_dir)
+
+    shards = {shard["name"]: shard for shard in manifest["shards"]}
+    ledger.register({name: (f"{shard['sha256']}:{stage_params}", shard["bytes"]) for name, shard in shards.items()})
+    # 台帳では完了していても出力が失われたシャードは処理し直す
+    ledger.reset([name for name, shard in shards.items()
+                  if not _is_current(output_dir, name, {"name": name, "sha256": shard["sha256"]}, stage_params)])
+
+    processed = []
+    skipped = []
+    while True:
+        name = ledger.claim(worker_id)
+        if name is None:
+            break
+        with ledger.lease(name, worker_id):
+            source = {"name": name, "sha256": shards[name]["sha256"]}
+            output_path = os.path.join(output_dir, name)
+            if _is_current(output_dir, name, source, stage_params):
+                skipped.append(name)
+                continue
+            remove_shard_meta(output_dir, name)
+            # 圧縮形式を拡張子で判定するため、一時ファイルは拡張子を保ったまま先頭にワーカーの印を付ける
+            tmp_path = os.path.join(output_dir, f".tmp-{worker_id}-{name}")
+            stats = process_shard(os.path.join(input_dir, name), tmp_path)
+            replace_file(tmp_path, output_path)
+            write_shard_meta(output_dir, name, stats["rows"], stats.get("tokens"), source, stage_params)
+            processed.append(name)
+
+    failed = ledger.names(FAILED)
+    if failed:
+        print(f"警告: 処理に失敗したシャード（試行回数の上限に達した。job_ledger.py --reset-failed で再実行の対象に戻せます）: {', '.join(failed)}")
+    with ledger.exclusive():
+        _remove_deleted_shards(output_dir, set(shards))
+        build_manifest(output_dir)
+    return processed, skipped
+
+
+def count_lines(path):
+    """空行を除いた行数を数える"""
+    with MappedJsonl(path) as reader:
+        return len(reader)
+
+
+def jsonl_to_shards(input_file, output_dir, shard_size=DEFAULT_SHARD_SIZE, suffix=".jsonl"):
+    """単一のJSONLファイルをシャード形式のデータセットに変換する"""
+    with ShardWriter(output_dir, shard_size, suffix=suffix) as writer, open_jsonl(input_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                writer.write(json.loads(line))
+    return load_manifest(output_dir)
+
+
+def shards_to_jsonl(dataset_dir, output_file):
+    """シャード形式のデータセットを単一のJSONLファイルに結合する"""
+    manifest = load_manifest(dataset_dir)
+    with open_jsonl(output_file, 'w') as out_f:
+        for shard in manifest["shards"]:
+            with open_jsonl(os.path.join(dataset_dir, shard["name"])) as in_f:
+                for line in in_f:
+                    if line.strip():
+                        out_f.write(line if line.endswith('\n') else line + '\n')
+
+
+def main():
+    from config import SHARDS_CONFIG
+
+    input_file = SHARDS_CONFIG["input_file"]
+    output_dir = SHARDS_CONFIG["output_dir"]
+    shard_size = SHARDS_CONFIG.get("shard_size", DEFAULT_SHARD_SIZE)
+    suffix = SHARDS_CONFIG.get("suffix", ".jsonl")
+
+    print(f"入力ファイル: {input_file}")
+    print(f"出力ディレクトリ: {output_dir}")
+    manifest = jsonl_to_shards(input_file, output_dir, shard_size, suffix)
+    print(f"シャード数: {manifest['totals']['shards']}")
+    print(f"総行数: {manifest['totals']['rows']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,31 @@
 import os
 import json
 import math
+import bisect
+import numpy as np
 from tqdm import tqdm
-from transformers import AutoTokenizer
 from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from functools import partial
-from config import SPLIT_LONG_JSONL_CONFIG
+from config import SPLIT_LONG_JSONL_CONFIG, CHECKPOINT_CONFIG, SCHEDULER_CONFIG
+from shards import is_sharded_dataset, process_shards, write_shard_meta, build_manifest, count_lines
+from jsonl_io import write_records, splitext_jsonl
+from token_store import TokenStore, TokenStoreWriter, TOKEN_DTYPE
+from checkpoint import (ChunkCheckpoint, checkpoint_dir, input_fingerprint, iter_records_from, iter_chunks,
+                        concat_records)
+from metrics import measure_stage, timer, count, merge, pop_delta
+from tokenizer_backend import get_tokenizer
+from batching import tokenize_batched
+from scheduler import run_scheduled, Subtasks, group_by_cost
 
 # 環境変数で警告を回避（必要に応じて）
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-# 設定ファイルからモデル名を取得してトークナイザーをロード
-tokenizer = AutoTokenizer.from_pretrained(SPLIT_LONG_JSONL_CONFIG["model_name"])
+def get_split_tokenizer():
+    """設定ファイルのモデル名のトークナイザー（各プロセスで最初に使用したときに読み込む）"""
+    return get_tokenizer(SPLIT_LONG_JSONL_CONFIG["model_name"])
 
-def split_segments_by_max_sum(segment_token_counts, delimiter_cost, token_limit):
+def split_segments_by_max_sum(segment_token_counts, delimiter_cost, token_limit, boundary_costs=None):
     """
     与えられた各セグメントのトークン数リストから、
     チャンク毎のトークン数（セグメント合計＋各区切りのコスト）を、
@@ -23,18 +35,25 @@ def split_segments_by_max_sum(segment_token_counts, delimiter_cost, token_limit)
       token_limit を上限とした場合のチャンク数 target_chunks を求め、
     その数を崩さずに、チャンク内のトークン数（最大値）を最小化する分割を二分探索で求める。
 
+    boundary_costs: 指定された場合、i 番目と i+1 番目のセグメントの区切りのコストとして
+      delimiter_cost の代わりに boundary_costs[i] を使用する（measure_boundary_costs を参照）
+
     戻り値:
       - partitions: 各チャンクの (開始, 終了) インデックスのタプルリスト
       - chunk_token_counts: 各チャンクのトークン数リスト
     """
     n = len(segment_token_counts)
+    if boundary_costs is None:
+        boundary_costs = [delimiter_cost] * (n - 1)
+    # (区切りのコスト, 次のセグメントのトークン数)
+    steps = list(zip(boundary_costs, segment_token_counts[1:]))
     
     def chunks_needed(max_allowed):
         chunks = 1
         current = segment_token_counts[0]
-        for count in segment_token_counts[1:]:
-            if current + delimiter_cost + count <= max_allowed:
-                current += delimiter_cost + count
+        for cost, count in steps:
+            if current + cost + count <= max_allowed:
+                current += cost + count
             else:
                 chunks += 1
                 current = count
@@ -54,51 +73,393 @@ def split_segments_by_max_sum(segment_token_counts, delimiter_cost, token_limit)
             low = mid + 1
 
     partitions = []
+    chunk_token_counts = []
     current_sum = segment_token_counts[0]
     start_index = 0
-    for i in range(1, n):
-        if current_sum + delimiter_cost + segment_token_counts[i] <= optimal:
-            current_sum += delimiter_cost + segment_token_counts[i]
+    for i, (cost, count) in enumerate(steps, 1):
+        if current_sum + cost + count <= optimal:
+            current_sum += cost + count
         else:
             partitions.append((start_index, i - 1))
+            chunk_token_counts.append(current_sum)
             start_index = i
-            current_sum = segment_token_counts[i]
+            current_sum = count
     partitions.append((start_index, n - 1))
+    chunk_token_counts.append(current_sum)
+    
+    return partitions, chunk_token_counts
+
+def split_oversized_segment(text, offsets, token_limit):
+    """
+    token_limit を超える1つのセグメントを、トークン化したときの offset_mapping を使って分割する。
+    各部分は token_limit トークン以下で、できるだけ行の境界（改行で終わるトークンの直後）で区切る。
+    区切り位置は行の境界のトークン番号を二分探索して求めるため、セグメントを再度トークン化しない。
+    1行で token_limit を超える場合は、その行をトークンの境界（文字の途中以外）で区切る。
+
+    戻り値: 各部分の (開始トークン番号, 終了トークン番号, 開始文字位置, 終了文字位置) のリスト
+    """
+    n_tokens = len(offsets)
+    # 行の境界で区切れる位置（改行で終わるトークンの次のトークン番号）
+    line_breaks = [i + 1 for i, (start, end) in enumerate(offsets) if end > start and text[end - 1] == '\n']
     
+    pieces = []
+    token_start = 0
+    char_start = 0
+    while token_start < n_tokens:
+        token_end = min(token_start + token_limit, n_tokens)
+        if token_end < n_tokens:
+            # token_end 以下で最も後ろにある行の境界
+            k = bisect.bisect_right(line_breaks, token_end) - 1
+            if k >= 0 and line_breaks[k] > token_start:
+                token_end = line_breaks[k]
+            else:
+                # 1文字が複数のトークンになっている場合（バイト単位のトークン）は文字の途中で区切らない
+                while token_end > token_start + 1 and offsets[token_end][0] < offsets[token_end - 1][1]:
+                    token_end -= 1
+        char_end = offsets[token_end][0] if token_end < n_tokens else len(text)
+        pieces.append((token_start, token_end, char_start, char_end))
+        token_start, char_start = token_end, char_end
+    return pieces
+
+def partition_segments(segments, segment_token_counts, delimiter_cost, token_limit, offset_mapping=None,
+                       boundary_costs=None, max_chunk_tokens=None):
+    """
+    セグメントを token_limit 以下のチャンクに分割する。
+    offset_mapping（各セグメントのトークンの文字位置）を指定した場合、token_limit を超えるセグメントを
+    split_oversized_segment で分割し、各部分を単独のチャンクとする（delimiter で連結すると元のテキストと
+    変わるため、前後のセグメントとは連結しない）。その間のセグメントは split_segments_by_max_sum で分割する。
+    boundary_costs: 各区切りのコスト（split_segments_by_max_sum を参照）
+    max_chunk_tokens: 連結したチャンクの上限（省略時は token_limit。plan_chunks で検証に失敗した場合に下げる）
+
+    戻り値:
+      - chunks: 各チャンクを構成する (セグメント番号, 開始トークン番号, 終了トークン番号, 開始文字位置, 終了文字位置)
+        のリスト（チャンクのテキストは各部分を delimiter で連結したもの）
+      - chunk_token_counts: 各チャンクのトークン数リスト
+    """
+    max_chunk_tokens = max_chunk_tokens or token_limit
+    oversized = [] if offset_mapping is None else [
+        i for i, token_count in enumerate(segment_token_counts) if token_count > token_limit
+    ]
+    chunks = []
     chunk_token_counts = []
-    for start, end in partitions:
-        count = sum(segment_token_counts[start:end+1]) + delimiter_cost * (end - start)
-        chunk_token_counts.append(count)
+    run_start = 0
+    for run_end in oversized + [len(segments)]:
+        # 制限を超えるセグメントの間のセグメントは、これまでと同じく delimiter で連結して分割する
+        if run_start < run_end:
+            partitions, counts = split_segments_by_max_sum(
+                segment_token_counts[run_start:run_end], delimiter_cost, max_chunk_tokens,
+                boundary_costs[run_start:run_end - 1] if boundary_costs is not None else None
+            )
+            for start, end in partitions:
+                chunks.append([(j, 0, segment_token_counts[j], 0, len(segments[j]))
+                               for j in range(run_start + start, run_start + end + 1)])
+            chunk_token_counts.extend(counts)
+        if run_end < len(segments):
+            for token_start, token_end, char_start, char_end in split_oversized_segment(
+                    segments[run_end], offset_mapping[run_end], token_limit):
+                chunks.append([(run_end, token_start, token_end, char_start, char_end)])
+                chunk_token_counts.append(token_end - token_start)
+        run_start = run_end + 1
+    return chunks, chunk_token_counts
+
+# measure_boundary_costs で区切りの前後に含めるトークン数と、測定結果のキャッシュ（プロセスごと）
+BOUNDARY_CONTEXT_TOKENS = 2
+_BOUNDARY_CACHE_SIZE = 1 << 16
+_boundary_cache = {}
+
+def measure_boundary_costs(segments, offset_mapping, delimiter, tokenizer):
+    """
+    隣り合うセグメントを delimiter で連結したときの区切りのコストを求める。
+    BPE では区切りの前後のトークンが delimiter と結合するため、実際のトークン数は
+    「セグメントのトークン数の合計 + delimiter のトークン数 × 区切りの数」と一致しない。
+    前のセグメントの末尾と次のセグメントの先頭の BOUNDARY_CONTEXT_TOKENS トークン（offset_mapping の文字位置）を
+    delimiter で連結してトークン化し、末尾・先頭それぞれのトークン数との差を区切りのコストとする。
+    同じ (delimiter, 末尾, 先頭) の組み合わせは1度だけ測定してキャッシュする。
+
+    戻り値: i 番目と i+1 番目のセグメントの区切りのコストのリスト
+    """
+    keys = []
+    for i in range(len(segments) - 1):
+        tail_start = offset_mapping[i][-min(BOUNDARY_CONTEXT_TOKENS, len(offset_mapping[i]))][0]
+        head_end = offset_mapping[i + 1][min(BOUNDARY_CONTEXT_TOKENS, len(offset_mapping[i + 1])) - 1][1]
+        keys.append((delimiter, segments[i][tail_start:], segments[i + 1][:head_end]))
     
-    return partitions, chunk_token_counts
+    missing = list(dict.fromkeys(key for key in keys if key not in _boundary_cache))
+    if missing:
+        if len(_boundary_cache) + len(missing) > _BOUNDARY_CACHE_SIZE:
+            _boundary_cache.clear()
+        # [連結したテキスト..., 末尾..., 先頭...] を1回でトークン化する
+        texts = [tail + delimiter + head for _, tail, head in missing]
+        texts += [tail for _, tail, _ in missing] + [head for _, _, head in missing]
+        with timer("measure_boundaries"):
+            ids = tokenize_batched(tokenizer, texts, add_special_tokens=False)['input_ids']
+        n_missing = len(missing)
+        for i, key in enumerate(missing):
+            _boundary_cache[key] = len(ids[i]) - len(ids[n_missing + i]) - len(ids[2 * n_missing + i])
+        count("boundary_patterns", n_missing)
+    return [_boundary_cache[key] for key in keys]
+
+def chunk_text(segments, parts, delimiter):
+    """partition_segments のチャンク1つ分のテキスト"""
+    return delimiter.join(segments[j][char_start:char_end] for j, _, _, char_start, char_end in parts)
+
+def plan_chunks(segments, tokenized, delimiter_cost, token_limit, delimiter, tokenizer, split_oversized_segments=True,
+                accounting="boundary", verify_margin=64):
+    """
+    トークン化したセグメントを token_limit 以下のチャンクに分割する
+
+    accounting:
+      - "additive": チャンクのトークン数を「セグメントの合計 + delimiter_cost × 区切りの数」とする
+        （区切りの前後のトークンの結合は考慮しないため、実際のトークン数が token_limit を超える場合がある）
+      - "boundary": 区切りのコストを measure_boundary_costs で測定し、推定したトークン数が
+        token_limit - verify_margin 以上の複数のセグメントからなるチャンクのみを実際にトークン化して検証する。
+        検証したチャンクが token_limit を超えた場合は、超えた分だけ上限を下げて分割し直す。
+        測定は区切りの前後 BOUNDARY_CONTEXT_TOKENS トークンのみで行うため、推定の誤差に上限はなく、
+        verify_margin は経験的な余裕（検証しないチャンクが token_limit 以下になる保証はない）。
+        verify_margin=None の場合は複数のセグメントからなるチャンクをすべて検証し、token_limit 以下を保証する。
+    tokenized: tokenizer(segments, add_special_tokens=False, return_offsets_mapping=...) の結果
+        （"boundary" の場合と制限を超えるセグメントを分割する場合は offset_mapping が必要）
+
+    戻り値:
+      - chunks / chunk_token_counts: partition_segments の戻り値（検証したチャンクは実際のトークン数）
+      - verified_ids: 検証したチャンクの番号 → 実際にトークン化したトークンID
+    """
+    segment_token_counts = [len(ids) for ids in tokenized['input_ids']]
+    oversized = split_oversized_segments and any(count > token_limit for count in segment_token_counts)
+    offset_mapping = tokenized['offset_mapping'] if oversized or accounting == "boundary" else None
+    if accounting not in ("additive", "boundary"):
+        raise ValueError(f"不明なトークン数の計算方法です: {accounting}")
+    
+    boundary_costs = None
+    if accounting == "boundary" and len(segments) > 1:
+        boundary_costs = measure_boundary_costs(segments, offset_mapping, delimiter, tokenizer)
+    
+    max_chunk_tokens = token_limit
+    verified = {}  # チャンクを構成する部分 → 実際のトークンID
+    while True:
+        with timer("partition"):
+            chunks, chunk_token_counts = partition_segments(
+                segments, segment_token_counts, delimiter_cost, token_limit,
+                offset_mapping if oversized else None, boundary_costs, max_chunk_tokens
+            )
+        if boundary_costs is None:
+            return chunks, chunk_token_counts, {}
+        
+        # 上限に近いチャンク（verify_margin=None の場合はすべて）を実際にトークン化して検証する
+        # （1つのセグメントのみのチャンクは正確なため対象外）
+        targets = [i for i, parts in enumerate(chunks)
+                   if len(parts) > 1 and (verify_margin is None or chunk_token_counts[i] >= token_limit - verify_margin)]
+        unverified = [i for i in targets if tuple(chunks[i]) not in verified]
+        if unverified:
+            with timer("verify"):
+                ids = tokenize_batched(tokenizer, [chunk_text(segments, chunks[i], delimiter) for i in unverified],
+                                       add_special_tokens=False)['input_ids']
+            for i, chunk_ids in zip(unverified, ids):
+                verified[tuple(chunks[i])] = chunk_ids
+            count("verified_chunks", len(unverified))
+        
+        overflow = 0
+        for i in targets:
+            chunk_token_counts[i] = len(verified[tuple(chunks[i])])
+            overflow = max(overflow, chunk_token_counts[i] - token_limit)
+        if overflow <= 0:
+            return chunks, chunk_token_counts, {i: verified[tuple(chunks[i])] for i in targets}
+        count("repartitions")
+        max_chunk_tokens -= overflow
+
+def split_content(content, delimiter):
+    """テキストを delimiter でセグメントに分割する（空白のみのセグメントは除く）"""
+    segments = content.split(delimiter)
+    return [seg.strip() for seg in segments if seg.strip()]
+
+# テキスト全体のトークン化を範囲に分ける場合に、各範囲の末尾に重ねてトークン化する次の範囲の先頭の文字数と、
+# そのうち末尾で切れたことによってトークン化が変わる可能性があるため比較しない文字数
+STITCH_OVERLAP_CHARS = 4096
+STITCH_TAIL_CHARS = 256
+
+def tokenize_content(content, model_name):
+    """テキスト全体をトークン化する"""
+    with timer("tokenize"):
+        ids = get_tokenizer(model_name)(content)['input_ids']
+    return np.asarray(ids, dtype=TOKEN_DTYPE)
+
+def content_ranges(content, size):
+    """テキストを size 文字程度の (開始, 終了) の範囲に分ける（境界はできるだけ行の先頭に合わせる）"""
+    cuts = [0]
+    while len(content) - cuts[-1] > size:
+        target = cuts[-1] + size
+        newline = content.find("\n", target, target + size // 2)
+        cuts.append(newline + 1 if newline != -1 else target)
+    cuts.append(len(content))
+    return list(zip(cuts[:-1], cuts[1:]))
+
+def special_token_affixes(tokenizer):
+    """add_special_tokens=True の場合にテキストの前後に追加されるトークンID (前, 後)"""
+    plain = list(tokenizer("a", add_special_tokens=False)['input_ids'])
+    full = list(tokenizer("a", add_special_tokens=True)['input_ids'])
+    for i in range(len(full) - len(plain) + 1):
+        if full[i:i + len(plain)] == plain:
+            return full[:i], full[i + len(plain):]
+    raise ValueError("特殊トークンの位置を判定できませんでした")
 
-def process_jsonl_entry(entry, output_dir, token_limit=32700, exceeding_entries=None, delimiter=";<h1/>"):
+def tokenize_content_range(text, start, model_name, with_affixes=False):
+    """
+    テキスト全体のトークン化の一部（範囲と、その末尾に重ねた次の範囲の先頭）をトークン化する（scheduler.py のサブタスク）
+    戻り値: ((トークンID, 各トークンの開始・終了の文字位置（テキスト全体での位置）, 特殊トークン or None), メトリクス)
+    """
+    tokenizer = get_tokenizer(model_name)
+    with timer("tokenize"):
+        encoded = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    offsets = np.asarray(encoded['offset_mapping'], dtype=np.int64).reshape(-1, 2) + start
+    affixes = special_token_affixes(tokenizer) if with_affixes else None
+    return (np.asarray(encoded['input_ids'], dtype=TOKEN_DTYPE), offsets[:, 0], offsets[:, 1], affixes), pop_delta()
+
+def _token_boundaries(starts, ends):
+    """直前のトークンと文字位置が重ならずに始まるトークンの添字（マルチバイト文字の途中から始まるトークンを除く）"""
+    mask = np.ones(len(starts), dtype=bool)
+    mask[1:] = ends[:-1] <= starts[1:]
+    return mask
+
+def stitch_tokenized(pieces):
+    """
+    tokenize_content_range の結果を連結して、テキスト全体をトークン化した場合のトークンIDを返す
+    範囲 i は次の範囲の先頭と重ねてトークン化しているため、重ねた部分で両方のトークン化の境界が一致し、
+    そこから重ねた部分の末尾の STITCH_TAIL_CHARS 文字の手前までのトークンがすべて一致する最初の位置で
+    次の範囲に切り替える（次の範囲は右側の文脈を含むため、一致すれば範囲 i の末尾で切れた影響はない）。
+    該当する位置がない場合は None を返す（呼び出し元でテキスト全体をトークン化する）。
+    """
+    ids, starts, ends, _ = pieces[0]
+    parts = []
+    for next_ids, next_starts, next_ends, _ in pieces[1:]:
+        if not len(ids) or not len(next_ids):
+            return None
+        boundaries = np.flatnonzero(_token_boundaries(starts, ends))
+        next_boundaries = _token_boundaries(next_starts, next_ends)
+        # 比較するトークンの終わり（末尾の STITCH_TAIL_CHARS 文字にかかるトークンの手前）
+        last = np.searchsorted(ends, ends[-1] - STITCH_TAIL_CHARS, side='right')
+        switch = None
+        for j in boundaries[(starts[boundaries] >= next_starts[0]) & (boundaries < last)]:
+            k = np.searchsorted(next_starts, starts[j])
+            length = last - j
+            if k >= len(next_starts) or next_starts[k] != starts[j] or not next_boundaries[k] \
+                    or k + length > len(next_ids):
+                continue
+            if np.array_equal(ids[j:last], next_ids[k:k + length]) and \
+                    np.array_equal(ends[j:last], next_ends[k:k + length]):
+                switch = j, k
+                break
+        if switch is None:
+            return None
+        j, k = switch
+        parts.append(ids[:j])
+        ids, starts, ends = next_ids[k:], next_starts[k:], next_ends[k:]
+    parts.append(ids)
+    prefix, suffix = pieces[0][3]
+    return np.concatenate([np.asarray(prefix, dtype=TOKEN_DTYPE)] + parts + [np.asarray(suffix, dtype=TOKEN_DTYPE)])
+
+def tokenize_segments(segments, model_name, return_offsets_mapping):
+    """セグメントの一部をトークン化する（scheduler.py のサブタスク）"""
+    tokenized = tokenize_batched(get_tokenizer(model_name), segments, add_special_tokens=False,
+                                 return_offsets_mapping=return_offsets_mapping)
+    return dict(tokenized), pop_delta()
+
+def plan_document_subtasks(content, delimiter, model_name, return_offsets_mapping, process):
+    """
+    SCHEDULER_CONFIG["expand_chars"] 文字以上のテキストを、全体のトークン化とセグメントのトークン化のサブタスク
+    （それぞれ subtask_chars 文字ずつ）に分ける。process(pretokenized) は残りの処理を行う関数を返す
+    （pretokenized: (テキスト全体のトークンID, セグメントのリスト, セグメントのトークン化の結果)）
+    テキスト全体のトークン化は範囲ごとにトークン化して stitch_tokenized で連結する。
+    """
+    if len(content) < SCHEDULER_CONFIG["expand_chars"]:
+        return None
+    segments = split_content(content, delimiter)
+    groups = group_by_cost([len(segment) for segment in segments], SCHEDULER_CONFIG["subtask_chars"])
+    ranges = content_ranges(content, SCHEDULER_CONFIG["subtask_chars"])
+    tasks = []
+    for i, (start, end) in enumerate(ranges):
+        text = content[start:min(end + STITCH_OVERLAP_CHARS, len(content))]
+        tasks.append((len(text), partial(tokenize_content_range, text, start, model_name, with_affixes=i == 0)))
+    for start, end in groups:
+        tasks.append((sum(len(segment) for segment in segments[start:end]),
+                      partial(tokenize_segments, segments[start:end], model_name, return_offsets_mapping)))
+    
+    def finish(results):
+        pieces = []
+        for piece, metrics_delta in results[:len(ranges)]:
+            merge(metrics_delta)
+            pieces.append(piece)
+        segment_results = results[len(ranges):]
+        original_ids = stitch_tokenized(pieces)
+        if original_ids is None:
+            count("stitch_fallbacks")
+            original_ids = tokenize_content(content, model_name)
+        tokenized = {"input_ids": []}
+        for part, metrics_delta in segment_results:
+            merge(metrics_delta)
+            for key, values in part.items():
+                tokenized.setdefault(key, []).extend(values)
+        return process((original_ids, segments, tokenized))
+    return Subtasks(tasks, finish)
+
+def process_jsonl_entry(entry, output_dir, token_limit=32700, exceeding_entries=None, delimiter=";<h1/>", token_counts=None,
+                        token_ids=None, split_oversized_segments=True, accounting="boundary", verify_margin=64,
+                        pretokenized=None):
     """
     JSONLの1エントリを処理する
     entry: {"id": "", "title": "", "text": ""} 形式の辞書
+    token_counts: 指定された場合、出力したエントリのトークン数を追加する
+    token_ids: 指定された場合、出力したエントリのトークンID（uint32 の numpy 配列）を追加する
+        （分割したチャンクはセグメントのトークンIDを delimiter のトークンIDで連結したもの。
+        plan_chunks で検証したチャンクは実際にトークン化したもの）
+    split_oversized_segments: True の場合、token_limit を超えるセグメントを行の境界で分割する
+        （False の場合はこれまでどおりエントリ全体を exceeding_entries に追加する）
+    accounting / verify_margin: チャンクのトークン数の計算方法（plan_chunks を参照）
+    pretokenized: サブタスクで計算済みの (テキスト全体のトークンID, セグメント, セグメントのトークン化の結果)
+        （plan_document_subtasks を参照。指定された場合はテキスト全体とセグメントをトークン化しない）
     """
     entry_id = entry.get("id", "")
     title = entry.get("title", "")
     content = entry.get("text", "")
+    tokenizer = get_split_tokenizer()
     
-    original_token_count = len(tokenizer(content)['input_ids'])
+    if pretokenized is not None:
+        original_ids = pretokenized[0]
+    else:
+        with timer("tokenize"):
+            original_ids = tokenizer(content)['input_ids']
+    original_token_count = len(original_ids)
+    count("input_tokens", original_token_count)
     
     # トークン数が制限以下の場合は分割しない
     if original_token_count <= token_limit:
+        if token_counts is not None:
+            token_counts.append(original_token_count)
+        if token_ids is not None:
+            token_ids.append(np.asarray(original_ids, dtype=TOKEN_DTYPE))
         return [entry], None
     
     # 指定された delimiter を使ってセグメント分割
-    segments = content.split(delimiter)
-    segments = [seg.strip() for seg in segments if seg.strip()]
+    segments = pretokenized[1] if pretokenized is not None else split_content(content, delimiter)
     n_segments = len(segments)
     if n_segments == 0:
+        if token_counts is not None:
+            token_counts.append(original_token_count)
+        if token_ids is not None:
+            token_ids.append(np.asarray(original_ids, dtype=TOKEN_DTYPE))
         return [entry], None
     
-    tokenized = tokenizer(segments, add_special_tokens=False)
+    # 制限を超えるセグメントの分割と区切りのコストの測定のために、各トークンの文字位置も求める
+    if pretokenized is not None:
+        tokenized = pretokenized[2]
+    else:
+        tokenized = tokenize_batched(tokenizer, segments, add_special_tokens=False,
+                                     return_offsets_mapping=split_oversized_segments or accounting == "boundary")
+    count("segments", n_segments)
     segment_token_counts = [len(ids) for ids in tokenized['input_ids']]
+    num_oversized = sum(1 for count in segment_token_counts if count > token_limit)
     
     # 各セグメントのトークン数が token_limit を超える場合
-    if any(count > token_limit for count in segment_token_counts):
+    if num_oversized and not split_oversized_segments:
         if exceeding_entries is not None:
             exceeding_entries.append(entry)
         return [], {
@@ -110,16 +471,21 @@ def process_jsonl_entry(entry, output_dir, token_limit=32700, exceeding_entries=
         }
     
     # delimiter のトークン数を計算
-    delimiter_token_count = len(tokenizer(delimiter)['input_ids'])
+    delimiter_ids = tokenizer(delimiter)['input_ids']
+    delimiter_token_count = len(delimiter_ids)
     
-    partitions, chunk_token_counts = split_segments_by_max_sum(segment_token_counts, delimiter_token_count, token_limit)
+    chunks, chunk_token_counts, verified_ids = plan_chunks(
+        segments, tokenized, delimiter_token_count, token_limit, delimiter, tokenizer,
+        split_oversized_segments, accounting, verify_margin
+    )
+    count("oversized_segments", num_oversized)
     
     if max(chunk_token_counts) > token_limit:
         return [], {
             "id": entry_id,
             "title": title,
             "original_token_count": original_token_count,
-            "split_parts": len(partitions),
+            "split_parts": len(chunks),
             "split_token_counts": chunk_token_counts,
             "max_chunk_token_count": max(chunk_token_counts),
             "error": "チャンクのトークン数が上限を超えました。"
@@ -127,117 +493,265 @@ def process_jsonl_entry(entry, output_dir, token_limit=32700, exceeding_entries=
     
     # 分割されたエントリを作成
     split_entries = []
-    for i, (start, end) in enumerate(partitions):
+    for i, parts in enumerate(chunks):
         # 分割したチャンクは delimiter を用いて連結
-        chunk = delimiter.join(segments[start:end+1])
+        chunk = chunk_text(segments, parts, delimiter)
         split_entry = {
             "id": f"{entry_id}_part{i+1}",
             "title": f"{title}_part{i+1}",
             "text": chunk
         }
         split_entries.append(split_entry)
+    if token_counts is not None:
+        token_counts.extend(chunk_token_counts)
+    if token_ids is not None:
+        # チャンクを再度トークン化せず、セグメントのトークンIDを delimiter のトークンIDで連結する
+        # （制限を超えたセグメントの部分は、セグメントのトークンIDの該当範囲）
+        for i, parts in enumerate(chunks):
+            if i in verified_ids:
+                token_ids.append(np.asarray(verified_ids[i], dtype=TOKEN_DTYPE))
+                continue
+            chunk_ids = []
+            for k, (j, token_start, token_end, _, _) in enumerate(parts):
+                if k > 0:
+                    chunk_ids.extend(delimiter_ids)
+                chunk_ids.extend(tokenized['input_ids'][j][token_start:token_end])
+            token_ids.append(np.asarray(chunk_ids, dtype=TOKEN_DTYPE))
     
     summary = {
         "id": entry_id,
         "title": title,
         "original_token_count": original_token_count,
-        "split_parts": len(partitions),
+        "split_parts": len(chunks),
         "split_token_counts": chunk_token_counts,
         "max_chunk_token_count": max(chunk_token_counts),
-        "final_chunk_count_used": len(partitions)
+        "final_chunk_count_used": len(chunks)
     }
+    if num_oversized:
+        summary["num_oversized_segments_split"] = num_oversized
     
     return split_entries, summary
 
-def process_single_entry(entry, token_limit, delimiter):
+def process_single_entry(entry, token_limit, delimiter, return_token_ids=False, split_oversized_segments=True,
+                         accounting="boundary", verify_margin=64, pretokenized=None):
     """並列処理用の関数"""
     exceeding_entries = []
+    token_counts = []
+    token_ids = [] if return_token_ids else None
     split_entries, summary = process_jsonl_entry(
-        entry, None, token_limit, exceeding_entries, delimiter
+        entry, None, token_limit, exceeding_entries, delimiter, token_counts, token_ids, split_oversized_segments,
+        accounting, verify_margin, pretokenized
     )
-    return split_entries, summary, exceeding_entries
+    return split_entries, summary, exceeding_entries, token_counts, token_ids, pop_delta()
+
+# チェックポイントのチャンク（part_XXXXX/）に保存するファイル
+PART_OUTPUT = "output.jsonl"
+PART_EXCEEDING = "exceeding.jsonl"
+PART_TOKENS = "tokens"
+PART_META = "meta.json"
+
+def write_part(part_dir, results, save_token_ids=False):
+    """チャンク1つ分の process_single_entry の結果をチェックポイントのチャンクに書き込む"""
+    split_entries = []
+    exceeding_entries = []
+    token_counts = []
+    summaries = []
+    token_writer = TokenStoreWriter(os.path.join(part_dir, PART_TOKENS)) if save_token_ids else None
+    for entry_split_entries, summary, entry_exceeding_entries, entry_token_counts, token_ids, metrics_delta in results:
+        merge(metrics_delta)
+        split_entries.extend(entry_split_entries)
+        exceeding_entries.extend(entry_exceeding_entries)
+        token_counts.extend(entry_token_counts)
+        if token_writer is not None:
+            for split_entry, ids in zip(entry_split_entries, token_ids):
+                token_writer.write(split_entry.get("id", ""), ids)
+        if summary:
+            summaries.append(summary)
+    if token_writer is not None:
+        token_writer.close()
+    write_records(os.path.join(part_dir, PART_OUTPUT), split_entries)
+    write_records(os.path.join(part_dir, PART_EXCEEDING), exceeding_entries)
+    with open(os.path.join(part_dir, PART_META), 'w', encoding='utf-8') as f:
+        json.dump({"token_counts": token_counts, "summaries": summaries}, f, ensure_ascii=False)
+
+def load_part_meta(part_dir):
+    with open(os.path.join(part_dir, PART_META), 'r', encoding='utf-8') as f:
+        return json.load(f)
 
-def process_jsonl_file(input_file, output_file, summary_dir, token_limit=32700, exceeding_file=None, delimiter=";<h1/>"):
-    """JSONLファイル全体を処理"""
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+def concat_part_records(part_dirs, name, output_path, token_counts=None):
+    """各チャンクの name のファイルを結合して output_path に書き込む"""
+    return concat_records([os.path.join(part_dir, name) for part_dir in part_dirs], output_path, token_counts)
+
+def _metrics_file(args):
+    """メトリクスは split_summary と同じディレクトリに <入力ファイル名>_metrics.json として保存する"""
+    input_base_name = splitext_jsonl(os.path.basename(args["input_file"]))[0]
+    return os.path.join(args["summary_dir"], f"{input_base_name}_metrics.json")
+
+@measure_stage("split_long_jsonl", _metrics_file)
+def process_jsonl_file(input_file, output_file, summary_dir, token_limit=32700, exceeding_file=None, delimiter=";<h1/>",
+                       token_output=None, executor=None, chunk_entries=None, split_oversized_segments=True,
+                       chunk_accounting="boundary", verify_margin=64):
+    """
+    JSONLファイル全体を処理
+    split_oversized_segments: True の場合、token_limit を超えるセグメントを行の境界で分割する
+        （False の場合、そのようなエントリは exceeding_file に出力する）
+    chunk_accounting / verify_margin: チャンクのトークン数の計算方法（plan_chunks を参照）
+    token_output: 指定された場合、分割時に計算したトークンIDを token_store.py の形式で
+        このプレフィックスのファイルに保存する（エントリの順序は output_file と同じ）
+    executor: 指定された場合、新しいプロセスプールを起動せずにこのプールを使用する
+        （cli.py のバッチ実行で、トークナイザーを読み込み済みのワーカーを複数のファイルで共有するため）
+    chunk_entries: 入力をこの件数ごとに処理し、結果を <output_file>.checkpoint/ にコミットする
+        （省略時は CHECKPOINT_CONFIG["chunk_entries"]）。中断した場合は次回の実行時に続きから再開する。
+    """
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
     os.makedirs(summary_dir, exist_ok=True)
+    chunk_entries = chunk_entries or CHECKPOINT_CONFIG["chunk_entries"]
     
-    # 入力ファイルを読み込む
-    entries = []
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                entries.append(json.loads(line))
-    
-    summary_list = []
-    all_split_entries = []
-    all_exceeding_entries = []
-    skipped_entries = []
+    # 入力と出力に影響する設定が前回と同じ場合のみ、前回の続きから処理する
+    fingerprint = input_fingerprint(
+        input_file, output_file=os.path.abspath(output_file), token_limit=token_limit, delimiter=delimiter,
+        model_name=SPLIT_LONG_JSONL_CONFIG["model_name"], token_output=token_output is not None,
+        chunk_entries=chunk_entries, split_oversized_segments=split_oversized_segments,
+        chunk_accounting=chunk_accounting, verify_margin=verify_margin
+    )
+    checkpoint = ChunkCheckpoint(checkpoint_dir(output_file), fingerprint)
+    if checkpoint.position:
+        print(f"チェックポイントから再開します: {checkpoint.position} エントリ処理済み")
+    count("input_bytes", os.path.getsize(input_file))
     
     # partial を使って必要な引数を固定
     process_func = partial(
         process_single_entry,
         token_limit=token_limit,
-        delimiter=delimiter
+        delimiter=delimiter,
+        return_token_ids=token_output is not None,
+        split_oversized_segments=split_oversized_segments,
+        accounting=chunk_accounting,
+        verify_margin=verify_margin
+    )
+    # 巨大なエントリはトークン化をサブタスクに分ける（scheduler.py）
+    expand_entry = lambda entry: plan_document_subtasks(
+        entry.get("text", ""), delimiter, SPLIT_LONG_JSONL_CONFIG["model_name"],
+        split_oversized_segments or chunk_accounting == "boundary",
+        lambda pretokenized: partial(process_func, entry, pretokenized=pretokenized)
     )
     
-    # 並列処理
-    with ProcessPoolExecutor() as executor:
-        results = list(tqdm(
-            executor.map(process_func, entries), 
-            total=len(entries), 
-            desc="Processing JSONL entries", 
-            unit="entry"
-        ))
+    # チャンクごとに並列処理し、結果をチェックポイントにコミットする
+    # （チャンク内はテキストの長いエントリから順に割り当てる。ワーカーでの処理時間は各ワーカーの合計として別に集計される）
+    position = checkpoint.position
+    records = iter_records_from(input_file, checkpoint.position, checkpoint.offset)
+    with (nullcontext(executor) if executor else ProcessPoolExecutor()) as pool, \
+            tqdm(initial=position, desc="Processing JSONL entries", unit="entry") as progress:
+        for chunk in iter_chunks(records, chunk_entries):
+            entries = [entry for entry, _ in chunk]
+            with timer("pool"):
+                results = run_scheduled(pool, process_func, entries, [len(entry.get("text", "")) for entry in entries],
+                                        expand_entry, progress)
+            position += len(chunk)
+            with timer("write"):
+                part_dir = checkpoint.begin_part()
+                write_part(part_dir, results, token_output is not None)
+                checkpoint.commit_part(part_dir, position, chunk[-1][1])
+    count("records_in", position)
     
-    # 結果を集計
-    for split_entries, summary, exceeding_entries in results:
-        all_split_entries.extend(split_entries)
-        all_exceeding_entries.extend(exceeding_entries)
-        
-        if summary:
-            summary_list.append(summary)
-            if summary.get("skipped_due_to_segment_exceeding_limit", False):
-                skipped_entries.append({
-                    "id": summary["id"],
-                    "title": summary["title"],
-                    "original_token_count": summary["original_token_count"]
-                })
+    # コミット済みのチャンクを結合して出力する
+    with timer("write"):
+        parts = [load_part_meta(part_dir) for part_dir in checkpoint.part_dirs()]
+        all_split_token_counts = [token_count for part in parts for token_count in part["token_counts"]]
+        # 分割されたエントリを出力ファイルに書き込む（Arrow / Parquet の場合はトークン数も保存される）
+        num_split_entries = concat_part_records(checkpoint.part_dirs(), PART_OUTPUT, output_file,
+                                                all_split_token_counts)
+        # 制限を超えたエントリを別ファイルに保存
+        # （後続ステージの入力になるため、該当エントリがなくても空ファイルを作成する）
+        if exceeding_file:
+            os.makedirs(os.path.dirname(exceeding_file) or ".", exist_ok=True)
+            concat_part_records(checkpoint.part_dirs(), PART_EXCEEDING, exceeding_file)
+    count("records_out", num_split_entries)
+    count("output_bytes", os.path.getsize(output_file))
     
-    # 分割されたエントリを出力ファイルに書き込む
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for entry in all_split_entries:
-            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    # トークンIDを保存する（学習時に再度トークン化せずに使用できる）
+    if token_output is not None:
+        with timer("write_tokens"), \
+                TokenStoreWriter(token_output, model_name=SPLIT_LONG_JSONL_CONFIG["model_name"]) as token_writer:
+            for part_dir in checkpoint.part_dirs():
+                part_store = TokenStore(os.path.join(part_dir, PART_TOKENS))
+                for i, entry_id in enumerate(part_store.ids):
+                    token_writer.write(entry_id, part_store[i])
     
-    # 制限を超えたエントリを別ファイルに保存
-    if exceeding_file and all_exceeding_entries:
-        os.makedirs(os.path.dirname(exceeding_file), exist_ok=True)
-        with open(exceeding_file, 'w', encoding='utf-8') as f:
-            for entry in all_exceeding_entries:
-                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    summary_list = [summary for part in parts for summary in part["summaries"]]
+    skipped_entries = [
+        {
+            "id": summary["id"],
+            "title": summary["title"],
+            "original_token_count": summary["original_token_count"]
+        }
+        for summary in summary_list if summary.get("skipped_due_to_segment_exceeding_limit", False)
+    ]
     
     # サマリーを作成
     summary = {
         "input_file": os.path.basename(input_file),
         "output_file": os.path.basename(output_file),
-        "num_original_entries": len(entries),
-        "num_split_entries": len(all_split_entries),
+        "num_original_entries": position,
+        "num_split_entries": num_split_entries,
+        "num_split_tokens": sum(all_split_token_counts),
         "num_skipped_entries": len(skipped_entries),
         "skipped_entries_due_to_segment_exceeding_limit": skipped_entries,
         "split_entries": summary_list
     }
     
     # サマリーファイルを保存
-    input_base_name = os.path.splitext(os.path.basename(input_file))[0]
+    input_base_name = splitext_jsonl(os.path.basename(input_file))[0]
     summary_file = os.path.join(summary_dir, f"{input_base_name}_summary.json")
     with open(summary_file, 'w', encoding='utf-8') as f:
         json.dump(summary, f, indent=4, ensure_ascii=False)
     
+    # すべての出力を書き込んだため、チェックポイントを削除する
+    checkpoint.remove()
+    
     print(f"処理完了:")
-    print(f"  元のエントリ数: {len(entries)}")
-    print(f"  分割後のエントリ数: {len(all_split_entries)}")
+    print(f"  元のエントリ数: {position}")
+    print(f"  分割後のエントリ数: {num_split_entries}")
     print(f"  スキップされたエントリ数: {len(skipped_entries)}")
+    return summary
+
+@measure_stage("split_long_jsonl_shards",
+               lambda args: os.path.join(args["summary_dir"], os.path.basename(os.path.normpath(args["output_dir"])) + "_metrics.json"))
+def process_jsonl_shards(input_dir, output_dir, summary_dir, token_limit=32700, exceeding_dir=None, delimiter=";<h1/>",
+                         worker_index=0, num_workers=1, token_output_dir=None, executor=None, split_oversized_segments=True,
+                         chunk_accounting="boundary", verify_margin=64):
+    """
+    シャード形式のデータセットを処理する（shards.py を参照）
+    新規・変更されたシャードのみを process_jsonl_file で処理し、同名のシャードとして出力する。
+    制限を超えたエントリは exceeding_dir に同名のシャードとして出力する。
+    token_output_dir を指定した場合、シャードごとのトークンIDを <token_output_dir>/<シャード名> に保存する。
+    """
+    # シャードのサマリーはデータセットごとのサブディレクトリに保存する
+    shard_summary_dir = os.path.join(summary_dir, os.path.basename(os.path.normpath(output_dir)))
+
+    def process_shard(input_path, output_path):
+        name = os.path.basename(input_path)
+        exceeding_file = os.path.join(exceeding_dir, name) if exceeding_dir else None
+        token_output = os.path.join(token_output_dir, splitext_jsonl(name)[0]) if token_output_dir else None
+        shard_summary = process_jsonl_file(input_path, output_path, shard_summary_dir,
+                                           token_limit, exceeding_file, delimiter, token_output, executor,
+                                           split_oversized_segments=split_oversized_segments,
+                                           chunk_accounting=chunk_accounting, verify_margin=verify_margin)
+        if exceeding_file:
+            write_shard_meta(exceeding_dir, name, count_lines(exceeding_file))
+        return {"rows": shard_summary["num_split_entries"], "tokens": shard_summary["num_split_tokens"]}
+
+    if exceeding_dir:
+        os.makedirs(exceeding_dir, exist_ok=True)
+    params = {"token_limit": token_limit, "delimiter": delimiter, "token_output": token_output_dir is not None,
+              "split_oversized_segments": split_oversized_segments, "chunk_accounting": chunk_accounting,
+              "verify_margin": verify_margin}
+    processed, skipped = process_shards(input_dir, output_dir, process_shard, params, worker_index, num_workers)
+    if exceeding_dir:
+        build_manifest(exceeding_dir)
+
+    print(f"シャード処理完了: 処理 {len(processed)} 件 / スキップ {len(skipped)} 件")
+    return processed, skipped
 
 if __name__ == "__main__":
     # 設定ファイルから値を読み込む
@@ -248,11 +762,32 @@ if __name__ == "__main__":
     delimiter = SPLIT_LONG_JSONL_CONFIG["delimiter"]
     token_limit = SPLIT_LONG_JSONL_CONFIG["token_limit"]
     
-    process_jsonl_file(
-        input_file=input_file,
-        output_file=output_file,
-        summary_dir=summary_dir,
-        token_limit=token_limit,
-        exceeding_file=exceeding_file,
-        delimiter=delimiter
-    )
+    if is_sharded_dataset(input_file):
+        # 入力がシャード形式の場合、output_file / exceeding_file は出力先ディレクトリとして扱う
+        process_jsonl_shards(
+            input_dir=input_file,
+            output_dir=output_file,
+            summary_dir=summary_dir,
+            token_limit=token_limit,
+            exceeding_dir=exceeding_file,
+            delimiter=delimiter,
+            worker_index=SPLIT_LONG_JSONL_CONFIG.get("worker_index", 0),
+            num_workers=SPLIT_LONG_JSONL_CONFIG.get("num_workers", 1),
+            token_output_dir=SPLIT_LONG_JSONL_CONFIG.get("token_output"),
+            split_oversized_segments=SPLIT_LONG_JSONL_CONFIG.get("split_oversized_segments", True),
+            chunk_accounting=SPLIT_LONG_JSONL_CONFIG.get("chunk_accounting", "boundary"),
+            verify_margin=SPLIT_LONG_JSONL_CONFIG.get("verify_margin", 64)
+        )
+    else:
+        process_jsonl_file(
+            input_file=input_file,
+            output_file=output_file,
+            summary_dir=summary_dir,
+            token_limit=token_limit,
+            exceeding_file=exceeding_file,
+            delimiter=delimiter,
+            token_output=SPLIT_LONG_JSONL_CONFIG.get("token_output"),
+            split_oversized_segments=SPLIT_LONG_JSONL_CONFIG.get("split_oversized_segments", True),
+            chunk_accounting=SPLIT_LONG_JSONL_CONFIG.get("chunk_accounting", "boundary"),
+            verify_margin=SPLIT_LONG_JSONL_CONFIG.get("verify_margin", 64)
+        )
@@ -1,108 +1,93 @@
 import os
 import json
 import math
+import uuid
 from tqdm import tqdm
-from transformers import AutoTokenizer
 from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from functools import partial
-from config import SPLIT_LONG_TXT_CONFIG
+from config import SPLIT_LONG_TXT_CONFIG, SCHEDULER_CONFIG
+from metrics import measure_stage, timer, count, merge, pop_delta
+from tokenizer_backend import get_tokenizer
+from batching import tokenize_batched
+from scheduler import run_scheduled
+from text_pack import get_pack_writer, source_row, remove_pack, write_index
+from checkpoint import FileState, code_version
+from split_long_jsonl import plan_chunks, chunk_text, split_content, plan_document_subtasks
+
+# 入力ごとのサイズ・更新時刻・出力ファイル・サマリー（"files" の場合に次回の実行で変更のないファイルをスキップする）
+STATE_FILE = ".split_long_txt.state.json"
 
 # 環境変数で警告を回避（必要に応じて）
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-# 設定ファイルからモデル名を取得してトークナイザーをロード
-tokenizer = AutoTokenizer.from_pretrained(SPLIT_LONG_TXT_CONFIG["model_name"])
+def get_split_tokenizer():
+    """設定ファイルのモデル名のトークナイザー（各プロセスで最初に使用したときに読み込む）"""
+    return get_tokenizer(SPLIT_LONG_TXT_CONFIG["model_name"])
 
-def split_segments_by_max_sum(segment_token_counts, delimiter_cost, token_limit):
+def process_file(input_file, output_dir, token_limit=32700, exceeding_dir=None, delimiter=";<h1/>",
+                 split_oversized_segments=True, accounting="boundary", verify_margin=64, pretokenized=None,
+                 pack_run=None, index_rows=None, written=None):
     """
-    与えられた各セグメントのトークン数リストから、
-    チャンク毎のトークン数（セグメント合計＋各区切りのコスト）を、
-    token_limit を超えないように分割する。
-
-    Split Array Largest Sum の考え方を用い、まず
-      token_limit を上限とした場合のチャンク数 target_chunks を求め、
-    その数を崩さずに、チャンク内のトークン数（最大値）を最小化する分割を二分探索で求める。
-
-    戻り値:
-      - partitions: 各チャンクの (開始, 終了) インデックスのタプルリスト
-      - chunk_token_counts: 各チャンクのトークン数リスト
+    テキストファイル1つを処理する
+    split_oversized_segments: True の場合、token_limit を超えるセグメントを行の境界で分割する
+        （False の場合、そのようなファイルは exceeding_dir に保存する）
+    accounting / verify_margin: チャンクのトークン数の計算方法（split_long_jsonl.py の plan_chunks を参照）
+    pretokenized: サブタスクで計算済みのトークン化の結果（split_long_jsonl.py の plan_document_subtasks を参照）
+    pack_run: 指定された場合、チャンクをこのプロセスの output_dir のパックに追記し（text_pack.py）、
+        インデックスの行を index_rows に追加する。token_limit 以下のファイルはコピーせず、インデックスで参照する
+    written: 指定された場合、書き込んだファイルのパスを追加する（process_directory の入力ごとの状態に記録する）
     """
-    n = len(segment_token_counts)
-    
-    def chunks_needed(max_allowed):
-        chunks = 1
-        current = segment_token_counts[0]
-        for count in segment_token_counts[1:]:
-            if current + delimiter_cost + count <= max_allowed:
-                current += delimiter_cost + count
-            else:
-                chunks += 1
-                current = count
-        return chunks
-
-    target_chunks = chunks_needed(token_limit)
-    
-    low = max(segment_token_counts)
-    high = token_limit
-    optimal = high
-    while low <= high:
-        mid = (low + high) // 2
-        if chunks_needed(mid) <= target_chunks:
-            optimal = mid
-            high = mid - 1
-        else:
-            low = mid + 1
-
-    partitions = []
-    current_sum = segment_token_counts[0]
-    start_index = 0
-    for i in range(1, n):
-        if current_sum + delimiter_cost + segment_token_counts[i] <= optimal:
-            current_sum += delimiter_cost + segment_token_counts[i]
-        else:
-            partitions.append((start_index, i - 1))
-            start_index = i
-            current_sum = segment_token_counts[i]
-    partitions.append((start_index, n - 1))
-    
-    chunk_token_counts = []
-    for start, end in partitions:
-        count = sum(segment_token_counts[start:end+1]) + delimiter_cost * (end - start)
-        chunk_token_counts.append(count)
-    
-    return partitions, chunk_token_counts
-
-def process_file(input_file, output_dir, token_limit=32700, exceeding_dir=None, delimiter=";<h1/>"):
-    with open(input_file, 'r', encoding='utf-8') as f:
+    if written is None:
+        written = []
+    tokenizer = get_split_tokenizer()
+    with timer("read"), open(input_file, 'r', encoding='utf-8') as f:
         content = f.read()
+    count("input_bytes", os.path.getsize(input_file))
     
-    original_token_count = len(tokenizer(content)['input_ids'])
+    if pretokenized is not None:
+        original_token_count = len(pretokenized[0])
+    else:
+        with timer("tokenize"):
+            original_token_count = len(tokenizer(content)['input_ids'])
+    count("input_tokens", original_token_count)
     base_name = os.path.splitext(os.path.basename(input_file))[0]
     
     if original_token_count <= token_limit:
+        if pack_run is not None:
+            index_rows.append(source_row(os.path.basename(input_file), input_file))
+            return None
         output_file = os.path.join(output_dir, f"{base_name}.txt")
-        with open(output_file, 'w', encoding='utf-8') as f_out:
+        with timer("write"), open(output_file, 'w', encoding='utf-8') as f_out:
             f_out.write(content)
+        written.append(output_file)
         return None
 
     # 指定された delimiter を使ってセグメント分割
-    segments = content.split(delimiter)
-    segments = [seg.strip() for seg in segments if seg.strip()]
+    segments = pretokenized[1] if pretokenized is not None else split_content(content, delimiter)
     n_segments = len(segments)
     if n_segments == 0:
         return None
 
-    tokenized = tokenizer(segments, add_special_tokens=False)
+    # 制限を超えるセグメントの分割と区切りのコストの測定のために、各トークンの文字位置も求める
+    if pretokenized is not None:
+        tokenized = pretokenized[2]
+    else:
+        tokenized = tokenize_batched(tokenizer, segments, add_special_tokens=False,
+                                     return_offsets_mapping=split_oversized_segments or accounting == "boundary")
+    count("segments", n_segments)
     segment_token_counts = [len(ids) for ids in tokenized['input_ids']]
+    num_oversized = sum(1 for count in segment_token_counts if count > token_limit)
 
     # 各セグメントのトークン数が token_limit を超える場合、exceeding_dir に保存
-    if any(count > token_limit for count in segment_token_counts):
+    if num_oversized and not split_oversized_segments:
         if exceeding_dir is None:
             raise ValueError("exceeding_dirが指定されていません。")
         os.makedirs(exceeding_dir, exist_ok=True)
         output_file = os.path.join(exceeding_dir, os.path.basename(input_file))
-        with open(output_file, 'w', encoding='utf-8') as out_f:
+        with timer("write"), open(output_file, 'w', encoding='utf-8') as out_f:
             out_f.write(content)
+        written.append(output_file)
         return {
             "file_name": os.path.basename(input_file),
             "original_token_count": original_token_count,
@@ -113,40 +98,85 @@ def process_file(input_file, output_dir, token_limit=32700, exceeding_dir=None,
     # delimiter のトークン数を計算
     delimiter_token_count = len(tokenizer(delimiter)['input_ids'])
     
-    partitions, chunk_token_counts = split_segments_by_max_sum(segment_token_counts, delimiter_token_count, token_limit)
+    chunks, chunk_token_counts, _ = plan_chunks(
+        segments, tokenized, delimiter_token_count, token_limit, delimiter, tokenizer,
+        split_oversized_segments, accounting, verify_margin
+    )
+    count("oversized_segments", num_oversized)
     
     if max(chunk_token_counts) > token_limit:
         return {
             "file_name": os.path.basename(input_file),
             "original_token_count": original_token_count,
-            "split_parts": len(partitions),
+            "split_parts": len(chunks),
             "split_token_counts": chunk_token_counts,
             "max_chunk_token_count": max(chunk_token_counts),
             "error": "チャンクのトークン数が上限を超えました。"
         }
     
-    for i, (start, end) in enumerate(partitions):
-        # 分割したチャンクは delimiter を用いて連結
-        chunk = delimiter.join(segments[start:end+1])
-        output_file = os.path.join(output_dir, f"{base_name}_part{i+1}.txt")
-        with open(output_file, 'w', encoding='utf-8') as out_f:
-            out_f.write(chunk)
+    # 分割したチャンクは delimiter を用いて連結
+    texts = [chunk_text(segments, parts, delimiter) for parts in chunks]
+    titles = [f"{base_name}_part{i+1}" for i in range(len(chunks))]
+    if pack_run is not None:
+        with timer("write"):
+            index_rows.extend(get_pack_writer(output_dir, pack_run).write_file(os.path.basename(input_file), titles, texts))
+    else:
+        for title, chunk in zip(titles, texts):
+            output_file = os.path.join(output_dir, f"{title}.txt")
+            with timer("write"), open(output_file, 'w', encoding='utf-8') as out_f:
+                out_f.write(chunk)
+            written.append(output_file)
     
-    return {
+    summary = {
         "file_name": os.path.basename(input_file),
         "original_token_count": original_token_count,
-        "split_parts": len(partitions),
+        "split_parts": len(chunks),
         "split_token_counts": chunk_token_counts,
         "max_chunk_token_count": max(chunk_token_counts),
-        "final_chunk_count_used": len(partitions)
+        "final_chunk_count_used": len(chunks)
     }
+    if num_oversized:
+        summary["num_oversized_segments_split"] = num_oversized
+    return summary
 
 # ピクル化可能なようにグローバル関数として定義
-def process_single_file(filename, input_dir, output_dir, token_limit, exceeding_dir, delimiter):
+def process_single_file(filename, input_dir, output_dir, token_limit, exceeding_dir, delimiter, split_oversized_segments=True,
+                        accounting="boundary", verify_margin=64, pretokenized=None, pack_run=None):
     input_file = os.path.join(input_dir, filename)
-    return process_file(input_file, output_dir, token_limit, exceeding_dir, delimiter)
+    index_rows = []
+    written = []
+    # ワーカーでの計測値とパックのインデックスの行、書き込んだファイルも返す
+    summary = process_file(input_file, output_dir, token_limit, exceeding_dir, delimiter, split_oversized_segments,
+                           accounting, verify_margin, pretokenized, pack_run, index_rows, written)
+    return summary, index_rows, written, pop_delta()
 
-def process_directory(input_dir, output_dir, summary_dir, token_limit=32700, exceeding_dir=None, delimiter=";<h1/>", label=None):
+def plan_file_subtasks(filename, input_dir, delimiter, return_offsets_mapping, process_func):
+    """巨大なファイルのトークン化をサブタスクに分ける（scheduler.py。小さいファイルは読み込まずに None を返す）"""
+    input_file = os.path.join(input_dir, filename)
+    if os.path.getsize(input_file) < SCHEDULER_CONFIG["expand_chars"]:
+        return None
+    with timer("read"), open(input_file, 'r', encoding='utf-8') as f:
+        content = f.read()
+    return plan_document_subtasks(
+        content, delimiter, SPLIT_LONG_TXT_CONFIG["model_name"], return_offsets_mapping,
+        lambda pretokenized: partial(process_func, filename, pretokenized=pretokenized)
+    )
+
+def _metrics_file(args):
+    """メトリクスは split_summary と同じディレクトリに <label>_<出力ディレクトリ名>_metrics.json として保存する"""
+    out_dir_name = os.path.basename(os.path.normpath(args["output_dir"])).removeprefix("txt_")
+    return os.path.join(args["summary_dir"], f"{args['label']}_{out_dir_name}_metrics.json")
+
+@measure_stage("split_long_txt", _metrics_file)
+def process_directory(input_dir, output_dir, summary_dir, token_limit=32700, exceeding_dir=None, delimiter=";<h1/>", label=None,
+                      executor=None, split_oversized_segments=True, chunk_accounting="boundary", verify_margin=64,
+                      output_format="files"):
+    # executor が指定された場合は新しいプロセスプールを起動せずにそのプールを使用する（cli.py のバッチ実行）
+    # output_format が "pack" の場合、チャンクをワーカーごとのパックファイルに追記し、index.jsonl を作成する（text_pack.py）
+    # split_oversized_segments が True の場合、token_limit を超えるセグメントを行の境界で分割する
+    # chunk_accounting / verify_margin はチャンクのトークン数の計算方法（split_long_jsonl.py の plan_chunks を参照）
+    # "files" の場合、前回の実行から変更のないファイルはスキップし、変更・削除されたファイルの以前の出力は削除する
+    # （入力ごとの状態は output_dir の STATE_FILE に保存する。checkpoint.py の FileState）
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(summary_dir, exist_ok=True)
     
@@ -156,6 +186,34 @@ def process_directory(input_dir, output_dir, summary_dir, token_limit=32700, exc
     
     files = [filename for filename in os.listdir(input_dir) if filename.endswith('.txt')]
     
+    if output_format not in ("files", "pack"):
+        raise ValueError(f"output_format は \"files\" または \"pack\" を指定してください: {output_format}")
+    # パックのファイル名に実行IDを含め、前回の実行のパックやワーカーが開いたままのパックに追記しないようにする
+    # （パックは毎回すべて作り直すため、入力ごとの状態は記録せず、"files" で出力したファイルは削除する）
+    pack_run = None
+    remove_pack(output_dir)
+    if output_format == "pack":
+        pack_run = uuid.uuid4().hex[:8]
+    state = FileState(os.path.join(output_dir, STATE_FILE), {
+        "code": code_version("split_long_txt"),
+        "model_name": SPLIT_LONG_TXT_CONFIG["model_name"],
+        "token_limit": token_limit,
+        "exceeding_dir": os.path.abspath(exceeding_dir) if exceeding_dir else None,
+        "delimiter": delimiter,
+        "split_oversized_segments": split_oversized_segments,
+        "chunk_accounting": chunk_accounting,
+        "verify_margin": verify_margin,
+    }, output_dir)
+    stats = {filename: os.stat(os.path.join(input_dir, filename)) for filename in files}
+    unchanged = [] if pack_run is not None else [filename for filename in files
+                                                    if state.is_current(filename, stats[filename])]
+    for filename in unchanged:
+        entry = state.get(filename)
+        state.record(filename, stats[filename], entry["outputs"], summary=entry["summary"])
+    count("files_skipped", len(unchanged))
+    unchanged = set(unchanged)
+    pending_files = [filename for filename in files if filename not in unchanged]
+    
     # partial を使って必要な引数を固定
     process_func = partial(
         process_single_file,
@@ -163,13 +221,38 @@ def process_directory(input_dir, output_dir, summary_dir, token_limit=32700, exc
         output_dir=output_dir,
         token_limit=token_limit,
         exceeding_dir=exceeding_dir,
-        delimiter=delimiter
+        delimiter=delimiter,
+        split_oversized_segments=split_oversized_segments,
+        accounting=chunk_accounting,
+        verify_margin=verify_margin,
+        pack_run=pack_run
     )
     
-    with ProcessPoolExecutor() as executor:
-        results = list(tqdm(executor.map(process_func, files), total=len(files), desc="Processing files", unit="file"))
+    expand_file = partial(plan_file_subtasks, input_dir=input_dir, delimiter=delimiter,
+                          return_offsets_mapping=split_oversized_segments or chunk_accounting == "boundary",
+                          process_func=process_func)
     
-    for file_summary in results:
+    # ファイルサイズの大きい順に割り当て、巨大なファイルのトークン化はサブタスクに分ける（scheduler.py）
+    # （結果はファイルの順に返される）
+    costs = [stats[filename].st_size for filename in pending_files]
+    with timer("pool"), (nullcontext(executor) if executor else ProcessPoolExecutor()) as pool, \
+            tqdm(total=len(pending_files), desc="Processing files", unit="file") as progress:
+        results = run_scheduled(pool, process_func, pending_files, costs, expand_file, progress)
+    count("files", len(files))
+    
+    index_rows = []
+    file_results = {}
+    for filename, (file_summary, file_index_rows, written, metrics_delta) in zip(pending_files, results):
+        merge(metrics_delta)
+        index_rows.extend(file_index_rows)
+        file_results[filename] = file_summary
+        if pack_run is None:
+            state.record(filename, stats[filename], [os.path.relpath(path, output_dir) for path in written],
+                         summary=file_summary)
+    
+    # サマリーは変更のないファイルの前回の結果も含めて、ファイルの順に作成する
+    for filename in files:
+        file_summary = file_results[filename] if filename in file_results else state.files[filename]["summary"]
         if file_summary:
             summary_list.append(file_summary)
             if file_summary.get("skipped_due_to_segment_exceeding_limit", False):
@@ -180,6 +263,12 @@ def process_directory(input_dir, output_dir, summary_dir, token_limit=32700, exc
             elif file_summary.get("max_chunk_token_count", 0) > token_limit:
                 files_with_exceeding_chunks.append(file_summary["file_name"])
     
+    if pack_run is not None:
+        with timer("write"):
+            write_index(output_dir, index_rows)
+    # 変更・削除されたファイルの以前の出力を削除して状態を保存する
+    state.save()
+    
     summary = {
         "num_split_files": len(summary_list),
         "num_skipped_files": len(skipped_files),
@@ -203,4 +292,11 @@ if __name__ == "__main__":
     label = SPLIT_LONG_TXT_CONFIG["label"]
     token_limit = SPLIT_LONG_TXT_CONFIG["token_limit"]
     
-    process_directory(input_dir, output_dir, summary_dir, token_limit=token_limit, exceeding_dir=exceeding_dir, delimiter=delimiter, label=label)
+    split_oversized_segments = SPLIT_LONG_TXT_CONFIG.get("split_oversized_segments", True)
+    chunk_accounting = SPLIT_LONG_TXT_CONFIG.get("chunk_accounting", "boundary")
+    verify_margin = SPLIT_LONG_TXT_CONFIG.get("verify_margin", 64)
+    output_format = SPLIT_LONG_TXT_CONFIG.get("output_format", "files")
+    
+    process_directory(input_dir, output_dir, summary_dir, token_limit=token_limit, exceeding_dir=exceeding_dir, delimiter=delimiter, label=label,
+                      split_oversized_segments=split_oversized_segments, chunk_accounting=chunk_accounting,
+                      verify_margin=verify_margin, output_format=output_format)
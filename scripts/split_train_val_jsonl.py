@@ -1,8 +1,18 @@
-import json
 import random
 import os
 from config import SPLIT_TRAIN_VAL_JSONL_CONFIG
+from jsonl_io import iter_records, write_records, is_jsonl_file, open_jsonl
+from mmap_jsonl import MappedJsonl
+from metrics import measure_stage, timer, count
 
+def write_lines(path, reader, indices):
+    """reader の指定した行をデコードせずにそのまま書き込む"""
+    with open_jsonl(path, 'wb') as f:
+        for i in indices:
+            f.write(reader[i])
+            f.write(b'\n')
+
+@measure_stage("split_train_val_jsonl", lambda args: os.path.join(args["output_dir"], "split_metrics.json"))
 def split_jsonl(file_path, train_ratio=0.8, output_dir="./", train_output="train.jsonl", val_output="val.jsonl", seed=42):
     """
     指定したJSONLファイルをtrainとvalにリスト単位で分割し、指定フォルダに保存する。
@@ -19,41 +29,55 @@ def split_jsonl(file_path, train_ratio=0.8, output_dir="./", train_output="train
     # 出力フォルダを作成（存在しない場合）
     os.makedirs(output_dir, exist_ok=True)
     
-    # JSONLのデータを読み込む
-    with open(file_path, "r", encoding="utf-8") as f:
-        data = [json.loads(line) for line in f]
-    
-    # データをシャッフル
-    random.shuffle(data)
-    
-    # 分割
-    train_size = int(len(data) * train_ratio)
-    train_data = data[:train_size]
-    val_data = data[train_size:]
-    
     # 出力ファイルのパス
     train_path = os.path.join(output_dir, train_output)
     val_path = os.path.join(output_dir, val_output)
     
-    # train.jsonlに書き込み
-    with open(train_path, "w", encoding="utf-8") as f:
-        for entry in train_data:
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
-    
-    # val.jsonlに書き込み
-    with open(val_path, "w", encoding="utf-8") as f:
-        for entry in val_data:
-            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    if is_jsonl_file(file_path) and is_jsonl_file(train_path) and is_jsonl_file(val_path):
+        # JSONL同士の場合は行の位置のみをシャッフルし、各行を解析せずにコピーする
+        with MappedJsonl(file_path) as reader:
+            indices = list(range(len(reader)))
+            with timer("shuffle"):
+                random.shuffle(indices)
+            train_size = int(len(indices) * train_ratio)
+            with timer("write"):
+                write_lines(train_path, reader, indices[:train_size])
+                write_lines(val_path, reader, indices[train_size:])
+        num_train, num_val = train_size, len(indices) - train_size
+    else:
+        # JSONL（または Arrow / Parquet）のデータを読み込む
+        with timer("read"):
+            data = list(iter_records(file_path))
+        
+        # データをシャッフル
+        with timer("shuffle"):
+            random.shuffle(data)
+        
+        # 分割
+        train_size = int(len(data) * train_ratio)
+        train_data = data[:train_size]
+        val_data = data[train_size:]
+        
+        with timer("write"):
+            # train.jsonlに書き込み
+            write_records(train_path, train_data)
+            
+            # val.jsonlに書き込み
+            write_records(val_path, val_data)
+        num_train, num_val = len(train_data), len(val_data)
+    count("records_train", num_train)
+    count("records_val", num_val)
     
-    print(f"Train data: {len(train_data)} samples → {train_path}")
-    print(f"Validation data: {len(val_data)} samples → {val_path}")
+    print(f"Train data: {num_train} samples → {train_path}")
+    print(f"Validation data: {num_val} samples → {val_path}")
 
-# 設定ファイルから値を読み込む
-split_jsonl(
-    file_path=SPLIT_TRAIN_VAL_JSONL_CONFIG["file_path"],
-    train_ratio=SPLIT_TRAIN_VAL_JSONL_CONFIG["train_ratio"],
-    output_dir=SPLIT_TRAIN_VAL_JSONL_CONFIG["output_dir"],
-    train_output=SPLIT_TRAIN_VAL_JSONL_CONFIG["train_output"],
-    val_output=SPLIT_TRAIN_VAL_JSONL_CONFIG["val_output"],
-    seed=SPLIT_TRAIN_VAL_JSONL_CONFIG["seed"]
-)
+if __name__ == "__main__":
+    # 設定ファイルから値を読み込む
+    split_jsonl(
+        file_path=SPLIT_TRAIN_VAL_JSONL_CONFIG["file_path"],
+        train_ratio=SPLIT_TRAIN_VAL_JSONL_CONFIG["train_ratio"],
+        output_dir=SPLIT_TRAIN_VAL_JSONL_CONFIG["output_dir"],
+        train_output=SPLIT_TRAIN_VAL_JSONL_CONFIG["train_output"],
+        val_output=SPLIT_TRAIN_VAL_JSONL_CONFIG["val_output"],
+        seed=SPLIT_TRAIN_VAL_JSONL_CONFIG["seed"]
+    )
@@ -0,0 +1,141 @@
+"""
+分割したテキストのチャンクを少数の大きなファイル（パック）にまとめて保存・参照する共通モジュール
+
+split_long_txt.py はチャンクごとに1つの .txt ファイルを作成するため、ファイル数が非常に多くなります。
+output_format="pack" の場合は、各ワーカーが自分のパックファイルにチャンクを追記し、
+元のファイル名から各チャンクの位置を引けるインデックスを作成します。
+
+    <出力ディレクトリ>/
+        pack-<実行ID>-<PID>.jsonl   ワーカーごとのパック（1行1チャンク {"file_name": ..., "title": ..., "text": ...}）
+        index.jsonl                 元のファイル名ごとのチャンクの位置（ファイル名・チャンク番号の順）
+
+index.jsonl の各行は次のいずれかです。
+
+    {"file_name": "a.txt", "part": 1, "pack": "pack-xxx-123.jsonl", "offset": 0, "length": 1234}
+        分割したチャンク（パックの offset バイト目から length バイトが1行）
+    {"file_name": "b.txt", "source": "/path/to/input/b.txt"}
+        token_limit 以下のファイル（コピーせず入力ファイルを参照する）
+
+    with PackReader(output_dir) as reader:
+        for file_name in reader.file_names():
+            texts = reader.read(file_name)  # チャンクのテキストのリスト（分割していないファイルは1つ）
+"""
+
+import glob
+import json
+import os
+
+PACK_PREFIX = "pack-"
+PACK_SUFFIX = ".jsonl"
+INDEX_FILE = "index.jsonl"
+
+
+class PackWriter:
+    """1つのワーカーのパックファイルにチャンクを追記する"""
+
+    def __init__(self, output_dir, run_id):
+        self.run_id = run_id
+        self.name = f"{PACK_PREFIX}{run_id}-{os.getpid()}{PACK_SUFFIX}"
+        self.file = open(os.path.join(output_dir, self.name), 'ab')
+
+    def write_file(self, file_name, titles, texts):
+        """
+        1つのファイルのチャンクを追記し、インデックスの行のリストを返す
+        ファイルごとにフラッシュするため、行を親プロセスに返した時点でチャンクはパックに書き込まれている。
+        """
+        rows = []
+        for part, (title, text) in enumerate(zip(titles, texts), start=1):
+            line = json.dumps({"file_name": file_name, "title": title, "text": text}, ensure_ascii=False).encode('utf-8') + b"\n"
+            rows.append({"file_name": file_name, "part": part, "pack": self.name, "offset": self.file.tell(),
+                         "length": len(line)})
+            self.file.write(line)
+        self.file.flush()
+        return rows
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+# プロセスごとの PackWriter（出力ディレクトリごと。実行IDが変わった場合は新しいパックを作成する）
+_writers = {}
+
+
+def get_pack_writer(output_dir, run_id):
+    """このプロセスの output_dir のパックの PackWriter"""
+    key = os.path.abspath(output_dir)
+    writer = _writers.get(key)
+    if writer is None or writer.run_id != run_id:
+        if writer is not None:
+            writer.close()
+        writer = _writers[key] = PackWriter(output_dir, run_id)
+    return writer
+
+
+def source_row(file_name, input_file):
+    """token_limit 以下のファイルのインデックスの行（入力ファイルを参照する）"""
+    return {"file_name": file_name, "source": os.path.abspath(input_file)}
+
+
+def remove_pack(output_dir):
+    """output_dir の既存のパックとインデックスを削除する"""
+    for path in glob.glob(os.path.join(glob.escape(output_dir), f"{PACK_PREFIX}*{PACK_SUFFIX}")):
+        os.remove(path)
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+
+def write_index(output_dir, rows):
+    """インデックスをファイル名・チャンク番号の順に書き込む"""
+    rows = sorted(rows, key=lambda row: (row["file_name"], row.get("part", 0)))
+    with open(os.path.join(output_dir, INDEX_FILE), 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+class PackReader:
+    """パックのインデックスを読み込み、元のファイル名からチャンクのテキストを取得する"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.index = {}
+        with open(os.path.join(output_dir, INDEX_FILE), 'r', encoding='utf-8') as f:
+            for line in f:
+                row = json.loads(line)
+                self.index.setdefault(row["file_name"], []).append(row)
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, file_name):
+        return file_name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def file_names(self):
+        return list(self.index)
+
+    def _read_row(self, row):
+        if "source" in row:
+            with open(row["source"], 'r', encoding='utf-8') as f:
+                return f.read()
+        pack = self._files.get(row["pack"])
+        if pack is None:
+            pack = self._files[row["pack"]] = open(os.path.join(self.output_dir, row["pack"]), 'rb')
+        pack.seek(row["offset"])
+        return json.loads(pack.read(row["length"]))["text"]
+
+    def read(self, file_name):
+        """file_name のチャンクのテキストのリスト（分割していないファイルは入力ファイルの内容1つ）"""
+        return [self._read_row(row) for row in self.index[file_name]]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
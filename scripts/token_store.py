@@ -0,0 +1,106 @@
+"""
+トークン化済みのデータ（トークンID）を保存・読み込みする共通モジュール
+
+1つのデータセットは共通のプレフィックスを持つ3つのファイルで構成されます。
+
+    <prefix>.bin       全エントリのトークンIDを連結した uint32 の配列（リトルエンディアン）
+    <prefix>.idx.npy   各エントリの開始位置（int64、エントリ数 + 1 個。i 番目は offsets[i]:offsets[i+1]）
+    <prefix>.json      エントリのIDのリストとメタデータ（トークナイザー名・エントリ数・トークン数）
+
+.bin と .idx.npy は numpy のメモリマップで読み込めるため、学習時のデータローダーは
+トークン化をやり直さずにゼロコピーで各エントリのトークンIDを参照できます。
+エントリの順序は同時に出力したJSONLファイルと同じです。
+"""
+
+import json
+import os
+
+import numpy as np
+
+TOKEN_DTYPE = np.dtype("<u4")
+BIN_SUFFIX = ".bin"
+INDEX_SUFFIX = ".idx.npy"
+META_SUFFIX = ".json"
+
+
+def token_store_paths(prefix):
+    """(トークンファイル, オフセットのインデックス, メタデータ) のパスを返す"""
+    prefix = str(prefix)
+    return prefix + BIN_SUFFIX, prefix + INDEX_SUFFIX, prefix + META_SUFFIX
+
+
+class TokenStoreWriter:
+    """エントリごとのトークンIDを順に書き込む（close() でインデックスとメタデータを保存する）"""
+
+    def __init__(self, prefix, model_name=None):
+        self.bin_path, self.index_path, self.meta_path = token_store_paths(prefix)
+        os.makedirs(os.path.dirname(self.bin_path) or ".", exist_ok=True)
+        self.model_name = model_name
+        self.file = open(self.bin_path, 'wb')
+        self.offsets = [0]
+        self.ids = []
+
+    def write(self, entry_id, token_ids):
+        array = np.asarray(token_ids)
+        if array.size and (array.min() < 0 or array.max() > np.iinfo(TOKEN_DTYPE).max):
+            raise ValueError(f"uint32 で表せないトークンIDが含まれています: {entry_id}")
+        self.file.write(array.astype(TOKEN_DTYPE, copy=False).tobytes())
+        self.offsets.append(self.offsets[-1] + int(array.size))
+        self.ids.append(entry_id)
+
+    def close(self):
+        self.file.close()
+        np.save(self.index_path, np.asarray(self.offsets, dtype=np.int64))
+        meta = {
+            "format": "token-store",
+            "dtype": "uint32",
+            "model_name": self.model_name,
+            "num_entries": len(self.ids),
+            "num_tokens": self.offsets[-1],
+            "ids": self.ids
+        }
+        with open(self.meta_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class TokenStore:
+    """
+    保存したトークンIDをメモリマップで読み込む
+
+    store[i] は i 番目のエントリ、store.get(entry_id) はIDを指定してエントリのトークンIDを
+    numpy 配列（メモリマップへのビュー）として返す。
+    """
+
+    def __init__(self, prefix):
+        bin_path, index_path, meta_path = token_store_paths(prefix)
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.ids = self.meta["ids"]
+        self.offsets = np.load(index_path, mmap_mode='r')
+        # 空のファイルはメモリマップできないため、トークンがない場合は空の配列とする
+        if self.meta["num_tokens"]:
+            self.tokens = np.memmap(bin_path, dtype=TOKEN_DTYPE, mode='r')
+        else:
+            self.tokens = np.empty(0, dtype=TOKEN_DTYPE)
+        self._positions = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def get(self, entry_id):
+        if self._positions is None:
+            self._positions = {entry_id: i for i, entry_id in enumerate(self.ids)}
+        return self[self._positions[entry_id]]
+
+    def lengths(self):
+        """各エントリのトークン数の配列"""
+        return np.diff(self.offsets)
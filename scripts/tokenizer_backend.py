@@ -0,0 +1,134 @@
+"""
+トークナイザーを読み込む共通モジュール
+
+transformers の AutoTokenizer は import だけで数秒かかり（torch も読み込まれる）、
+ProcessPoolExecutor の各ワーカーでも同じ時間がかかります。このモジュールはモデルの tokenizer.json を
+tokenizers ライブラリで直接読み込むため、transformers / torch を読み込みません。
+
+    from tokenizer_backend import get_tokenizer
+    tokenizer = get_tokenizer(model_name)
+    tokenizer(texts, add_special_tokens=False)["input_ids"]
+
+返すトークナイザーは AutoTokenizer と同じ呼び出し方（__call__ / encode / decode）に対応しています。
+トークナイザーはプロセスごとに1度だけ、最初に使用したときに読み込みます（モジュールの import 時には読み込みません）。
+
+config.py の TOKENIZER_CONFIG で、使用するバックエンドと tokenizer.json のローカルパスを設定します。
+TOKENIZER_SERVICE_CONFIG の enabled が True で、tokenizer_service.py のサービスが同じモデルで起動している場合は、
+トークナイザーを読み込まずにサービスのクライアント（同じ呼び出し方）を返します。
+"""
+
+import functools
+import os
+import sys
+from pathlib import Path
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import TOKENIZER_CONFIG, TOKENIZER_SERVICE_CONFIG, MODEL_NAME
+
+TOKENIZER_FILE = "tokenizer.json"
+
+
+class FastTokenizer:
+    """tokenizers.Tokenizer を AutoTokenizer と同じ呼び出し方で使えるようにするラッパー"""
+
+    def __init__(self, tokenizer, name=None):
+        # AutoTokenizer と同様に、tokenizer.json の切り詰め・パディングの設定は使用しない
+        tokenizer.no_truncation()
+        tokenizer.no_padding()
+        self.tokenizer = tokenizer
+        self.name_or_path = name
+
+    @classmethod
+    def from_file(cls, path):
+        from tokenizers import Tokenizer
+        return cls(Tokenizer.from_file(str(path)), str(path))
+
+    @classmethod
+    def from_pretrained(cls, model_name):
+        """Hugging Face Hub のモデルの tokenizer.json を読み込む（ダウンロード済みの場合はキャッシュを使用）"""
+        from tokenizers import Tokenizer
+        return cls(Tokenizer.from_pretrained(model_name), model_name)
+
+    def __call__(self, text, add_special_tokens=True, return_offsets_mapping=False):
+        """
+        text が文字列の場合は {"input_ids": [...]}、リストの場合は {"input_ids": [[...], ...]} を返す
+        return_offsets_mapping=True の場合は各トークンの (開始, 終了) 文字位置も返す
+        """
+        if isinstance(text, str):
+            encodings = [self.tokenizer.encode(text, add_special_tokens=add_special_tokens)]
+        else:
+            encodings = self.tokenizer.encode_batch(list(text), add_special_tokens=add_special_tokens)
+
+        result = {"input_ids": [encoding.ids for encoding in encodings]}
+        if return_offsets_mapping:
+            result["offset_mapping"] = [encoding.offsets for encoding in encodings]
+        if isinstance(text, str):
+            result = {key: value[0] for key, value in result.items()}
+        return result
+
+    def encode(self, text, add_special_tokens=True):
+        return self.tokenizer.encode(text, add_special_tokens=add_special_tokens).ids
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return self.tokenizer.decode(list(token_ids), skip_special_tokens=skip_special_tokens)
+
+    def __len__(self):
+        return self.tokenizer.get_vocab_size(with_added_tokens=True)
+
+
+def resolve_tokenizer_file(model_name):
+    """
+    tokenizer.json のローカルパスを返す（ローカルにない場合は None）
+    TOKENIZER_CONFIG["tokenizer_file"] が指定されていればそれを、
+    model_name がファイルまたは tokenizer.json を含むディレクトリの場合はそのパスを使用する。
+    """
+    for candidate in (TOKENIZER_CONFIG.get("tokenizer_file"), model_name):
+        if not candidate:
+            continue
+        if os.path.isfile(candidate):
+            return candidate
+        if os.path.isfile(os.path.join(candidate, TOKENIZER_FILE)):
+            return os.path.join(candidate, TOKENIZER_FILE)
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model_name=None, backend=None):
+    """
+    トークナイザーを返す（プロセスごとにキャッシュする）
+
+    Args:
+        model_name: モデル名（Hugging Face Hub）またはローカルのパス（省略時は MODEL_NAME）
+        backend: "tokenizers" / "transformers"（省略時は TOKENIZER_CONFIG["backend"]）
+    """
+    model_name = model_name or MODEL_NAME
+    if TOKENIZER_SERVICE_CONFIG.get("enabled", False):
+        from tokenizer_service import connect
+        client = connect(model_name)
+        if client is not None:
+            return client
+    return load_tokenizer(model_name, backend)
+
+
+def load_tokenizer(model_name=None, backend=None):
+    """トークナイザーをこのプロセスに読み込む（キャッシュしない。通常は get_tokenizer を使用する）"""
+    model_name = model_name or MODEL_NAME
+    backend = backend or TOKENIZER_CONFIG.get("backend", "tokenizers")
+
+    if backend == "tokenizers":
+        path = resolve_tokenizer_file(model_name)
+        if path is not None:
+            return FastTokenizer.from_file(path)
+        try:
+            return FastTokenizer.from_pretrained(model_name)
+        except Exception as e:
+            # tokenizer.json がないモデル（SentencePiece のみなど）は transformers で読み込む
+            print(f"警告: {model_name} の tokenizer.json を読み込めないため、transformers を使用します: {e}")
+    elif backend != "transformers":
+        raise ValueError(f"不明なトークナイザーのバックエンドです: {backend}")
+
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(model_name)
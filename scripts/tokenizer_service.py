@@ -0,0 +1,375 @@
+"""
+トークナイザーを1つのプロセスで保持し、複数のプロセスからのトークン化の要求を処理するローカルのサービス
+
+各スクリプトとプロセスプールの各ワーカーはそれぞれトークナイザーを読み込むため、コア数の多いマシンでは
+語彙のコピーがワーカー数だけメモリに載り、短いジョブではトークン化よりも読み込みに時間がかかります。
+このサービスを起動しておくと、get_tokenizer() はトークナイザーを読み込まずにサービスのクライアントを返します。
+
+    python scripts/tokenizer_service.py    # TOKENIZER_SERVICE_CONFIG の socket で待ち受ける（Ctrl+C で終了）
+
+- 複数のクライアントから coalesce_ms ミリ秒以内に届いた要求は、1回の encode_batch にまとめてトークン化します
+  （tokenizers はバッチを複数のスレッドで処理するため、小さな要求が多い場合もコアを使い切れます）
+- サービスのモデル名が要求されたモデル名と異なる場合や、サービスが起動していない・途中で停止した場合、
+  クライアントはプロセス内でトークナイザーを読み込んで処理を続けます
+
+プロトコル（Unix ソケット、リトルエンディアン）:
+
+    要求:  <B 操作><B フラグ><I 件数><I ペイロードのバイト数> + ペイロード
+    応答:  <B 状態（0: 成功、1: エラー）><I ペイロードのバイト数> + ペイロード
+
+    操作   要求のペイロード                              応答のペイロード
+    HELLO  なし                                         JSON {"model_name": ..., "vocab_size": ...}
+    ENCODE 各テキストのバイト数（uint32 × 件数）+ UTF-8    各テキストのトークン数（uint32 × 件数）+ トークンID（uint32）
+                                                        （OFFSETS の場合はさらに各トークンの (開始, 終了) 文字位置（uint32 × 2））
+    COUNT  ENCODE と同じ                                 各テキストのトークン数（uint32 × 件数）
+    DECODE 各リストのトークン数（uint32 × 件数）+ トークンID  各テキストのバイト数（uint32 × 件数）+ UTF-8
+"""
+
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# スクリプトのディレクトリを取得してパスに追加
+script_dir = Path(__file__).parent
+sys.path.append(str(script_dir))
+
+from config import TOKENIZER_SERVICE_CONFIG
+
+OP_HELLO = 0
+OP_ENCODE = 1
+OP_COUNT = 2
+OP_DECODE = 3
+
+FLAG_SPECIAL_TOKENS = 1  # add_special_tokens（DECODE では skip_special_tokens）
+FLAG_OFFSETS = 2  # return_offsets_mapping
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+REQUEST_HEADER = struct.Struct("<BBII")
+RESPONSE_HEADER = struct.Struct("<BI")
+UINT32 = np.dtype("<u4")
+
+
+def pack_texts(texts):
+    """テキストのリストを (各テキストのバイト数 + UTF-8) のバイト列にする"""
+    encoded = [text.encode('utf-8') for text in texts]
+    return np.fromiter(map(len, encoded), dtype=UINT32, count=len(encoded)).tobytes() + b"".join(encoded)
+
+
+def unpack_texts(payload, n):
+    lengths = np.frombuffer(payload, dtype=UINT32, count=n)
+    ends = np.cumsum(lengths, dtype=np.int64) + 4 * n
+    starts = ends - lengths
+    return [payload[start:end].decode('utf-8') for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def pack_id_lists(id_lists):
+    """トークンIDのリストのリストを (各リストの長さ + トークンID) のバイト列にする"""
+    lengths = np.fromiter(map(len, id_lists), dtype=UINT32, count=len(id_lists))
+    ids = np.fromiter(itertools.chain.from_iterable(id_lists), dtype=UINT32, count=int(lengths.sum()))
+    return lengths.tobytes() + ids.tobytes()
+
+
+def unpack_id_lists(payload, n):
+    """pack_id_lists の逆（戻り値: (リストのリスト, 読み込んだバイト数)）"""
+    lengths = np.frombuffer(payload, dtype=UINT32, count=n)
+    total = int(lengths.sum())
+    ids = np.frombuffer(payload, dtype=UINT32, count=total, offset=4 * n).tolist()
+    bounds = list(itertools.accumulate(lengths.tolist(), initial=0))
+    return [ids[start:end] for start, end in zip(bounds, bounds[1:])], 4 * (n + total)
+
+
+# --- サーバー ---
+
+class _Request:
+    """トークン化の要求（接続のスレッドが作成し、トークン化のスレッドが結果を設定する）"""
+
+    def __init__(self, texts, add_special_tokens, return_offsets_mapping):
+        self.texts = texts
+        self.key = (add_special_tokens, return_offsets_mapping)
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class TokenizerService:
+    """トークナイザーを保持し、複数の要求をまとめてトークン化する"""
+
+    def __init__(self, model_name, coalesce_ms=2, max_batch_chars=1 << 22):
+        from tokenizer_backend import load_tokenizer
+        self.model_name = model_name
+        self.tokenizer = load_tokenizer(model_name)
+        self.coalesce = coalesce_ms / 1000
+        self.max_batch_chars = max_batch_chars
+        self.requests = queue.Queue()
+        self.num_requests = 0
+        self.num_batches = 0
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def tokenize(self, texts, add_special_tokens, return_offsets_mapping):
+        """他の要求とまとめてトークン化し、tokenizer(texts, ...) と同じ形式の結果を返す"""
+        request = _Request(texts, add_special_tokens, return_offsets_mapping)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _collect(self):
+        """最初の要求から coalesce 秒以内に届いた要求を max_batch_chars 文字までまとめる"""
+        batch = [self.requests.get()]
+        chars = sum(map(len, batch[0].texts))
+        deadline = time.monotonic() + self.coalesce
+        while chars < self.max_batch_chars:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            chars += sum(map(len, request.texts))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # 同じオプションの要求ごとに1回でトークン化する
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.key, []).append(request)
+            for (add_special_tokens, return_offsets_mapping), requests in groups.items():
+                texts = [text for request in requests for text in request.texts]
+                try:
+                    encoded = self.tokenizer(texts, add_special_tokens=add_special_tokens,
+                                             return_offsets_mapping=return_offsets_mapping)
+                    start = 0
+                    for request in requests:
+                        end = start + len(request.texts)
+                        request.result = {key: values[start:end] for key, values in encoded.items()}
+                        start = end
+                except Exception as e:
+                    for request in requests:
+                        request.error = e
+                for request in requests:
+                    request.done.set()
+            self.num_requests += len(batch)
+            self.num_batches += len(groups)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """1つのクライアントの接続（接続ごとのスレッドで要求を順に処理する）"""
+
+    def handle(self):
+        service = self.server.service
+        while True:
+            header = self.rfile.read(REQUEST_HEADER.size)
+            if len(header) < REQUEST_HEADER.size:
+                return
+            op, flags, n, size = REQUEST_HEADER.unpack(header)
+            payload = self.rfile.read(size)
+            try:
+                response = self._process(service, op, flags, n, payload)
+                status = STATUS_OK
+            except Exception as e:
+                response = f"{type(e).__name__}: {e}".encode('utf-8')
+                status = STATUS_ERROR
+            self.wfile.write(RESPONSE_HEADER.pack(status, len(response)) + response)
+            self.wfile.flush()
+
+    @staticmethod
+    def _process(service, op, flags, n, payload):
+        if op == OP_HELLO:
+            info = {"model_name": service.model_name, "vocab_size": len(service.tokenizer)}
+            return json.dumps(info, ensure_ascii=False).encode('utf-8')
+        if op == OP_DECODE:
+            id_lists, _ = unpack_id_lists(payload, n)
+            skip_special_tokens = bool(flags & FLAG_SPECIAL_TOKENS)
+            return pack_texts([service.tokenizer.decode(ids, skip_special_tokens=skip_special_tokens) for ids in id_lists])
+        if op not in (OP_ENCODE, OP_COUNT):
+            raise ValueError(f"不明な操作です: {op}")
+
+        return_offsets_mapping = op == OP_ENCODE and bool(flags & FLAG_OFFSETS)
+        result = service.tokenize(unpack_texts(payload, n), bool(flags & FLAG_SPECIAL_TOKENS), return_offsets_mapping)
+        if op == OP_COUNT:
+            return np.fromiter(map(len, result["input_ids"]), dtype=UINT32, count=n).tobytes()
+        response = pack_id_lists(result["input_ids"])
+        if return_offsets_mapping:
+            offsets = itertools.chain.from_iterable(itertools.chain.from_iterable(result["offset_mapping"]))
+            response += np.fromiter(offsets, dtype=UINT32).tobytes()
+        return response
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path=None, model_name=None):
+    """サービスを起動し、Ctrl+C で終了するまで要求を処理する"""
+    socket_path = socket_path or TOKENIZER_SERVICE_CONFIG["socket"]
+    model_name = model_name or TOKENIZER_SERVICE_CONFIG.get("model_name")
+    if os.path.exists(socket_path):
+        if _connect(socket_path) is not None:
+            print(f"エラー: サービスは既に起動しています: {socket_path}")
+            return 1
+        # 前回異常終了したときのソケットファイルを削除する
+        os.remove(socket_path)
+
+    service = TokenizerService(model_name, TOKENIZER_SERVICE_CONFIG.get("coalesce_ms", 2),
+                               TOKENIZER_SERVICE_CONFIG.get("max_batch_chars", 1 << 22))
+    server = _Server(socket_path, _Handler)
+    server.service = service
+    print(f"トークナイザーのサービスを起動しました: {socket_path} (モデル: {model_name})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        print(f"サービスを終了しました（要求数: {service.num_requests}, バッチ数: {service.num_batches}）")
+    return 0
+
+
+# --- クライアント ---
+
+def _connect(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+class ServiceTokenizer:
+    """
+    サービスにトークン化を要求するクライアント（tokenizer_backend.FastTokenizer と同じ呼び出し方）
+
+    接続はプロセスごとに作成する（fork したワーカーが親プロセスの接続を共有しないように、PID が変わった場合は再接続する）。
+    サービスとの通信に失敗した場合は、プロセス内でトークナイザーを読み込んで以降の処理を行う。
+    """
+
+    def __init__(self, socket_path, model_name, vocab_size):
+        self.socket_path = socket_path
+        self.name_or_path = model_name
+        self.vocab_size = vocab_size
+        self._sock = None
+        self._pid = None
+        self._local = None
+
+    def _request(self, op, flags, n, payload):
+        if self._sock is None or self._pid != os.getpid():
+            self._sock = _connect(self.socket_path)
+            if self._sock is None:
+                raise ConnectionError(f"サービスに接続できません: {self.socket_path}")
+            self._pid = os.getpid()
+            self._file = self._sock.makefile('rb')
+        self._sock.sendall(REQUEST_HEADER.pack(op, flags, n, len(payload)) + payload)
+        header = self._file.read(RESPONSE_HEADER.size)
+        if len(header) < RESPONSE_HEADER.size:
+            raise ConnectionError("サービスとの接続が切断されました")
+        status, size = RESPONSE_HEADER.unpack(header)
+        response = self._file.read(size)
+        if status != STATUS_OK:
+            raise RuntimeError(f"トークナイザーのサービスでエラーが発生しました: {response.decode('utf-8')}")
+        return response
+
+    def _fallback(self, e):
+        """サービスを使用できない場合にプロセス内のトークナイザーに切り替える"""
+        if self._local is None:
+            from tokenizer_backend import load_tokenizer
+            print(f"警告: トークナイザーのサービスを使用できないため、プロセス内で読み込みます: {e}")
+            self._sock = None
+            self._local = load_tokenizer(self.name_or_path)
+        return self._local
+
+    def __call__(self, text, add_special_tokens=True, return_offsets_mapping=False):
+        if self._local is not None:
+            return self._local(text, add_special_tokens=add_special_tokens, return_offsets_mapping=return_offsets_mapping)
+        texts = [text] if isinstance(text, str) else list(text)
+        flags = (FLAG_SPECIAL_TOKENS if add_special_tokens else 0) | (FLAG_OFFSETS if return_offsets_mapping else 0)
+        try:
+            response = self._request(OP_ENCODE, flags, len(texts), pack_texts(texts))
+        except (OSError, ConnectionError) as e:
+            return self._fallback(e)(text, add_special_tokens=add_special_tokens,
+                                     return_offsets_mapping=return_offsets_mapping)
+
+        id_lists, size = unpack_id_lists(response, len(texts))
+        result = {"input_ids": id_lists}
+        if return_offsets_mapping:
+            flat = np.frombuffer(response, dtype=UINT32, offset=size).tolist()
+            pairs = list(zip(flat[0::2], flat[1::2]))
+            bounds = list(itertools.accumulate(map(len, id_lists), initial=0))
+            result["offset_mapping"] = [pairs[start:end] for start, end in zip(bounds, bounds[1:])]
+        if isinstance(text, str):
+            result = {key: value[0] for key, value in result.items()}
+        return result
+
+    def count(self, texts, add_special_tokens=True):
+        """各テキストのトークン数のリスト（トークンIDを受け取らないため ENCODE より応答が小さい）"""
+        if self._local is None:
+            flags = FLAG_SPECIAL_TOKENS if add_special_tokens else 0
+            try:
+                response = self._request(OP_COUNT, flags, len(texts), pack_texts(texts))
+                return np.frombuffer(response, dtype=UINT32).tolist()
+            except (OSError, ConnectionError) as e:
+                self._fallback(e)
+        return [len(ids) for ids in self._local(texts, add_special_tokens=add_special_tokens)["input_ids"]]
+
+    def encode(self, text, add_special_tokens=True):
+        return self(text, add_special_tokens=add_special_tokens)["input_ids"]
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        if self._local is None:
+            flags = FLAG_SPECIAL_TOKENS if skip_special_tokens else 0
+            try:
+                response = self._request(OP_DECODE, flags, 1, pack_id_lists([list(token_ids)]))
+                return unpack_texts(response, 1)[0]
+            except (OSError, ConnectionError) as e:
+                self._fallback(e)
+        return self._local.decode(token_ids, skip_special_tokens=skip_special_tokens)
+
+    def __len__(self):
+        return self.vocab_size
+
+
+def connect(model_name, socket_path=None):
+    """
+    サービスが起動しており、model_name のトークナイザーを保持している場合は ServiceTokenizer を返す
+    （それ以外の場合は None）
+    """
+    socket_path = socket_path or TOKENIZER_SERVICE_CONFIG["socket"]
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+    try:
+        sock.sendall(REQUEST_HEADER.pack(OP_HELLO, 0, 0, 0))
+        with sock.makefile('rb') as f:
+            status, size = RESPONSE_HEADER.unpack(f.read(RESPONSE_HEADER.size))
+            info = json.loads(f.read(size))
+    except (OSError, struct.error, ValueError):
+        return None
+    finally:
+        sock.close()
+    if status != STATUS_OK or info["model_name"] != model_name:
+        return None
+    return ServiceTokenizer(socket_path, model_name, info["vocab_size"])
+
+
+if __name__ == "__main__":
+    sys.exit(serve())
@@ -1,8 +1,79 @@
 import os
-import json
+import hashlib
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from config import TXT_TO_JSONL_CONFIG
+from shards import ShardWriter, is_sharded_dataset, load_manifest
+from jsonl_io import write_records, splitext_jsonl
+from metrics import measure_stage, timer, count, merge, pop_delta
+from scheduler import run_scheduled
 
-def txt_files_to_jsonl(input_dirs, output_dir, output_filename, category, id_prefix, use_delimiter=False, delimiter="\n;"):
+# id の振り方
+#   "sequential": ファイル名順の連番（1プロセスで順に処理した場合と同じ id）
+#   "hash": 入力ディレクトリの番号・ファイル名・ブロック番号から計算した id（ファイルの追加・削除で他のファイルの id が変わらない）
+ID_SCHEMES = ("sequential", "hash")
+
+def read_blocks(file_path, use_delimiter=False, delimiter="\n;"):
+    """
+    ファイルを読み込み、(タイトル, テキスト) のリストを返す
+    use_delimiter が True の場合はデリミタで分割し、空のブロックは除く（タイトルは <ファイル名>_block_<ブロック番号>）
+    """
+    with timer("read"), open(file_path, 'r', encoding='utf-8') as in_f:
+        content = in_f.read().strip()
+    # 拡張子を除いたタイトル
+    title = os.path.splitext(os.path.basename(file_path))[0]
+    if not use_delimiter:
+        # 従来の処理（1ファイル1エントリ）
+        return [(title, content)]
+    blocks = []
+    for block_index, block in enumerate(content.split(delimiter)):
+        block = block.strip()
+        if block:  # 空のブロックは無視
+            # タイトルにブロック番号を追加
+            blocks.append((f"{title}_block_{block_index}", block))
+    return blocks
+
+def count_blocks(file_path, use_delimiter=False, delimiter="\n;"):
+    """ファイルのエントリ数を返す（連番の開始位置を求めるための1回目の処理）"""
+    return len(read_blocks(file_path, use_delimiter, delimiter)), pop_delta()
+
+def source_key(dir_index, file_name):
+    """
+    id_scheme="hash" の id の元になるファイルの識別子（input_dirs の番号/ファイル名）
+    ディレクトリ名は別の親ディレクトリの同じ名前のディレクトリと重複するため、入力ディレクトリの番号を使う
+    """
+    return f"{dir_index}/{file_name}"
+
+def stable_id(category, id_prefix, source, title):
+    """ファイルの識別子（source_key）とタイトル（ブロック番号を含む）から計算した id（id_scheme="hash"）"""
+    key = f"{source}#{title}"
+    return f"{category}-{id_prefix}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}"
+
+def convert_file(task, category, id_prefix, use_delimiter=False, delimiter="\n;", id_scheme="sequential"):
+    """
+    task = (ファイルのパス, 連番の開始位置, source_key) のファイルをエントリのリストに変換する
+    id はこのファイルの情報だけから決まるため、各ファイルを別のワーカーで任意の順に処理できる
+    """
+    file_path, start, source = task
+    entries = []
+    for i, (title, text) in enumerate(read_blocks(file_path, use_delimiter, delimiter)):
+        if id_scheme == "hash":
+            json_id = stable_id(category, id_prefix, source, title)
+        else:
+            # id を category, id_prefix, 連番から生成
+            json_id = f"{category}-{id_prefix}-{start + i}"
+        entries.append({
+            "id": json_id,
+            "title": title,
+            "text": text
+        })
+    return entries, pop_delta()
+
+@measure_stage("txt_to_jsonl")
+def txt_files_to_jsonl(input_dirs, output_dir, output_filename, category, id_prefix, use_delimiter=False, delimiter="\n;", shard_size=None,
+                       id_scheme="sequential", executor=None):
     """
     指定されたディレクトリ（またはディレクトリのリスト）内のすべての .txt ファイルを読み込み、
     各ファイルの内容とファイル名（拡張子除く）を JSON オブジェクトに変換し、
@@ -11,6 +82,9 @@ def txt_files_to_jsonl(input_dirs, output_dir, output_filename, category, id_pre
     "id" は、関数の引数で渡された category と id_prefix に連番（0から開始）をハイフンで連結して生成します。
     例: "normal-01-0", "normal-01-1" または "STG-01-0", "STG-01-1"
     
+    各ファイルはプロセスプールで並列に変換します。連番は、1回目に各ファイルのエントリ数を並列に数え、
+    その累積和から各ファイルの開始位置を求めるため、ファイル名順に1つずつ処理した場合と同じになります。
+    
     Parameters:
         input_dirs (str or list): .txt ファイルがある入力ディレクトリのパス、またはそのリスト。
         output_dir (str): 出力先ディレクトリのパス。
@@ -19,6 +93,13 @@ def txt_files_to_jsonl(input_dirs, output_dir, output_filename, category, id_pre
         id_prefix (str): id の中間部分。例: "01" や "02"。
         use_delimiter (bool): デリミタを使用してファイルを分割するかどうか。デフォルトはFalse。
         delimiter (str): ファイルを分割するデリミタ。デフォルトは"\n;"。
+        shard_size (int): 指定した場合、output_dir/<output_filename の拡張子を除いた名前>/ に
+            シャード形式で出力する（shards.py を参照）。既に出力済みのファイルはスキップし、
+            新しく追加されたファイルのみを新しいシャードとして追記する（連番は前回の続きから振る）。
+        id_scheme (str): "sequential"（連番）または "hash"（input_dirs での入力ディレクトリの番号・ファイル名・
+            ブロック番号のハッシュ。エントリ数を数える1回目の処理が不要で、再実行やファイルの追加・削除でも
+            同じファイルの id は変わらない。input_dirs の順序を変えると id が変わるため、ディレクトリは末尾に追加する）。
+        executor: 指定された場合、新しいプロセスプールを起動せずにこのプールを使用する（cli.py のバッチ実行）。
     """
     try:
         # 入力が文字列の場合はリストに変換
@@ -29,59 +110,69 @@ def txt_files_to_jsonl(input_dirs, output_dir, output_filename, category, id_pre
         os.makedirs(output_dir, exist_ok=True)
         output_file = os.path.join(output_dir, output_filename)
 
-        json_data = []
+        if id_scheme not in ID_SCHEMES:
+            raise ValueError(f"id_scheme は {ID_SCHEMES} のいずれかを指定してください: {id_scheme}")
         counter = 0  # 連番カウンタ
 
-        # 各ディレクトリごとに .txt ファイルを処理
-        for input_dir in input_dirs:
+        # シャード形式の場合、前回までに出力したファイルと連番を引き継ぐ
+        processed_files = set()
+        if shard_size:
+            output_file = os.path.join(output_dir, splitext_jsonl(output_filename)[0])
+            if is_sharded_dataset(output_file):
+                manifest = load_manifest(output_file)
+                processed_files = set(manifest.get("source_files", []))
+                counter = manifest.get("next_counter", 0)
+        new_files = []
+        sources = []
+
+        # 各ディレクトリごとに .txt ファイルを列挙
+        for dir_index, input_dir in enumerate(input_dirs):
             # 安定した順序で処理するためにファイル名でソート
             for file_name in sorted(os.listdir(input_dir)):
                 if file_name.endswith('.txt'):
                     file_path = os.path.join(input_dir, file_name)
-                    with open(file_path, 'r', encoding='utf-8') as in_f:
-                        content = in_f.read().strip()
-                    # 拡張子を除いたタイトル
-                    title = os.path.splitext(file_name)[0]
+                    if file_path in processed_files:
+                        continue
+                    new_files.append(file_path)
+                    sources.append(source_key(dir_index, file_name))
 
-                    if use_delimiter:
-                        # デリミタを使用してファイルを分割
-                        blocks = content.split(delimiter)
-                        for block_index, block in enumerate(blocks):
-                            block = block.strip()
-                            if block:  # 空のブロックは無視
-                                # id を category, id_prefix, 連番から生成
-                                json_id = f"{category}-{id_prefix}-{counter}"
-                                counter += 1
+        # ファイルサイズの大きい順にワーカーに割り当て、結果はファイル名順に受け取る（scheduler.py）
+        costs = [os.path.getsize(file_path) for file_path in new_files]
+        with timer("pool"), (nullcontext(executor) if executor else ProcessPoolExecutor()) as pool:
+            if id_scheme == "sequential":
+                # 各ファイルのエントリ数の累積和から、各ファイルの連番の開始位置を求める
+                count_func = partial(count_blocks, use_delimiter=use_delimiter, delimiter=delimiter)
+                block_counts = []
+                for num_blocks, metrics_delta in run_scheduled(pool, count_func, new_files, costs):
+                    merge(metrics_delta)
+                    block_counts.append(num_blocks)
+                starts = [counter + offset for offset in itertools.accumulate(block_counts, initial=0)]
+            else:
+                starts = [None] * (len(new_files) + 1)
+            convert_func = partial(convert_file, category=category, id_prefix=id_prefix, use_delimiter=use_delimiter,
+                                   delimiter=delimiter, id_scheme=id_scheme)
+            json_data = []
+            for entries, metrics_delta in run_scheduled(pool, convert_func, list(zip(new_files, starts, sources)), costs):
+                merge(metrics_delta)
+                json_data.extend(entries)
+        counter += len(json_data)
 
-                                # タイトルにブロック番号を追加
-                                block_title = f"{title}_block_{block_index}"
-
-                                json_entry = {
-                                    "id": json_id,
-                                    "title": block_title,
-                                    "text": block
-                                }
-                                json_data.append(json_entry)
-                    else:
-                        # 従来の処理（1ファイル1エントリ）
-                        # id を category, id_prefix, 連番から生成
-                        json_id = f"{category}-{id_prefix}-{counter}"
-                        counter += 1
-
-                        json_entry = {
-                            "id": json_id,
-                            "title": title,
-                            "text": content
-                        }
-                        json_data.append(json_entry)
-
-        # JSONL ファイルとして出力（1行に1つの JSON オブジェクト）
-        with open(output_file, 'w', encoding='utf-8') as out_f:
-            for entry in json_data:
-                json_line = json.dumps(entry, ensure_ascii=False)
-                out_f.write(json_line + '\n')
+        if shard_size:
+            # シャード形式で追記（既存のシャードは変更しない）
+            with timer("write"):
+                writer = ShardWriter(output_file, shard_size, append=True)
+                for entry in json_data:
+                    writer.write(entry)
+                writer.close(source_files=sorted(processed_files | set(new_files)), next_counter=counter)
+            print(f"シャードを追記しました: {output_file} (新規ファイル数: {len(new_files)}, 新規シャード数: {len(writer.written_shards)})")
+        else:
+            # JSONL ファイルとして出力（1行に1つの JSON オブジェクト。拡張子が .arrow / .parquet の場合は列指向形式）
+            with timer("write"):
+                write_records(output_file, json_data)
 
-        print(f"JSONLファイルが作成されました: {output_file}")
+            print(f"JSONLファイルが作成されました: {output_file}")
+        count("files_in", len(new_files))
+        count("records_out", len(json_data))
         print(f"処理した行数: {len(json_data)}")
         if use_delimiter:
             print(f"デリミタ '{delimiter}' を使用してファイルを分割しました")
@@ -89,15 +180,21 @@ def txt_files_to_jsonl(input_dirs, output_dir, output_filename, category, id_pre
             print("従来の処理（1ファイル1エントリ）で処理しました")
         
     except Exception as e:
+        # 呼び出し元（pipeline.py など）が失敗を検出できるように例外を送出し直す
         print(f"エラーが発生しました: {e}")
+        raise
 
-# 設定ファイルから値を読み込む
-input_directories = TXT_TO_JSONL_CONFIG["input_directories"]
-category = TXT_TO_JSONL_CONFIG["category"]
-id_prefix = TXT_TO_JSONL_CONFIG["id_prefix"]
-output_directory = TXT_TO_JSONL_CONFIG["output_dir"]
-output_filename = TXT_TO_JSONL_CONFIG["output_filename"]
-use_delimiter = TXT_TO_JSONL_CONFIG.get("use_delimiter", False)
-delimiter = TXT_TO_JSONL_CONFIG.get("delimiter", "\n;")
+if __name__ == "__main__":
+    # 設定ファイルから値を読み込む
+    input_directories = TXT_TO_JSONL_CONFIG["input_directories"]
+    category = TXT_TO_JSONL_CONFIG["category"]
+    id_prefix = TXT_TO_JSONL_CONFIG["id_prefix"]
+    output_directory = TXT_TO_JSONL_CONFIG["output_dir"]
+    output_filename = TXT_TO_JSONL_CONFIG["output_filename"]
+    use_delimiter = TXT_TO_JSONL_CONFIG.get("use_delimiter", False)
+    delimiter = TXT_TO_JSONL_CONFIG.get("delimiter", "\n;")
+    shard_size = TXT_TO_JSONL_CONFIG.get("shard_size")
+    id_scheme = TXT_TO_JSONL_CONFIG.get("id_scheme", "sequential")
 
-txt_files_to_jsonl(input_directories, output_directory, output_filename, category, id_prefix, use_delimiter, delimiter)
+    txt_files_to_jsonl(input_directories, output_directory, output_filename, category, id_prefix, use_delimiter, delimiter, shard_size,
+                       id_scheme)